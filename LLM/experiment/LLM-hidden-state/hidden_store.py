@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+hidden state 分块存储（HDF5）：
+- 所有 prompt 写入同一个 .h5 文件，取代每条 prompt 一个 savez_compressed 的 .npz
+- output_hidden 按 (layer × token × hidden) 分块压缩，各 prompt 的生成 token 依次拼接在 token 轴上，
+  由索引表中的 token_offset / token_count 定位
+- 读取 (prompt_id, layer, token) 时只解压相关的块，不必解压整个 (layers, tokens, hidden) 数组
+- 采集循环通过 HiddenStateWriter 把结果交给后台线程追加写入
+
+读取示例:
+    with HiddenStateStore("hidden_states.h5") as store:
+        meta = store.metadata()                          # 每条 prompt 一行
+        h = store.output_hidden(1, token=3)              # (layers, hidden)
+        h = store.output_hidden(1, layer=20)             # (tokens, hidden)
+        x = store.input_last_hidden(1, layer=20)         # (hidden,)
+"""
+
+import json
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# ================== 存储格式 ==================
+
+TOKEN_CHUNK = 16           # output_hidden 每个块包含的 token 数
+INDEX_CHUNK = 1024         # 索引表每个块的行数
+INDEX_COLUMNS = ("prompt_id", "token_offset", "token_count")
+
+
+class HiddenStateStore:
+    """
+    单文件 hidden state 存储
+    - input_last_hidden: (rows, layers, hidden)，每行一条 prompt
+    - output_hidden: (layers, total_tokens, hidden)，块大小 (1, TOKEN_CHUNK, hidden)
+    - index/prompt_id, index/token_offset, index/token_count, index/meta: 每行一条 prompt
+    同一 prompt_id 重复写入时读取最后一次
+
+    每条记录最后写入 index/prompt_id 作为提交标记（未写入的位置为 -1）：
+    只有 prompt_id 已写入的行才算完成；以可写模式打开时，中断留下的未提交数据被截掉
+    """
+
+    def __init__(self, path: str, mode: str = "r"):
+        if h5py is None:
+            raise ImportError("HDF5 存储需要安装 h5py")
+        self.path = path
+        self.file = h5py.File(path, mode)
+        self._rows: Dict[int, int] = {}
+        self._committed = 0
+        if "index" in self.file:
+            prompt_ids = self.file["index/prompt_id"][:]
+            uncommitted = np.flatnonzero(prompt_ids < 0)
+            self._committed = int(uncommitted[0]) if len(uncommitted) else len(prompt_ids)
+            for row, prompt_id in enumerate(prompt_ids[: self._committed]):
+                self._rows[int(prompt_id)] = row
+            if mode != "r":
+                self._truncate()
+
+    def _token_end(self) -> int:
+        """已提交记录占用的 token 数（下一条记录的 token_offset）"""
+        if self._committed == 0:
+            return 0
+        row = self._committed - 1
+        return int(self.file["index/token_offset"][row] + self.file["index/token_count"][row])
+
+    def _truncate(self):
+        """把各数据集截到已提交的记录，丢弃中断时写了一半的记录"""
+        rows = self._committed
+        for name in ("input_last_hidden", *(f"index/{c}" for c in (*INDEX_COLUMNS, "meta"))):
+            if self.file[name].shape[0] != rows:
+                self.file[name].resize(rows, axis=0)
+        if self.file["output_hidden"].shape[1] != self._token_end():
+            self.file["output_hidden"].resize(self._token_end(), axis=1)
+        self.file.flush()
+
+    # ---------- 写入 ----------
+
+    def _create(self, num_layers: int, hidden_size: int, layers: List[int]):
+        self.file.attrs["layers"] = json.dumps(layers)
+        self.file.create_dataset(
+            "input_last_hidden",
+            shape=(0, num_layers, hidden_size),
+            maxshape=(None, num_layers, hidden_size),
+            chunks=(1, num_layers, hidden_size),
+            dtype="float16",
+            compression="gzip",
+            shuffle=True,
+        )
+        self.file.create_dataset(
+            "output_hidden",
+            shape=(num_layers, 0, hidden_size),
+            maxshape=(num_layers, None, hidden_size),
+            chunks=(1, TOKEN_CHUNK, hidden_size),
+            dtype="float16",
+            compression="gzip",
+            shuffle=True,
+        )
+        for column in INDEX_COLUMNS:
+            self.file.create_dataset(
+                f"index/{column}", shape=(0,), maxshape=(None,),
+                chunks=(INDEX_CHUNK,), dtype="int64", fillvalue=-1,
+            )
+        self.file.create_dataset(
+            "index/meta", shape=(0,), maxshape=(None,),
+            chunks=(INDEX_CHUNK,), dtype=h5py.string_dtype(),
+        )
+
+    def append(
+        self,
+        prompt_id: int,
+        prompt_text: str,
+        prompt_type: str,
+        collected: Dict[str, Any],
+    ):
+        input_last_hidden = np.asarray(collected["input_last_hidden"], dtype=np.float16)
+        output_hidden = np.asarray(collected["output_hidden"], dtype=np.float16)
+        num_layers, num_tokens, hidden_size = output_hidden.shape
+        layers = list(collected.get("layers") or range(num_layers))
+
+        if "output_hidden" not in self.file:
+            self._create(num_layers, hidden_size, layers)
+        elif json.loads(self.file.attrs["layers"]) != layers:
+            raise ValueError(f"采集的层 {layers} 与存储中的层不一致: {self.path}")
+
+        # 行号与 token 位置只由已提交的记录决定，之前中断留下的残余数据被覆盖
+        row = self._committed
+        token_offset = self._token_end()
+
+        out = self.file["output_hidden"]
+        out.resize(token_offset + num_tokens, axis=1)
+        out[:, token_offset:, :] = output_hidden
+
+        self.file["input_last_hidden"].resize(row + 1, axis=0)
+        self.file["input_last_hidden"][row] = input_last_hidden
+
+        meta = {
+            "prompt_id": prompt_id,
+            "prompt_type": prompt_type,
+            "prompt": prompt_text,
+            "generated_ids": collected["generated_ids"],
+            "generated_texts": collected["generated_texts"],
+            "score": collected["score"],
+        }
+        # prompt_id 最后写入，作为该行的提交标记
+        values = {
+            "token_offset": token_offset,
+            "token_count": num_tokens,
+            "meta": json.dumps(meta, ensure_ascii=False),
+            "prompt_id": prompt_id,
+        }
+        for column, value in values.items():
+            ds = self.file[f"index/{column}"]
+            ds.resize(row + 1, axis=0)
+            ds[row] = value
+
+        # 每条落盘，中断时已写入的 prompt 不丢失
+        self.file.flush()
+        self._committed = row + 1
+        self._rows[prompt_id] = row
+
+    # ---------- 读取 ----------
+
+    @property
+    def layers(self) -> List[int]:
+        return json.loads(self.file.attrs["layers"])
+
+    def prompt_ids(self) -> List[int]:
+        return sorted(self._rows)
+
+    def _row(self, prompt_id: int) -> int:
+        if prompt_id not in self._rows:
+            raise KeyError(f"存储中没有 prompt {prompt_id}: {self.path}")
+        return self._rows[prompt_id]
+
+    def meta(self, prompt_id: int) -> Dict[str, Any]:
+        return json.loads(self.file["index/meta"][self._row(prompt_id)])
+
+    def metadata(self) -> pd.DataFrame:
+        """元数据表：每条 prompt 一行（prompt_id, prompt_type, score, token_offset, token_count, ...）"""
+        if "index" not in self.file:
+            return pd.DataFrame(columns=["prompt_id", "prompt_type", "score", "token_offset", "token_count"])
+        index = {column: self.file[f"index/{column}"][:] for column in INDEX_COLUMNS}
+        metas = self.file["index/meta"].asstr()[:]
+        rows = []
+        for prompt_id, row in sorted(self._rows.items()):
+            meta = json.loads(metas[row])
+            rows.append({
+                "prompt_id": prompt_id,
+                "prompt_type": meta["prompt_type"],
+                "score": meta["score"],
+                "token_offset": int(index["token_offset"][row]),
+                "token_count": int(index["token_count"][row]),
+                "generated_text": "".join(meta["generated_texts"]),
+                "prompt": meta["prompt"],
+            })
+        return pd.DataFrame(rows)
+
+    def input_last_hidden(self, prompt_id: int, layer=slice(None)) -> np.ndarray:
+        """prompt 最后一个 token 的 hidden；layer 为存储中的层位置（整数或切片）"""
+        return self.file["input_last_hidden"][self._row(prompt_id), layer, :]
+
+    def output_hidden(self, prompt_id: int, layer=slice(None), token=None) -> np.ndarray:
+        """
+        生成 token 的 hidden；layer 为存储中的层位置，token 为该 prompt 内的 token 序号（整数、切片或 None 表示全部）
+        只读取并解压覆盖所需 (layer, token) 的块
+        """
+        row = self._row(prompt_id)
+        offset = int(self.file["index/token_offset"][row])
+        count = int(self.file["index/token_count"][row])
+        if token is None:
+            tokens = slice(offset, offset + count)
+        elif isinstance(token, slice):
+            start, stop, step = token.indices(count)
+            tokens = slice(offset + start, offset + stop, step)
+        else:
+            if not -count <= token < count:
+                raise IndexError(f"prompt {prompt_id} 只有 {count} 个生成 token")
+            tokens = offset + token % count
+        return self.file["output_hidden"][layer, tokens, :]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> "HiddenStateStore":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ================== 后台写入 ==================
+
+class HiddenStateWriter:
+    """
+    后台线程追加写入 HiddenStateStore，采集循环只需 put()，不等待压缩与落盘；
+    队列有上限，写入跟不上时 put() 阻塞，避免主机内存无限增长。写入线程的异常在下一次 put() / close() 时抛出
+    """
+
+    def __init__(self, path: str, max_pending: int = 16):
+        self.store = HiddenStateStore(path, mode="a")
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self.store.append(*item)
+                print(f"✓ 保存成功: prompt {item[0]:03d} {item[2]} → {self.store.path}")
+            except BaseException as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"写入 {self.store.path} 失败: {self._error}") from self._error
+
+    def prompt_ids(self) -> List[int]:
+        """写入线程启动前已在存储中的 prompt（可用于跳过已完成的样本）"""
+        return self.store.prompt_ids()
+
+    def put(
+        self,
+        prompt_id: int,
+        prompt_text: str,
+        prompt_type: str,
+        collected: Dict[str, Any],
+    ):
+        self._raise_error()
+        self._queue.put((prompt_id, prompt_text, prompt_type, collected))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.store.close()
+        self._raise_error()
+
+    def __enter__(self) -> "HiddenStateWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -8,17 +8,24 @@
 动态生成 Qwen3-8B：
 - prompt 前向：仅保存最后一个 token 的每层 hidden
 - 生成阶段：逐 token 生成，逐层保存 hidden
-- 使用“括号配对”定位第一个完整 JSON
+- hidden 由 forward hook 直接写入预分配缓冲区（可只采集部分层），不再输出全部层的完整序列
+- 使用“括号配对”定位第一个完整 JSON（逐 token 增量检测，不重复解码整段输出）
 - JSON 一闭合立刻停止生成
-- 每条样本落盘前强制自检，失败直接报错
+- 每条样本落盘前强制自检：未解析出评分的样本不保存，同批其他样本照常保存，全部批次结束后汇总报错
+- 按长度分组批量采集：左填充后一次前向、逐步同步解码，每行 JSON 闭合后单独退出
+- 结果逐条保存 .npz；store="hdf5" 时改由后台线程追加写入单个 HDF5 分块存储（见 hidden_store.py）
+- 数字 logit 评分模式：在 prompt 后接上 {"punishment_score":  前缀，一次前向得到 0-9 的概率分布
+  及该位置的 hidden，不做生成
 """
 
 import json
+import time
 import numpy as np
 import torch
 import shutil
+import pandas as pd
 from pathlib import Path
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Optional
 
 from modelscope import snapshot_download
 from transformers import (
@@ -29,6 +36,7 @@ from transformers import (
 )
 
 from batch_csv_to_prompts import BatchCSVProcessor
+from hidden_store import HiddenStateWriter, h5py
 
 
 # ================== 基础配置 ==================
@@ -36,6 +44,16 @@ from batch_csv_to_prompts import BatchCSVProcessor
 MODEL_ID = "Qwen/Qwen3-8B"
 CACHE_DIR = "./modelscope"
 MAX_GENERATE_STEPS = 384   # 防死循环硬上限
+BATCH_SIZE = 8             # 每批同时采集的 prompt 数
+CAPTURE_LAYERS = None      # 采集的层（与 hidden_states[1:] 同序号），None 为全部层
+STORE_NAME = "hidden_states.h5"
+
+# 数字 logit 评分：teacher forcing 的 JSON 前缀，其后下一个 token 即评分数字
+SCORE_PREFIX = {
+    "punishment": '{"punishment_score": ',
+    "emotion": '{"emotional_score": ',
+}
+DIGIT_SCORES_NAME = "digit_scores"
 
 
 # ================== JSON 精确定位 ==================
@@ -87,8 +105,131 @@ def extract_score_from_stream(
     return False, None, None
 
 
+class StreamingJSONDetector:
+    """
+    增量定位第一个完整 JSON 对象：每步只解码新 token 带来的文本，
+    维护括号深度与字符串/转义状态，深度回到 0 时才尝试 json.loads
+    """
+
+    def __init__(self, tokenizer, prompt_type: str):
+        self.tokenizer = tokenizer
+        self.prompt_type = prompt_type
+        self.token_ids: List[int] = []
+        # 已输出文本对应的 token 区间 [prefix_offset, read_offset)，用于多字节字符跨 token 时的增量解码
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.candidate = ""     # 从第一个 "{" 开始的文本
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False       # 第一个 JSON 已闭合（无论能否解析）
+        self.success = False
+        self.score = None
+
+    def _new_text(self) -> str:
+        prefix = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset : self.read_offset], skip_special_tokens=True
+        )
+        text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset :], skip_special_tokens=True
+        )
+        # 多字节字符尚未解码完整时先不输出
+        if len(text) > len(prefix) and not text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return text[len(prefix) :]
+        return ""
+
+    def feed(self, token_id: int) -> bool:
+        """
+        追加一个生成的 token
+        返回: 第一个 JSON 是否已闭合；闭合后 success / score 为解析结果，
+        解析失败或缺少评分字段时之后的生成也不会改变结果
+        """
+        if self.done:
+            return True
+        self.token_ids.append(token_id)
+        chunk = self._new_text()
+
+        begin = chunk.find("{") if not self.candidate else 0
+        if begin == -1:
+            return False
+
+        for i in range(begin, len(chunk)):
+            ch = chunk[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.candidate += chunk[begin : i + 1]
+                    self.done = True
+                    self._parse()
+                    return True
+
+        self.candidate += chunk[begin:]
+        return False
+
+    def _parse(self):
+        try:
+            obj = json.loads(self.candidate)
+        except Exception:
+            return
+        key = "emotional_score" if self.prompt_type == "emotion" else "punishment_score"
+        if isinstance(obj, dict) and key in obj:
+            self.success = True
+            self.score = obj[key]
+
+
+def benchmark_json_detection(tokenizer, steps: int = MAX_GENERATE_STEPS):
+    """
+    JSON 闭合检测的微基准：构造 steps 个 token 内始终不闭合的输出（最坏情况），
+    对比逐步整段解码 + find_first_complete_json 与增量检测的耗时
+    """
+    text = '{"punishment_score": 7, "reason": "' + "被告人的行为造成了严重的社会危害，" * steps
+    token_ids = tokenizer.encode(text, add_special_tokens=False)[:steps]
+
+    start = time.perf_counter()
+    for n in range(1, len(token_ids) + 1):
+        extract_score_from_stream(
+            tokenizer.decode(token_ids[:n], skip_special_tokens=True), "punishment"
+        )
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    detector = StreamingJSONDetector(tokenizer, "punishment")
+    for tid in token_ids:
+        detector.feed(tid)
+    incremental = time.perf_counter() - start
+
+    print(f"\n📊 JSON 闭合检测（{len(token_ids)} 步，不闭合）:")
+    print(f"  整段解码: {full * 1000:.1f} ms（{full / len(token_ids) * 1e6:.0f} µs/步）")
+    print(f"  增量检测: {incremental * 1000:.1f} ms（{incremental / len(token_ids) * 1e6:.0f} µs/步）")
+    print(f"  加速: {full / incremental:.1f}x")
+
+
 # ================== 模型准备 ==================
 
+def load_tokenizer(model_dir: str):
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_dir, trust_remote_code=True
+    )
+    # 批量采集时左填充，使每行 prompt 的最后一个 token 对齐在最后一列
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
 def prepare_model() -> Dict[str, Any]:
     print(">>> 下载 / 同步模型")
     model_dir = snapshot_download(MODEL_ID, cache_dir=CACHE_DIR, revision="master")
@@ -98,9 +239,7 @@ def prepare_model() -> Dict[str, Any]:
     else:
         quant = None
 
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_dir, trust_remote_code=True
-    )
+    tokenizer = load_tokenizer(model_dir)
 
     model = AutoModelForCausalLM.from_pretrained(
         model_dir,
@@ -108,7 +247,6 @@ def prepare_model() -> Dict[str, Any]:
         device_map="auto",
         quantization_config=quant,
         trust_remote_code=True,
-        output_hidden_states=True,
     )
 
     config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
@@ -134,101 +272,347 @@ def build_prompts(csv_paths, column, delay_column):
     return processor.process()
 
 
+def infer_prompt_type(prompt_text: str) -> str:
+    return (
+        "punishment"
+        if "\"punishment_score\"" in prompt_text
+        else "emotion"
+    )
+
+
+def iter_prompt_batches(prompts: List[str], batch_size: int, skip_ids=()):
+    """
+    按长度排序后分批，减少左填充的浪费
+    产出: [(prompt_id, prompt_text, prompt_type), ...]，prompt_id 为原顺序中的编号（从 1 开始）；
+    skip_ids 中的 prompt（已保存）跳过
+    """
+    order = sorted(
+        (i for i in range(len(prompts)) if i + 1 not in skip_ids),
+        key=lambda i: len(prompts[i]),
+    )
+    for start in range(0, len(order), batch_size):
+        yield [
+            (i + 1, prompts[i], infer_prompt_type(prompts[i]))
+            for i in order[start : start + batch_size]
+        ]
+
+
 # ================== 核心采集逻辑 ==================
 
+class HiddenStateCapture:
+    """
+    用 forward hook 采集每行最后一个位置的 hidden
+    - 层序号与 output_hidden_states 的 hidden_states[1:] 一致：
+      0..L-2 为各 decoder 层的输出，L-1 为最终 norm 之后的输出
+    - hook 只把选定层、每行最后一个位置写入预分配的设备端缓冲区，
+      前向结束后由 fetch() 一次拷回主机
+    """
+
+    def __init__(self, model, batch_size: int, layers: Optional[List[int]] = None):
+        decoder = model.get_decoder()
+        num_layers = len(decoder.layers)
+        self.layers = list(range(num_layers)) if layers is None else list(layers)
+        for li in self.layers:
+            if not 0 <= li < num_layers:
+                raise ValueError(f"层序号 {li} 超出范围 0..{num_layers - 1}")
+
+        self.buffer = torch.empty(
+            (batch_size, len(self.layers), model.config.hidden_size),
+            dtype=torch.float16,
+            device=next(model.parameters()).device,
+        )
+        modules = [
+            decoder.layers[li] if li < num_layers - 1 else decoder.norm
+            for li in self.layers
+        ]
+        self.handles = [
+            module.register_forward_hook(self._hook(slot))
+            for slot, module in enumerate(modules)
+        ]
+
+    def _hook(self, slot: int):
+        def hook(module, inputs, output):
+            h = output[0] if isinstance(output, tuple) else output
+            self.buffer[: h.shape[0], slot].copy_(h[:, -1])
+        return hook
+
+    def fetch(self, rows: int) -> np.ndarray:
+        """
+        本次前向采集到的 (rows, layers, hidden)；
+        总是返回副本：模型在 CPU 上时 .cpu() 不拷贝，numpy 数组会与之后被 hook 覆盖的缓冲区共享内存
+        """
+        return self.buffer[:rows].to("cpu", copy=True).numpy()
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+    def __enter__(self) -> "HiddenStateCapture":
+        return self
+
+    def __exit__(self, *exc):
+        self.remove()
+
+
 def collect_hidden_states_dynamic(
     prompt_text: str,
     prompt_type: str,
     tokenizer,
     model,
     config,
+    layers: Optional[List[int]] = None,
 ) -> Dict[str, Any]:
+    collected = collect_hidden_states_batch(
+        [prompt_text], [prompt_type], tokenizer, model, config, layers
+    )[0]
+    if collected is None:
+        raise RuntimeError(f"生成失败：{prompt_type} 在 {MAX_GENERATE_STEPS} 步内未解析出评分")
+    return collected
+
+
+def _select_cache_rows(past, rows: torch.Tensor):
+    """KV cache 只保留 rows 指定的行"""
+    if hasattr(past, "batch_select_indices"):
+        past.batch_select_indices(rows)
+        return past
+    return tuple(tuple(t[rows] for t in layer) for layer in past)
+
+
+def collect_hidden_states_batch(
+    prompt_texts: List[str],
+    prompt_types: List[str],
+    tokenizer,
+    model,
+    config,
+    layers: Optional[List[int]] = None,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    一组 prompt 左填充后一次前向，再逐步同步贪心解码（每行各自的 KV cache 位于同一 batch 中）；
+    某行 JSON 闭合即从 batch 中移除，其余行继续生成。
+    每条 prompt 的返回值与逐条采集相同，未解析出评分的行为 None（不影响同批其他行）；layers 为 None 时采集全部层
+    """
+
+    with HiddenStateCapture(model, len(prompt_texts), layers) as capture:
+        results = _generate_and_capture(prompt_texts, prompt_types, tokenizer, model, capture)
+    for item in results:
+        if item is not None:
+            item["layers"] = capture.layers
+    return results
+
 
+def _prompt_forward(prompt_texts: List[str], tokenizer, model, use_cache: bool = True):
+    """
+    一组 prompt 左填充后一次前向，只计算最后一个位置的 logits（不再生成时 use_cache=False，不保留 KV cache）
+    返回: (模型输出, attention_mask, position_ids)
+    """
     device = next(model.parameters()).device
 
     enc = tokenizer(
-        prompt_text,
+        prompt_texts,
         return_tensors="pt",
+        padding=True,
         add_special_tokens=True,
     ).to(device)
 
-    # ---------- prompt 前向 ----------
+    attention_mask = enc["attention_mask"]
+    # 左填充时每行的位置编号从第一个真实 token 开始计数
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+
     with torch.no_grad():
-        out = model(**enc, output_hidden_states=True)
+        out = model(
+            input_ids=enc["input_ids"],
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=use_cache,
+            logits_to_keep=1,
+        )
+    return out, attention_mask, position_ids
+
+
+def _generate_and_capture(
+    prompt_texts: List[str],
+    prompt_types: List[str],
+    tokenizer,
+    model,
+    capture: HiddenStateCapture,
+) -> List[Optional[Dict[str, Any]]]:
+
+    device = next(model.parameters()).device
+    batch_size = len(prompt_texts)
+
+    # ---------- prompt 前向 ----------
+    out, attention_mask, position_ids = _prompt_forward(prompt_texts, tokenizer, model)
 
     past = out.past_key_values
-    hidden_states = out.hidden_states[1:]
-    num_layers = len(hidden_states)
 
-    # prompt 最后一个 token 的每层 hidden
-    input_last_hidden = np.stack(
-        [h[0, -1].half().cpu().numpy() for h in hidden_states],
-        axis=0,
-    )
+    # 每行 prompt 最后一个 token 的每层 hidden: (batch, layers, hidden)
+    input_last_hidden = capture.fetch(batch_size)
 
     # ---------- 生成阶段 ----------
-    output_hidden_collector = [[] for _ in range(num_layers)]
-    generated_ids: List[int] = []
+    output_hidden_collector: List[List[np.ndarray]] = [[] for _ in range(batch_size)]
+    detectors = [
+        StreamingJSONDetector(tokenizer, prompt_type) for prompt_type in prompt_types
+    ]
+    active = list(range(batch_size))   # batch 中第 row 行对应的 prompt 下标
 
     next_token_id = torch.argmax(out.logits[:, -1, :], dim=-1)
-
-    success = False
-    score_value = None
+    positions = position_ids[:, -1]
 
     for step in range(MAX_GENERATE_STEPS):
+        attention_mask = torch.cat(
+            [attention_mask, attention_mask.new_ones((len(active), 1))], dim=-1
+        )
+        positions = positions + 1
+
         with torch.no_grad():
             out_step = model(
-                input_ids=next_token_id.unsqueeze(0),
+                input_ids=next_token_id.unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=positions.unsqueeze(-1),
                 past_key_values=past,
-                output_hidden_states=True,
             )
 
         next_token_id = torch.argmax(out_step.logits[:, -1, :], dim=-1)
-        tid = int(next_token_id[0].item())
-        generated_ids.append(tid)
+        token_ids = next_token_id.tolist()
 
-        for li, layer_h in enumerate(out_step.hidden_states[1:]):
-            output_hidden_collector[li].append(
-                layer_h[0, 0].half().cpu().numpy()
-            )
+        # 本步所有行、所选层的 hidden 一次拷回主机: (rows, layers, hidden)
+        step_hidden = capture.fetch(len(active))
 
         past = out_step.past_key_values
 
-        text = tokenizer.decode(
-            generated_ids, skip_special_tokens=True
-        )
+        keep = []
+        for row, i in enumerate(active):
+            output_hidden_collector[i].append(step_hidden[row])
 
-        ok, score, _ = extract_score_from_stream(
-            text, prompt_type
-        )
+            # 第一个 JSON 闭合即退出（解析失败的行之后也不会成功，同样提前退出）
+            if not detectors[i].feed(token_ids[row]):
+                keep.append(row)
 
-        if ok:
-            success = True
-            score_value = score
+        if not keep:
             break
 
-    if not success:
-        raise RuntimeError(
-            f"生成失败：{prompt_type} 在 {MAX_GENERATE_STEPS} 步内未解析出评分"
-        )
+        # JSON 已闭合的行退出 batch
+        if len(keep) < len(active):
+            rows = torch.tensor(keep, device=device)
+            past = _select_cache_rows(past, rows)
+            attention_mask = attention_mask[rows]
+            positions = positions[rows]
+            next_token_id = next_token_id[rows]
+            active = [active[row] for row in keep]
+
+    # CPU 上自检：各步的 hidden 必须是独立的副本，而不是同一块被覆盖的缓冲区
+    if device.type == "cpu":
+        for steps in output_hidden_collector:
+            if len(steps) > 1 and (np.shares_memory(steps[0], steps[-1]) or np.array_equal(steps[0], steps[-1])):
+                raise RuntimeError("hidden 采集自检失败：第 0 步与最后一步的 hidden 相同（缓冲区未拷贝）")
+
+    results = []
+    for i, detector in enumerate(detectors):
+        if not detector.success:
+            results.append(None)
+            continue
+        results.append({
+            "input_last_hidden": input_last_hidden[i],
+            # (layers, steps, hidden)
+            "output_hidden": np.stack(output_hidden_collector[i], axis=1),
+            "generated_ids": detector.token_ids,
+            "generated_texts": [
+                tokenizer.decode([tid], skip_special_tokens=False)
+                for tid in detector.token_ids
+            ],
+            "score": detector.score,
+        })
+    return results
+
+
+def benchmark_batch_sizes(
+    prompts: List[str],
+    resources: Dict[str, Any],
+    batch_sizes: List[int],
+    num_prompts: int,
+    layers: Optional[List[int]] = None,
+):
+    """对比不同 batch size 的采集吞吐量、每个解码步的耗时与显存峰值（不保存结果）"""
+    sample = prompts[:num_prompts]
+    print(f"\n📊 批量采集吞吐量（{len(sample)} 条 prompt）:")
+    print(f"  {'batch':>6}{'耗时(s)':>10}{'prompts/s':>12}{'ms/步':>10}{'显存峰值(GB)':>14}")
+    for batch_size in batch_sizes:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        steps = 0
+        start = time.perf_counter()
+        for batch in iter_prompt_batches(sample, batch_size):
+            collected = collect_hidden_states_batch(
+                [prompt_text for _, prompt_text, _ in batch],
+                [prompt_type for _, _, prompt_type in batch],
+                resources["tokenizer"],
+                resources["model"],
+                resources["config"],
+                layers,
+            )
+            steps += max((len(item["generated_ids"]) for item in collected if item is not None), default=0)
+        elapsed = time.perf_counter() - start
+        peak = torch.cuda.max_memory_allocated() / 1024**3 if torch.cuda.is_available() else float("nan")
+        # 全部行都生成失败时没有可计的解码步，ms/步 一栏留空
+        per_step = f"{elapsed / steps * 1000:>10.1f}" if steps else f"{'-':>10}"
+        print(f"  {batch_size:>6}{elapsed:>10.1f}{len(sample) / elapsed:>12.2f}"
+              f"{per_step}{peak:>14.2f}")
+
+
+# ================== 数字 logit 评分 ==================
+
+def digit_token_ids(tokenizer) -> List[int]:
+    """0-9 各自对应的 token id（每个数字必须恰好是一个 token）"""
+    ids = []
+    for digit in range(10):
+        token_ids = tokenizer.encode(str(digit), add_special_tokens=False)
+        if len(token_ids) != 1:
+            raise ValueError(f"分词器把数字 {digit} 编码为 {len(token_ids)} 个 token，无法按数字 logit 评分")
+        ids.append(token_ids[0])
+    return ids
+
+
+def score_digits_batch(
+    prompt_texts: List[str],
+    prompt_types: List[str],
+    tokenizer,
+    model,
+    digit_ids: List[int],
+    layers: Optional[List[int]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    每条 prompt 后接上评分字段的 JSON 前缀（SCORE_PREFIX），一次前向取下一个 token 的分布：
+    - digit_probs: 0-9 上重新归一化的概率 (10,)
+    - digit_mass: 0-9 在整个词表上的概率之和（越低说明模型越倾向输出数字以外的内容）
+    - expected_score / argmax_score: 评分的期望与众数
+    - hidden: 前缀最后一个 token（即预测评分数字的位置）的每层 hidden (layers, hidden)
+    """
+    forced = [
+        prompt_text + SCORE_PREFIX[prompt_type]
+        for prompt_text, prompt_type in zip(prompt_texts, prompt_types)
+    ]
 
-    output_hidden = np.stack(
-        [np.stack(v, axis=0) for v in output_hidden_collector],
-        axis=0,
-    )
+    with HiddenStateCapture(model, len(forced), layers) as capture:
+        out, _, _ = _prompt_forward(forced, tokenizer, model, use_cache=False)
+        hidden = capture.fetch(len(forced))
 
-    generated_texts = [
-        tokenizer.decode([tid], skip_special_tokens=False)
-        for tid in generated_ids
-    ]
+    log_probs = torch.log_softmax(out.logits[:, -1, :].float(), dim=-1)
+    digit_log_probs = log_probs[:, digit_ids]
+    digit_mass = digit_log_probs.exp().sum(dim=-1).cpu().numpy()
+    digit_probs = torch.softmax(digit_log_probs, dim=-1).cpu().numpy()
 
-    return {
-        "input_last_hidden": input_last_hidden,
-        "output_hidden": output_hidden,
-        "generated_ids": generated_ids,
-        "generated_texts": generated_texts,
-        "score": score_value,
-    }
+    results = []
+    for i in range(len(forced)):
+        results.append({
+            "digit_probs": digit_probs[i],
+            "digit_mass": float(digit_mass[i]),
+            "expected_score": float(np.dot(np.arange(10), digit_probs[i])),
+            "argmax_score": int(np.argmax(digit_probs[i])),
+            "hidden": hidden[i],
+            "layers": capture.layers,
+        })
+    return results
 
 
 # ================== 保存 ==================
@@ -250,6 +634,7 @@ def save_npz_atomic(
         "generated_ids": collected["generated_ids"],
         "generated_texts": collected["generated_texts"],
         "score": collected["score"],
+        "layers": collected["layers"],
     }
 
     np.savez_compressed(
@@ -263,6 +648,78 @@ def save_npz_atomic(
     print(f"✓ 保存成功: {out_path}")
 
 
+def save_digit_scores(
+    output_dir: Path,
+    records: List[Dict[str, Any]],
+):
+    """
+    数字 logit 评分结果：
+    - digit_scores.csv: 每条 prompt 一行（期望评分、众数、数字概率质量、p0-p9）
+    - digit_scores.npz: prompt_id (N,)、digit_probs (N, 10)、hidden (N, layers, hidden)、layers
+    """
+    records = sorted(records, key=lambda r: r["prompt_id"])
+
+    table = pd.DataFrame([{
+        "prompt_id": r["prompt_id"],
+        "prompt_type": r["prompt_type"],
+        "expected_score": r["expected_score"],
+        "argmax_score": r["argmax_score"],
+        "digit_mass": r["digit_mass"],
+        **{f"p{d}": float(r["digit_probs"][d]) for d in range(10)},
+    } for r in records])
+    csv_path = output_dir / f"{DIGIT_SCORES_NAME}.csv"
+    table.to_csv(csv_path, index=False, encoding="utf-8")
+
+    npz_path = output_dir / f"{DIGIT_SCORES_NAME}.npz"
+    np.savez(
+        str(npz_path),
+        prompt_id=np.array([r["prompt_id"] for r in records]),
+        digit_probs=np.stack([r["digit_probs"] for r in records]),
+        hidden=np.stack([r["hidden"] for r in records]),
+        layers=np.array(records[0]["layers"] if records else []),
+    )
+    print(f"✓ 保存成功: {csv_path}, {npz_path}")
+
+
+def run_digit_scoring(
+    prompts: List[str],
+    resources: Dict[str, Any],
+    output_dir: Path,
+    batch_size: int,
+    layers: Optional[List[int]] = None,
+):
+    tokenizer = resources["tokenizer"]
+    digit_ids = digit_token_ids(tokenizer)
+
+    records = []
+    start = time.perf_counter()
+    for batch in iter_prompt_batches(prompts, batch_size):
+        scored = score_digits_batch(
+            [prompt_text for _, prompt_text, _ in batch],
+            [prompt_type for _, _, prompt_type in batch],
+            tokenizer,
+            resources["model"],
+            digit_ids,
+            layers,
+        )
+        for (idx, _, prompt_type), item in zip(batch, scored):
+            records.append({"prompt_id": idx, "prompt_type": prompt_type, **item})
+        print(f"[{len(records)}/{len(prompts)}] 已评分")
+    elapsed = time.perf_counter() - start
+
+    save_digit_scores(output_dir, records)
+
+    print(f"\n📊 数字 logit 评分: {len(records)} 条 prompt，耗时 {elapsed:.1f}s "
+          f"（{len(records) / elapsed:.2f} prompts/s）")
+    for prompt_type in SCORE_PREFIX:
+        subset = [r for r in records if r["prompt_type"] == prompt_type]
+        if subset:
+            low_mass = sum(1 for r in subset if r["digit_mass"] < 0.5)
+            print(f"  {prompt_type}: 平均期望评分 {np.mean([r['expected_score'] for r in subset]):.2f} | "
+                  f"平均数字概率质量 {np.mean([r['digit_mass'] for r in subset]):.1%} | "
+                  f"质量低于 50% 的 {low_mass} 条")
+
+
 # ================== main ==================
 
 def main():
@@ -271,9 +728,26 @@ def main():
         column = "案件内容"
         delay_column = "延迟时间"
         output_dir = "../autodl-tmp/results_dynamic_clean"
+        # "generate" 逐 token 生成并采集 hidden；"digits" 只做数字 logit 评分（一次前向，不生成）
+        mode = "generate"
+        # "npz" 逐条保存（RSA notebook 读取此格式）；
+        # "hdf5" 写入 output_dir/STORE_NAME（需要 h5py，已保存的 prompt 自动跳过）
+        store = "npz"
+        batch_size = BATCH_SIZE
+        layers = CAPTURE_LAYERS
+        # 非空时（如 [1, 2, 4, 8, 16]）只对比这些 batch size 的吞吐量（取前 benchmark_prompts 条 prompt），不保存结果
+        benchmark_batch_sizes = []
+        benchmark_prompts = 32
+        # True 时只运行 JSON 闭合检测的微基准（仅加载分词器）
+        benchmark_json = False
 
     args = Args()
 
+    if args.benchmark_json:
+        model_dir = snapshot_download(MODEL_ID, cache_dir=CACHE_DIR, revision="master")
+        benchmark_json_detection(load_tokenizer(model_dir))
+        return
+
     prompts = build_prompts(
         [args.csv],
         args.column,
@@ -290,30 +764,78 @@ def main():
     model = resources["model"]
     config = resources["config"]
 
-    for idx, prompt_text in enumerate(prompts, 1):
-        prompt_type = (
-            "punishment"
-            if "\"punishment_score\"" in prompt_text
-            else "emotion"
+    if args.mode == "digits":
+        run_digit_scoring(
+            prompts,
+            resources,
+            output_dir,
+            args.batch_size,
+            args.layers,
         )
-
-        print(f"\n[{idx}/{len(prompts)}] 处理 {prompt_type}")
-
-        collected = collect_hidden_states_dynamic(
-            prompt_text,
-            prompt_type,
-            tokenizer,
-            model,
-            config,
+        return
+
+    if args.benchmark_batch_sizes:
+        benchmark_batch_sizes(
+            prompts,
+            resources,
+            args.benchmark_batch_sizes,
+            args.benchmark_prompts,
+            args.layers,
         )
+        return
+
+    writer = None
+    skip_ids = set()
+    if args.store == "hdf5" and h5py is None:
+        print("⚠️ 未安装 h5py，改为逐条保存 .npz")
+    elif args.store == "hdf5":
+        writer = HiddenStateWriter(str(output_dir / STORE_NAME))
+        skip_ids = set(writer.prompt_ids())
+        if skip_ids:
+            print(f"↻ 存储中已有 {len(skip_ids)} 条 prompt，跳过")
+
+    total = len(prompts) - len(skip_ids)
+    finished = 0
+    failed = []
+    try:
+        for batch in iter_prompt_batches(prompts, args.batch_size, skip_ids):
+            print(
+                f"\n[{finished + 1}-{finished + len(batch)}/{total}] 处理 "
+                + ", ".join(f"#{idx} {prompt_type}" for idx, _, prompt_type in batch)
+            )
 
-        save_npz_atomic(
-            output_dir,
-            idx,
-            prompt_text,
-            prompt_type,
-            collected,
-        )
+            collected = collect_hidden_states_batch(
+                [prompt_text for _, prompt_text, _ in batch],
+                [prompt_type for _, _, prompt_type in batch],
+                tokenizer,
+                model,
+                config,
+                args.layers,
+            )
+
+            for (idx, prompt_text, prompt_type), item in zip(batch, collected):
+                if item is None:
+                    # 同批其他行照常保存，失败的 prompt 在全部批次结束后汇总报错
+                    print(f"❌ 生成失败: prompt {idx:03d} {prompt_type} 在 {MAX_GENERATE_STEPS} 步内未解析出评分")
+                    failed.append(f"#{idx} {prompt_type}")
+                elif writer is not None:
+                    # 压缩与落盘在后台线程进行，不阻塞下一批生成
+                    writer.put(idx, prompt_text, prompt_type, item)
+                else:
+                    save_npz_atomic(
+                        output_dir,
+                        idx,
+                        prompt_text,
+                        prompt_type,
+                        item,
+                    )
+            finished += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} 条 prompt 生成失败（其余已保存）: {', '.join(failed)}")
 
     print("\n✅ 全部样本生成完成（JSON 精确定位，已干净截断）")
 
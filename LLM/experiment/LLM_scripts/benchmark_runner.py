@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+实验运行器性能基准
+在本地模拟服务（mock_server.py）上以多种配置驱动 SimpleExperiment，
+报告每种配置的吞吐量、客户端观测延迟的 p50/p95/p99 与运行器进程的 CPU 占用；
+结果可保存为基线，之后每次修改 experiment_runner.py 时与基线对比，作为性能回归门槛
+"""
+
+import io
+import os
+import json
+import time
+import tempfile
+import argparse
+import contextlib
+import multiprocessing
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+
+from experiment_runner import CSVCases, SimpleExperiment
+from mock_server import MockConfig, MockLLMServer
+
+
+# ==================== Benchmark Cases ====================
+@dataclass
+class BenchCase:
+    """一种基准配置：模拟服务行为 + 运行器参数"""
+    name: str
+    mock: MockConfig = field(default_factory=MockConfig)
+    concurrency: int = 16
+    batch_samples: bool = False
+    stream: bool = False
+    hedge: bool = False
+    structured: bool = False
+    parse_retries: int = 0
+    max_retries: int = 8
+    schedule: str = "prefix"
+    breaker_cooldown: float = 10.0
+
+
+BENCH_CASES: List[BenchCase] = [
+    BenchCase("serial", MockConfig(latency=0.02), concurrency=1),
+    BenchCase("async-16", MockConfig(latency=0.05, latency_dist="lognormal")),
+    BenchCase("async-64", MockConfig(latency=0.05, latency_dist="lognormal"), concurrency=64),
+    BenchCase("batch-samples", MockConfig(latency=0.05, latency_dist="lognormal"), batch_samples=True),
+    BenchCase("stream", MockConfig(latency=0.02, chunk_delay=0.002, trailing_chunks=50), stream=True),
+    BenchCase("hedge-tail", MockConfig(latency=0.05, tail_rate=0.05, tail_latency=1.0), hedge=True),
+    BenchCase("throttled", MockConfig(latency=0.05, max_concurrency=8, retry_after=0.1), concurrency=32),
+    BenchCase("faulty", MockConfig(latency=0.05, error_rate=0.05, malformed_rate=0.05),
+              structured=True, parse_retries=2),
+    BenchCase("prefix-cache", MockConfig(latency=0.02, prefix_cache=4, prefill_per_token=0.0002)),
+    BenchCase("outage", MockConfig(latency=0.05, outage_after=0.2, outage_duration=1.0),
+              max_retries=2, breaker_cooldown=0.25),
+]
+
+
+# ==================== Mock Server Process ====================
+def _serve(config: MockConfig, port_queue: "multiprocessing.Queue"):
+    server = MockLLMServer(port=0, config=config)
+    port_queue.put(server.httpd.server_address[1])
+    server.httpd.serve_forever()
+
+
+class MockServerProcess:
+    """在子进程中运行模拟服务，使基准测得的 CPU 时间只包含运行器本身"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self._queue: "multiprocessing.Queue" = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, args=(config, self._queue), daemon=True)
+        self.url = ""
+
+    def __enter__(self) -> "MockServerProcess":
+        self._process.start()
+        self.url = f"http://127.0.0.1:{self._queue.get(timeout=10)}/v1"
+        return self
+
+    def __exit__(self, *exc):
+        self._process.terminate()
+        self._process.join()
+
+
+# ==================== Measurement ====================
+def percentile(values: List[float], q: float) -> float:
+    """线性插值分位数（q 取 0~100）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (pos - lower)
+
+
+def write_synthetic_csv(path: str, n_cases: int):
+    """生成基准用的案件表：一半即时、一半延迟条件"""
+    rows = [{
+        "序号": i + 1,
+        "案件内容": f"基准测试案件{i + 1}：被告人于某日实施盗窃，涉案金额{(i + 1) * 1000}元。",
+        "延迟时间": "当日" if i % 2 == 0 else "三个月后",
+        "Category": "基准",
+    } for i in range(n_cases)]
+    pd.DataFrame(rows).to_csv(path, index=False, encoding="utf-8")
+
+
+def run_case(case: BenchCase, cases: CSVCases, samples: int, verbose: bool = False) -> Dict[str, Any]:
+    """运行一种基准配置并返回指标"""
+    with MockServerProcess(case.mock) as server:
+        exp = SimpleExperiment(
+            csv_path=cases.csv_path,
+            model_name=f"bench-{case.name}",
+            samples_per_condition=samples,
+            experiment_id_prefix=f"bench_{case.name}",
+            api_url=server.url,
+            api_key="mock",
+            concurrency=case.concurrency,
+            cases=cases,
+            batch_samples=case.batch_samples,
+            max_retries=case.max_retries,
+            hedge=case.hedge,
+            stream=case.stream,
+            structured=case.structured,
+            parse_retries=case.parse_retries,
+            schedule=case.schedule,
+            breaker_cooldown=case.breaker_cooldown,
+        )
+        sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        with sink:
+            results = exp.run()
+        elapsed = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+
+    latencies = [r.response_time for r in results if not r.cached]
+    calls = len(results)
+    return {
+        "calls": calls,
+        "requests": exp.client.request_count,
+        "elapsed": elapsed,
+        "rps": calls / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "cpu": cpu,
+        "cpu_ms_per_call": cpu / calls * 1000 if calls else 0.0,
+        "failed": sum(1 for r in results if not r.parse_ok),
+        "prefix_hit": exp.client.cached_tokens / exp.client.prompt_tokens if exp.client.prompt_tokens else 0.0,
+    }
+
+
+def print_table(metrics: Dict[str, Dict[str, Any]]):
+    """打印基准结果表"""
+    print(f"\n📊 基准结果:")
+    print(f"  {'配置':<14}{'调用':>6}{'请求':>6}{'次/秒':>9}{'p50(s)':>9}{'p95(s)':>9}"
+          f"{'p99(s)':>9}{'CPU(s)':>8}{'ms/次':>8}{'失败':>6}{'前缀命中':>9}")
+    for name, m in metrics.items():
+        print(f"  {name:<14}{m['calls']:>6}{m['requests']:>6}{m['rps']:>9.1f}{m['p50']:>9.3f}"
+              f"{m['p95']:>9.3f}{m['p99']:>9.3f}{m['cpu']:>8.2f}{m['cpu_ms_per_call']:>8.2f}{m['failed']:>6}"
+              f"{m.get('prefix_hit', 0.0):>9.1%}")
+
+
+# ==================== Regression Gate ====================
+def compare_baseline(metrics: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+                     tolerance: float) -> List[str]:
+    """与基线对比：吞吐量或前缀缓存命中率下降、p95 延迟或单次调用 CPU 上升超过 tolerance 即视为回归"""
+    regressions = []
+    for name, m in metrics.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if m["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: 吞吐量 {m['rps']:.1f} < 基线 {base['rps']:.1f} 次/秒")
+        if m["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {m['p95']:.3f}s > 基线 {base['p95']:.3f}s")
+        if m["cpu_ms_per_call"] > base["cpu_ms_per_call"] * (1 + tolerance):
+            regressions.append(f"{name}: CPU {m['cpu_ms_per_call']:.2f} > 基线 "
+                               f"{base['cpu_ms_per_call']:.2f} ms/次")
+        if m.get("prefix_hit", 0.0) < base.get("prefix_hit", 0.0) * (1 - tolerance):
+            regressions.append(f"{name}: 前缀缓存命中 {m['prefix_hit']:.1%} < 基线 {base['prefix_hit']:.1%}")
+        if m["failed"] > base["failed"]:
+            regressions.append(f"{name}: 失败 {m['failed']} > 基线 {base['failed']}")
+    return regressions
+
+
+# ==================== Main Function ====================
+def main():
+    """主函数 - 支持命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='在本地模拟服务上对实验运行器做性能基准测试',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=f"""
+示例:
+  # 运行全部基准配置，并保存为基线
+  python benchmark_runner.py --output bench_baseline.json
+
+  # 修改 experiment_runner.py 后与基线对比（回归超过 15% 时以非零状态退出）
+  python benchmark_runner.py --baseline bench_baseline.json --tolerance 0.15
+
+  # 只运行部分配置，使用真实案件表
+  python benchmark_runner.py --only async-16 stream --csv ../../data/final_crime_data.csv
+
+可用配置: {', '.join(c.name for c in BENCH_CASES)}
+        """
+    )
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                       help='仅运行指定的基准配置')
+    parser.add_argument('--csv', type=str, default=None,
+                       help='案件表路径（默认: 生成合成案件表）')
+    parser.add_argument('--cases', type=int, default=20,
+                       help='合成案件数（默认: 20）')
+    parser.add_argument('--samples', type=int, default=4,
+                       help='每个条件的样本数（默认: 4）')
+    parser.add_argument('--output', type=str, default=None,
+                       help='把结果保存为 JSON（可作为之后的基线）')
+    parser.add_argument('--baseline', type=str, default=None,
+                       help='基线 JSON 文件；提供时检查性能回归')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                       help='允许的相对回归幅度（默认: 0.15）')
+    parser.add_argument('--verbose', action='store_true',
+                       help='显示运行器的完整输出')
+    args = parser.parse_args()
+
+    selected = [c for c in BENCH_CASES if not args.only or c.name in args.only]
+    if not selected:
+        print(f"❌ 错误: 没有匹配的基准配置: {' '.join(args.only)}")
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = args.csv
+        if csv_path is None:
+            csv_path = os.path.join(tmp, "bench_cases.csv")
+            write_synthetic_csv(csv_path, args.cases)
+        with contextlib.redirect_stdout(io.StringIO()):
+            cases = CSVCases(csv_path)
+
+        metrics: Dict[str, Dict[str, Any]] = {}
+        for case in selected:
+            print(f"🧪 基准: {case.name}")
+            metrics[case.name] = run_case(case, cases, args.samples, args.verbose)
+    print_table(metrics)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "created": datetime.now().isoformat(),
+                "samples": args.samples,
+                "configs": {c.name: asdict(c) for c in selected},
+                "metrics": metrics,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"✓ 已保存: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline: Optional[Dict[str, Any]] = json.load(f)
+        regressions = compare_baseline(metrics, baseline["metrics"], args.tolerance)
+        if regressions:
+            print(f"❌ 性能回归（容差 {args.tolerance:.0%}）:")
+            for line in regressions:
+                print(f"  - {line}")
+            return 1
+        print(f"✓ 未发现超过 {args.tolerance:.0%} 的性能回归")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
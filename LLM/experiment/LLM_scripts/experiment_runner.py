@@ -10,25 +10,990 @@ import json
 import csv
 import time
 import re
+import random
+import asyncio
+import sqlite3
+import hashlib
 import argparse
-from dataclasses import dataclass, asdict
+import functools
+import threading
+from collections import deque
+from itertools import zip_longest
+from dataclasses import dataclass, asdict, fields, replace
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union, get_args, get_origin, get_type_hints
+from urllib.parse import quote
 
 import pandas as pd
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as pads
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# ==================== Response Cache ====================
+class ResponseCache:
+    """
+    基于 SQLite 的内容寻址响应缓存
+
+    键为 hash(model, prompt, temperature, max_tokens, sample_index)，
+    支持按条目数、总字节数与存活时间淘汰（按最近访问时间 LRU），
+    replay 模式以只读方式打开，未命中时不会调用API
+    """
+
+    EVICT_EVERY = 200  # 每写入多少条检查一次淘汰条件
+
+    def __init__(self,
+                 path: str,
+                 max_entries: int = None,
+                 max_bytes: int = None,
+                 max_age_days: float = None,
+                 replay: bool = False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        if replay:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"回放模式需要已有的缓存文件: {path}")
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT,"
+                " response TEXT,"
+                " response_time REAL,"
+                " size INTEGER,"
+                " created_at REAL,"
+                " last_access REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)"
+            )
+            self._conn.commit()
+            self.evict()
+
+    @staticmethod
+    def make_key(model: str, prompt: str, temperature: float,
+                 max_tokens: int, sample_index: int) -> str:
+        payload = json.dumps([model, prompt, temperature, max_tokens, sample_index],
+                             ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        """查询缓存，命中时返回 (响应内容, 原始响应时间)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, response_time FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.replay:
+                self._conn.execute(
+                    "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+            return row[0], row[1]
+
+    def contains(self, key: str) -> bool:
+        """是否已缓存该响应（不计入命中统计，也不更新 last_access）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM responses WHERE key = ?", (key,)
+            ).fetchone() is not None
+
+    def put(self, key: str, model: str, response: str, response_time: float):
+        """写入一条响应"""
+        if self.replay:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, response, response_time, len(response.encode("utf-8")), now, now)
+            )
+            self._conn.commit()
+            self._puts += 1
+        if self._puts % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self):
+        """按存活时间、总条目数与总字节数淘汰最久未访问的条目"""
+        if self.replay:
+            return
+        with self._lock:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,))
+            if self.max_entries is not None:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    " SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            if self.max_bytes is not None:
+                total = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+                if total > self.max_bytes:
+                    freed = 0
+                    stale = []
+                    for key, size in self._conn.execute(
+                            "SELECT key, size FROM responses ORDER BY last_access ASC"):
+                        if total - freed <= self.max_bytes:
+                            break
+                        stale.append((key,))
+                        freed += size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        """命中统计"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        self.evict()
+        self._conn.close()
+
+
+# ==================== Rate Limiting ====================
+def classify_api_error(e: Exception) -> Tuple[bool, Optional[float]]:
+    """
+    判断异常是否值得重试，并解析 Retry-After（秒）
+
+    429、5xx、连接错误与超时视为可重试的拥塞信号；其余（如 400/401）直接失败
+    """
+    if isinstance(e, APIStatusError):
+        retryable = e.status_code == 429 or e.status_code >= 500
+        retry_after = None
+        headers = getattr(e.response, "headers", None) or {}
+        if headers.get("retry-after-ms"):
+            try:
+                retry_after = float(headers["retry-after-ms"]) / 1000
+            except ValueError:
+                pass
+        elif headers.get("retry-after"):
+            try:
+                retry_after = float(headers["retry-after"])
+            except ValueError:
+                try:
+                    retry_after = max(0.0, parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return retryable, retry_after
+    if isinstance(e, APIConnectionError):
+        return True, None
+    return False, None
+
+
+class AdaptiveLimiter:
+    """
+    单个模型服务（base_url + model）的自适应限流器
+
+    令牌桶限制请求速率（rate 为每秒请求数，None 表示不限）；
+    并发窗口按 AIMD 调整：每次成功加 1/窗口（约每轮加 1），
+    遇到 429/5xx 时减半（同一冷却期内只减一次），并在 Retry-After 期间暂停发送。
+    窗口上限为 max_concurrency，运行中逐步探测出可持续的最大并发
+    """
+
+    def __init__(self,
+                 max_concurrency: int,
+                 initial_concurrency: int = None,
+                 rate: float = None,
+                 burst: int = None,
+                 decrease_factor: float = 0.5,
+                 cooldown: float = 1.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.window = float(min(self.max_concurrency, initial_concurrency or 4))
+        self.rate = rate
+        self.burst = burst or max(1, self.max_concurrency)
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.tokens = float(self.burst)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.peak_in_flight = 0
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._changed: Optional[asyncio.Event] = None
+        self._changed_loop = None
+
+    def _event(self) -> asyncio.Event:
+        """等待状态变化的事件（每次 release 后替换为新事件）"""
+        loop = asyncio.get_running_loop()
+        if self._changed is None or self._changed_loop is not loop:
+            self._changed = asyncio.Event()
+            self._changed_loop = loop
+        return self._changed
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _wait_time(self, now: float) -> Optional[float]:
+        """距离可发送下一个请求还需等待的秒数；None 表示需等待在途请求完成"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.window):
+            return None
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0.0
+
+    def has_capacity(self) -> bool:
+        """当前是否可以立即发送（不在暂停期且并发窗口有空位）"""
+        return time.monotonic() >= self.paused_until and self.in_flight < int(self.window)
+
+    async def acquire(self):
+        """等待并发窗口、令牌与暂停期，占用一个在途名额"""
+        while True:
+            wait = self._wait_time(time.monotonic())
+            if wait is not None and wait <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._event().wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if self.rate:
+            self.tokens -= 1
+
+    def release(self, congested: bool = False, status_code: int = None,
+                retry_after: float = None, cancelled: bool = False, neutral: bool = False):
+        """释放在途名额，并根据结果调整并发窗口（被取消或 neutral 的请求不反映拥塞，不调整）"""
+        self.in_flight -= 1
+        now = time.monotonic()
+        if cancelled or neutral:
+            pass
+        elif congested:
+            if status_code == 429:
+                self.throttled += 1
+            elif status_code is not None and status_code >= 500:
+                self.server_errors += 1
+            if now - self._last_decrease >= self.cooldown:
+                self.window = max(1.0, self.window * self.decrease_factor)
+                self._last_decrease = now
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+        else:
+            self.window = min(float(self.max_concurrency), self.window + 1.0 / self.window)
+        self._notify()
+
+    def metrics(self) -> Dict[str, float]:
+        """当前并发窗口与重试统计"""
+        return {
+            "concurrency": int(self.window),
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "server_errors": self.server_errors,
+        }
+
+
+_LIMITERS: Dict[Tuple[str, str, Optional[str]], AdaptiveLimiter] = {}
+
+
+def get_limiter(api_url: str, model_name: str, max_concurrency: int,
+                rate: float = None, api_key: str = None) -> AdaptiveLimiter:
+    """同一 base_url + key + model 共享一个限流器（服务商按 key 计算速率限制）"""
+    key = (api_url, model_name, api_key)
+    if key not in _LIMITERS:
+        _LIMITERS[key] = AdaptiveLimiter(max_concurrency, rate=rate)
+    return _LIMITERS[key]
+
+
+class ClientStopped(Exception):
+    """客户端不再发出新请求（预算用尽或服务持续故障），剩余工作单元留待 --resume 补跑"""
+
+
+class CircuitOpen(ClientStopped):
+    """熔断器多次探测失败，已放弃该服务"""
+
+
+class CircuitBreaker:
+    """
+    单个模型服务（base_url + key + model）的熔断器
+
+    连续 failure_threshold 次请求失败（连接错误、超时或 5xx；429 由限流器处理）后断开，
+    断开期间该服务的请求在 acquire 处等待，工作单元暂停而不发出请求，其他服务照常运行；
+    经过 cooldown 秒后进入半开状态，只放行一个探测请求：成功则闭合，失败则再次断开并把冷却时间加倍（不超过 max_cooldown）。
+    连续 max_probes 次探测失败后放弃该服务，之后的请求抛出 CircuitOpen
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str = "", failure_threshold: int = 5,
+                 cooldown: float = 10.0, max_cooldown: float = 300.0, max_probes: int = 6):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_probes = max_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.failed_probes = 0
+        self.gave_up = False
+        self.current_cooldown = cooldown
+        self.opened_until = 0.0
+        self.probing = False
+        self.trips = 0
+        self.probes = 0
+        self.parked_time = 0.0
+        self._changed: Optional[asyncio.Event] = None
+        self._changed_loop = None
+
+    def _event(self) -> asyncio.Event:
+        """等待状态变化的事件（每次记录结果后替换为新事件）"""
+        loop = asyncio.get_running_loop()
+        if self._changed is None or self._changed_loop is not loop:
+            self._changed = asyncio.Event()
+            self._changed_loop = loop
+        return self._changed
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def ready(self) -> bool:
+        """当前是否可以立即放行请求（闭合、冷却期已过或半开且探测名额空闲）"""
+        if self.gave_up:
+            return False
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() >= self.opened_until
+        return not self.probing
+
+    async def acquire(self) -> bool:
+        """等待熔断器允许发送；返回本次请求是否为半开状态下的探测请求，已放弃该服务时抛出 CircuitOpen"""
+        parked_since = None
+        while True:
+            now = time.monotonic()
+            if self.gave_up:
+                raise CircuitOpen(f"{self.name} 服务持续故障")
+            if self.state == self.CLOSED:
+                probe = False
+                break
+            if self.state == self.OPEN and now >= self.opened_until:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                self.probes += 1
+                probe = True
+                break
+            parked_since = parked_since or now
+            wait = self.opened_until - now if self.state == self.OPEN else None
+            try:
+                await asyncio.wait_for(self._event().wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        if parked_since is not None:
+            self.parked_time += time.monotonic() - parked_since
+        return probe
+
+    def _trip(self):
+        self.state = self.OPEN
+        self.opened_until = time.monotonic() + self.current_cooldown
+        self.trips += 1
+        print(f"⚠️ {self.name} 连续失败 {self.failures} 次，熔断 {self.current_cooldown:.1f}s"
+              f"（该服务的工作单元暂停，其他服务照常运行）")
+
+    def record(self, ok: Optional[bool], probe: bool = False):
+        """
+        记录一次请求的结果：True 成功，False 服务故障，None 与服务健康无关（429、4xx 或被取消），
+        只释放探测名额
+        """
+        if probe:
+            self.probing = False
+        if ok:
+            if self.state != self.CLOSED:
+                print(f"✓ {self.name} 探测成功，熔断恢复")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.failed_probes = 0
+            self.current_cooldown = self.cooldown
+        elif ok is False:
+            self.failures += 1
+            if probe:
+                self.failed_probes += 1
+                if self.failed_probes >= self.max_probes:
+                    self.gave_up = True
+                    print(f"❌ {self.name} 连续 {self.failed_probes} 次探测失败，放弃该服务（剩余工作单元可 --resume 补跑）")
+                else:
+                    self.current_cooldown = min(self.max_cooldown, self.current_cooldown * 2)
+                    self._trip()
+            elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self._trip()
+        self._notify()
+
+    def metrics(self) -> Dict[str, float]:
+        """熔断次数、探测次数与累计暂停时间"""
+        return {
+            "state": "gave_up" if self.gave_up else self.state,
+            "trips": self.trips,
+            "probes": self.probes,
+            "parked_time": self.parked_time,
+        }
+
+
+_BREAKERS: Dict[Tuple[str, str, Optional[str]], CircuitBreaker] = {}
+
+
+def get_breaker(api_url: str, model_name: str, failure_threshold: int = 5,
+                cooldown: float = 10.0, max_cooldown: float = 300.0, api_key: str = None) -> CircuitBreaker:
+    """同一 base_url + key + model 共享一个熔断器（与限流器的划分一致）"""
+    key = (api_url, model_name, api_key)
+    if key not in _BREAKERS:
+        _BREAKERS[key] = CircuitBreaker(model_name, failure_threshold, cooldown, max_cooldown)
+    return _BREAKERS[key]
+
+
+def reset_service_state():
+    """
+    清空进程内共享的限流器与熔断器；每次运行开始时调用，
+    避免同一进程中上一次运行收窄的并发窗口或已放弃的熔断器带入下一次运行
+    """
+    _LIMITERS.clear()
+    _BREAKERS.clear()
+
+
+def print_limiter_stats(client: "AsyncLLMClient"):
+    """打印限流器与熔断器指标；端点池按端点逐个打印，并给出各端点的请求占比、平滑延迟与故障率"""
+    pooled = len(client.endpoints) > 1
+    total = sum(ep.requests for ep in client.endpoints)
+    for i, ep in enumerate(client.endpoints):
+        label = f"{client.model_name} #{i} {ep.endpoint.api_url}" if pooled else client.model_name
+        m = ep.limiter.metrics()
+        print(f"✓ {label} 限流: 当前并发窗口 {m['concurrency']}/{m['max_concurrency']} | "
+              f"峰值在途 {m['peak_in_flight']} | 重试 {m['retries']} | "
+              f"429 {m['throttled']} | 5xx {m['server_errors']}")
+        if pooled:
+            latency = f"{ep.latency:.3f}s" if ep.latency is not None else "-"
+            print(f"✓ {label} 端点: 请求 {ep.requests} ({ep.requests / total if total else 0:.1%}) | "
+                  f"权重 {ep.endpoint.weight:g} | 平滑延迟 {latency} | 故障率 {ep.error_rate:.1%}")
+        b = ep.breaker.metrics()
+        if b["trips"]:
+            print(f"✓ {label} 熔断: 断开 {b['trips']} 次 | 探测 {b['probes']} 次 | "
+                  f"暂停 {b['parked_time']:.1f}s | 当前 {b['state']}")
+    if client.hedge:
+        print(f"✓ {client.model_name} 对冲: 触发 {client.hedge_count}/{client.primary_count} 次 | "
+              f"对冲胜出 {client.hedge_wins} 次")
+    if client.cached_tokens:
+        print(f"✓ {client.model_name} 前缀缓存: 提示词 {client.prompt_tokens} tokens | "
+              f"命中 {client.cached_tokens} tokens ({client.cached_tokens / client.prompt_tokens:.1%})")
+
+
+# ==================== Budget ====================
+class TokenEstimator:
+    """
+    token 用量估计
+
+    提示词 token 数在已安装 tiktoken 时按 o200k_base 编码计数，否则按 chars_per_token 字符/token 估计；
+    各模型的分词器不同，收到接口返回的实际用量后按 实际/估计 的累计比值校准。
+    每个样本的生成 token 数在没有实际用量前取 completion_tokens，之后取实际均值
+    """
+
+    DEFAULT_CHARS_PER_TOKEN = 1.5     # 以中文为主的提示词约 1.5 字符/token
+    DEFAULT_COMPLETION_TOKENS = 300   # JSON 格式的评分与理由约 300 token
+
+    def __init__(self, chars_per_token: float = None, completion_tokens: int = None):
+        self.chars_per_token = chars_per_token or self.DEFAULT_CHARS_PER_TOKEN
+        self.default_completion = completion_tokens or self.DEFAULT_COMPLETION_TOKENS
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                # 离线节点上无法下载编码表时退回字符比例
+                self.encoding = None
+        self.estimated_prompt = 0
+        self.actual_prompt = 0
+        self.completion_total = 0
+        self.completion_samples = 0
+        self._raw: Dict[str, int] = {}
+
+    def raw_tokens(self, text: str) -> int:
+        """未经校准的 token 数（同一提示词只计算一次）"""
+        count = self._raw.get(text)
+        if count is None:
+            if self.encoding is not None:
+                count = len(self.encoding.encode(text))
+            else:
+                count = max(1, round(len(text) / self.chars_per_token))
+            self._raw[text] = count
+        return count
+
+    @property
+    def ratio(self) -> float:
+        """校准系数 实际/估计（尚无实际用量时为 1）"""
+        return self.actual_prompt / self.estimated_prompt if self.estimated_prompt else 1.0
+
+    def prompt_tokens(self, prompt: str) -> int:
+        """校准后的提示词 token 数"""
+        return max(1, round(self.raw_tokens(prompt) * self.ratio))
+
+    def completion_tokens(self) -> float:
+        """每个样本的生成 token 数"""
+        if self.completion_samples:
+            return self.completion_total / self.completion_samples
+        return self.default_completion
+
+    def observe(self, prompt: str, prompt_tokens: Optional[int], completion_tokens: Optional[int], n: int = 1):
+        """以一次请求（n 个样本）的实际用量校准"""
+        if prompt_tokens:
+            self.estimated_prompt += self.raw_tokens(prompt)
+            self.actual_prompt += prompt_tokens
+        if completion_tokens:
+            self.completion_total += completion_tokens
+            self.completion_samples += n
+
+
+@dataclass
+class ModelBudget:
+    """
+    单个模型的预算：token_budget 为提示词与生成 token 的总量上限，cost_budget 为费用上限（None 表示不限）；
+    价格为每百万 token 的单价，货币单位与 cost_budget 一致，cached_price 为命中前缀缓存的提示词单价（None 时同 input_price）
+    """
+    token_budget: Optional[int] = None
+    cost_budget: Optional[float] = None
+    input_price: float = 0.0
+    output_price: float = 0.0
+    cached_price: Optional[float] = None
+
+    def cost(self, prompt_tokens: float, completion_tokens: float, cached_tokens: float = 0) -> float:
+        """按单价计算费用"""
+        cached_price = self.input_price if self.cached_price is None else self.cached_price
+        return ((prompt_tokens - cached_tokens) * self.input_price + cached_tokens * cached_price
+                + completion_tokens * self.output_price) / 1e6
+
+
+class BudgetExhausted(ClientStopped):
+    """模型预算已用尽，不再发出新请求"""
+
+
+class BudgetGovernor:
+    """
+    单个模型的预算管理器
+
+    每次请求发出前按估计用量预留额度，返回后按实际用量结算（接口未返回用量时按估计值计）。
+    已用 + 在途预留 + 本次估计超出上限时先等待在途请求结算，越接近上限可同时在途的请求越少；
+    没有在途请求仍超出上限时判定预算用尽并抛出 BudgetExhausted，之后不再发出请求，
+    未执行的工作单元不写入结果日志，调整预算后可 --resume 继续（恢复时已完成结果的用量一并计入预算）
+    """
+
+    def __init__(self, budget: ModelBudget, estimator: TokenEstimator = None, name: str = ""):
+        self.budget = budget
+        self.estimator = estimator or TokenEstimator()
+        self.name = name
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.reserved_tokens = 0.0
+        self.reserved_cost = 0.0
+        self.in_flight = 0
+        self.waits = 0
+        self.exhausted = False
+        self._changed: Optional[asyncio.Event] = None
+        self._changed_loop = None
+
+    def _event(self) -> asyncio.Event:
+        """等待在途请求结算的事件（每次结算后替换为新事件）"""
+        loop = asyncio.get_running_loop()
+        if self._changed is None or self._changed_loop is not loop:
+            self._changed = asyncio.Event()
+            self._changed_loop = loop
+        return self._changed
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    @property
+    def tokens_used(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def cost_used(self) -> float:
+        return self.budget.cost(self.prompt_tokens, self.completion_tokens, self.cached_tokens)
+
+    def estimate(self, prompt: str, n: int = 1) -> Tuple[float, float]:
+        """一次请求（n 个样本）的估计 token 数与费用"""
+        prompt_tokens = self.estimator.prompt_tokens(prompt)
+        completion_tokens = self.estimator.completion_tokens() * n
+        return prompt_tokens + completion_tokens, self.budget.cost(prompt_tokens, completion_tokens)
+
+    def _fits(self, tokens: float, cost: float) -> bool:
+        if self.budget.token_budget is not None and \
+                self.tokens_used + self.reserved_tokens + tokens > self.budget.token_budget:
+            return False
+        if self.budget.cost_budget is not None and \
+                self.cost_used + self.reserved_cost + cost > self.budget.cost_budget:
+            return False
+        return True
+
+    async def reserve(self, prompt: str, n: int = 1) -> Tuple[float, float]:
+        """预留一次请求的额度；需等待在途请求结算时阻塞，预算用尽时抛出 BudgetExhausted"""
+        tokens, cost = self.estimate(prompt, n)
+        while not self.exhausted and not self._fits(tokens, cost):
+            if not self.in_flight:
+                self.exhausted = True
+                print(f"⚠️ {self.name} 预算已用尽: 已用 {self.tokens_used} tokens，"
+                      f"费用 {self.cost_used:.4f}，不再发出新请求")
+                break
+            self.waits += 1
+            await self._event().wait()
+        if self.exhausted:
+            raise BudgetExhausted(f"{self.name} 预算已用尽")
+        self.in_flight += 1
+        self.reserved_tokens += tokens
+        self.reserved_cost += cost
+        return tokens, cost
+
+    def settle(self, prompt: str, reservation: Tuple[float, float], reply: "ChatReply" = None,
+               n: int = 1, cancelled: bool = False):
+        """
+        结算一次请求：reply 为成功的响应；失败的请求不计费，
+        被取消的请求（如对冲中落败的一方）服务端通常已在生成，按估计值计
+        """
+        tokens, cost = reservation
+        self.in_flight -= 1
+        self.reserved_tokens -= tokens
+        self.reserved_cost -= cost
+        if reply is not None:
+            self.estimator.observe(prompt, reply.prompt_tokens, reply.completion_tokens, n)
+            self.prompt_tokens += reply.prompt_tokens or self.estimator.prompt_tokens(prompt)
+            self.completion_tokens += reply.completion_tokens or round(self.estimator.completion_tokens() * n)
+            self.cached_tokens += reply.cached_tokens or 0
+        elif cancelled:
+            prompt_tokens = self.estimator.prompt_tokens(prompt)
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += max(0, round(tokens) - prompt_tokens)
+        self._notify()
+
+    def metrics(self) -> Dict[str, float]:
+        """已用额度与等待统计"""
+        return {
+            "tokens": self.tokens_used,
+            "token_budget": self.budget.token_budget,
+            "cost": self.cost_used,
+            "cost_budget": self.budget.cost_budget,
+            "waits": self.waits,
+            "exhausted": self.exhausted,
+        }
+
+
+def client_stopped(client: "AsyncLLMClient") -> bool:
+    """客户端是否已停止发出新请求（预算用尽或放弃了全部持续故障的端点）"""
+    return all(ep.breaker.gave_up for ep in client.endpoints) or \
+        (client.budget is not None and client.budget.exhausted)
+
+
+def print_budget_stats(client: "AsyncLLMClient"):
+    """打印预算使用情况"""
+    if client.budget is None:
+        return
+    m = client.budget.metrics()
+    tokens = f"{m['tokens']}" + (f"/{m['token_budget']}" if m['token_budget'] is not None else "")
+    cost = f"{m['cost']:.4f}" + (f"/{m['cost_budget']}" if m['cost_budget'] is not None else "")
+    state = "已用尽" if m["exhausted"] else "未用尽"
+    print(f"✓ {client.model_name} 预算: tokens {tokens} | 费用 {cost} | "
+          f"接近上限等待 {m['waits']} 次 | {state}")
+
+
+DEFAULT_EST_LATENCY = 10.0   # 没有历史记录时假设的单次请求耗时（秒）
+
+
+def account_resumed(governor: BudgetGovernor, exp: "SimpleExperiment"):
+    """把实验中已恢复结果记录的实际 token 用量计入预算（预算对整个实验累计），并以之校准估计器"""
+    for item in exp._items:
+        done = exp._slots[item.index]
+        if done is not None and not done.cached:
+            governor.estimator.observe(item.prompt, done.prompt_tokens, done.completion_tokens)
+            governor.prompt_tokens += done.prompt_tokens or 0
+            governor.completion_tokens += done.completion_tokens or 0
+            governor.cached_tokens += done.cached_tokens or 0
+
+
+def estimate_run(experiments: List["SimpleExperiment"], latency: float = None) -> pd.DataFrame:
+    """
+    预估各实验中尚未完成的工作单元所需的请求数、token 用量、费用与墙钟时间（不发出请求），按模型汇总
+
+    token 按各客户端预算管理器的估计器计算（未配置预算时使用以已恢复结果校准的默认估计器），缓存已命中的样本不计，
+    used_tokens / used_cost 为已恢复结果的实际用量；
+    墙钟时间 = 请求轮数（请求数 / 并发数）× 单次请求耗时，耗时取 latency、已恢复结果的平均值或 DEFAULT_EST_LATENCY
+    """
+    rows: Dict[int, Dict[str, Any]] = {}
+    governors: Dict[int, BudgetGovernor] = {}
+    latencies: Dict[int, List[float]] = {}
+    for exp in experiments:
+        client = exp.client
+        key = id(client)
+        if key not in rows:
+            governors[key] = client.budget or BudgetGovernor(ModelBudget(), name=client.model_name)
+            latencies[key] = []
+            rows[key] = {"model": client.model_name, "concurrency": client.max_concurrency,
+                         "calls": 0, "cache_hits": 0, "requests": 0,
+                         "prompt_tokens": 0.0, "completion_tokens": 0.0}
+        if client.budget is None:
+            account_resumed(governors[key], exp)
+        latencies[key].extend(r.latency for r in exp._slots if r is not None and r.latency)
+
+    for exp in experiments:
+        client = exp.client
+        row, estimator = rows[id(client)], governors[id(client)].estimator
+        pending = [item for item in exp._items if exp._slots[item.index] is None]
+        for unit in group_work_items(pending, exp.batch_samples):
+            missing = [item for item in unit if not client._cache_contains(item.prompt, item.sample_idx)]
+            row["calls"] += len(unit)
+            row["cache_hits"] += len(unit) - len(missing)
+            if not missing:
+                continue
+            requests = 1 if len(missing) > 1 and client.supports_n is not False else len(missing)
+            row["requests"] += requests
+            row["prompt_tokens"] += estimator.prompt_tokens(unit[0].prompt) * requests
+            row["completion_tokens"] += estimator.completion_tokens() * len(missing)
+
+    table = []
+    for key, row in rows.items():
+        budget = governors[key].budget
+        observed = latencies[key]
+        per_request = latency or (sum(observed) / len(observed) if observed else DEFAULT_EST_LATENCY)
+        rounds = -(-row["requests"] // row["concurrency"])
+        table.append({
+            **row,
+            "prompt_tokens": round(row["prompt_tokens"]),
+            "completion_tokens": round(row["completion_tokens"]),
+            "tokens": round(row["prompt_tokens"] + row["completion_tokens"]),
+            "cost": budget.cost(row["prompt_tokens"], row["completion_tokens"]),
+            "latency": per_request,
+            "wall_time": rounds * per_request,
+            "used_tokens": governors[key].tokens_used,
+            "used_cost": governors[key].cost_used,
+            "token_budget": budget.token_budget,
+            "cost_budget": budget.cost_budget,
+            "chars_per_token": governors[key].estimator.chars_per_token,
+            "tokenizer": "tiktoken" if governors[key].estimator.encoding is not None else "chars",
+            "ratio": governors[key].estimator.ratio,
+            "completion_per_sample": governors[key].estimator.completion_tokens(),
+        })
+    return pd.DataFrame(table)
+
+
+def format_duration(seconds: float) -> str:
+    """把秒数格式化为 1h02m / 3m05s / 12.3s"""
+    if seconds >= 3600:
+        return f"{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m"
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+    return f"{seconds:.1f}s"
+
+
+def print_estimate(table: pd.DataFrame, adaptive: bool = False):
+    """打印预估结果；各模型服务并行运行，总墙钟时间取最长者"""
+    print(f"\n📊 预估（不发出请求）{'，自适应采样按样本上限计' if adaptive else ''}:")
+    if table.empty:
+        print("  没有需要执行的调用")
+        return
+    print(f"  {'模型':<22}{'调用':>8}{'缓存命中':>8}{'请求':>8}{'提示词tokens':>14}"
+          f"{'生成tokens':>12}{'费用':>10}{'单次耗时':>9}{'墙钟时间':>10}")
+    for row in table.itertuples():
+        print(f"  {row.model:<22}{row.calls:>8}{row.cache_hits:>8}{row.requests:>8}{row.prompt_tokens:>14}"
+              f"{row.completion_tokens:>12}{row.cost:>10.4f}{row.latency:>8.1f}s{format_duration(row.wall_time):>10}")
+    print(f"  {'合计':<22}{table['calls'].sum():>8}{table['cache_hits'].sum():>8}{table['requests'].sum():>8}"
+          f"{table['prompt_tokens'].sum():>14}{table['completion_tokens'].sum():>12}{table['cost'].sum():>10.4f}"
+          f"{'':>9}{format_duration(table['wall_time'].max()):>10}")
+    for row in table.itertuples():
+        method = "tiktoken o200k_base" if row.tokenizer == "tiktoken" else f"{row.chars_per_token} 字符/token"
+        print(f"  {row.model}: 提示词按 {method} 估计（校准系数 {row.ratio:.2f}），"
+              f"每样本生成约 {row.completion_per_sample:.0f} tokens")
+        if row.used_tokens:
+            print(f"  {row.model}: 已恢复结果用量 {row.used_tokens} tokens，费用 {row.used_cost:.4f}")
+        tokens, cost = row.used_tokens + row.tokens, row.used_cost + row.cost
+        if row.token_budget is not None and not pd.isna(row.token_budget) and tokens > row.token_budget:
+            print(f"⚠️ {row.model} 预计累计 {tokens} tokens，超出预算 {int(row.token_budget)}，用尽后将暂停")
+        if row.cost_budget is not None and not pd.isna(row.cost_budget) and cost > row.cost_budget:
+            print(f"⚠️ {row.model} 预计累计费用 {cost:.4f}，超出预算 {row.cost_budget}，用尽后将暂停")
 
 
 # ==================== LLM Client ====================
+@dataclass
+class Completion:
+    """
+    一次模型调用的结果；cached 为 True 时 response_time 为首次调用实测的耗时
+    hedge 为 "" 表示未触发对冲请求，否则记录胜出的一方（"primary" / "hedge"）
+    ttft / time_to_json 仅在流式模式下记录：首个 token 与首个完整 JSON 对象的到达时间（秒）
+    response_time 为调用的总耗时（含排队、重试与退避），latency 为最终成功的那次请求本身的耗时，
+    api_retries 为该次调用因 429/5xx/连接错误重试的次数
+    token 用量取自接口返回的 usage，未返回时为 None；n>1 时提示词与缓存 token 只计在第一个样本上、
+    生成 token 在各样本间平均分摊，按结果求和即为实际用量
+    """
+    text: str
+    response_time: float
+    cached: bool = False
+    error: bool = False
+    hedge: str = ""
+    ttft: Optional[float] = None
+    time_to_json: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    latency: Optional[float] = None
+    api_retries: int = 0
+
+
+@dataclass
+class ChatReply:
+    """
+    一次 chat.completions 请求返回的全部候选文本（按 choice.index 排序）、计时、重试次数与 token 用量；
+    indices 为各候选的 choice.index（None 表示依次为 0..len(texts)-1）
+    """
+    texts: List[str]
+    indices: Optional[List[int]] = None
+    ttft: Optional[float] = None
+    time_to_json: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    latency: Optional[float] = None
+    api_retries: int = 0
+
+    def sample_fields(self, i: int) -> Dict[str, Any]:
+        """第 i 个候选的 Completion 遥测字段（token 用量的分摊方式见 Completion）"""
+        n = max(1, len(self.texts))
+        completion_tokens = None
+        if self.completion_tokens is not None:
+            completion_tokens = self.completion_tokens // n + (self.completion_tokens % n if i == 0 else 0)
+        return {
+            "ttft": self.ttft,
+            "time_to_json": self.time_to_json,
+            "prompt_tokens": self.prompt_tokens if i == 0 or self.prompt_tokens is None else 0,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": self.cached_tokens if i == 0 or self.cached_tokens is None else 0,
+            "latency": self.latency,
+            "api_retries": self.api_retries,
+        }
+
+
+def usage_tokens(usage: Any) -> Tuple[Optional[int], Optional[int], Optional[int]]:
+    """
+    从 usage 中读取 (prompt_tokens, completion_tokens, cached_tokens)；命中前缀缓存的 token 数
+    在 OpenAI 兼容接口中为 prompt_tokens_details.cached_tokens，DeepSeek 为 prompt_cache_hit_tokens
+    """
+    if usage is None:
+        return None, None, None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None), cached
+
+
+class JSONObjectDetector:
+    """
+    增量检测流式文本中的第一个完整 JSON 对象
+
+    逐字符维护花括号深度，并识别字符串与转义字符，字符串中的括号不计数；
+    对象闭合后 done 为 True，text 为截至对象末尾的文本
+    """
+
+    def __init__(self):
+        self._parts: List[str] = []
+        self._length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.end: Optional[int] = None
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None
+
+    @property
+    def text(self) -> str:
+        full = "".join(self._parts)
+        return full[:self.end] if self.end is not None else full
+
+    def feed(self, chunk: str) -> bool:
+        """追加一段文本，返回第一个 JSON 对象是否已闭合"""
+        if self.end is not None or not chunk:
+            return self.end is not None
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self._length + i + 1
+                    break
+        self._parts.append(chunk)
+        self._length += len(chunk)
+        return self.end is not None
+
+
 class LLMClient:
     """LLM API客户端封装"""
     
-    def __init__(self, model_name: str, api_url: str = None, api_key: str = None):
+    def __init__(self, model_name: str, api_url: str = None, api_key: str = None,
+                 temperature: float = 0.7,
+                 max_tokens: int = 1000,
+                 cache: ResponseCache = None):
         if not model_name:
             raise ValueError("model_name 必须提供")
         self.model_name = model_name
         self.api_url = api_url or os.getenv("LLM_API_URL", "your_default_api_url_here")
         self.api_key = api_key or os.getenv("LLM_API_KEY", "your_default_api_key_here")
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.cache = cache
+        self.request_count = 0
         
         if not self.api_key:
             raise ValueError("API密钥未提供，请设置环境变量 LLM_API_KEY 或通过参数传入")
@@ -38,24 +1003,566 @@ class LLMClient:
             base_url=self.api_url
         )
 
-    def generate_response(self, prompt: str) -> Tuple[str, float]:
-        """生成响应并返回内容和响应时间"""
+    def _cache_key(self, prompt: str, sample_index: int) -> str:
+        return ResponseCache.make_key(self.model_name, prompt, self.temperature,
+                                      self.max_tokens, sample_index)
+
+    def _cache_lookup(self, prompt: str, sample_index: int) -> Optional[Completion]:
+        """查询缓存；回放模式下未命中返回错误结果而不调用API"""
+        if self.cache is None:
+            return None
+        hit = self.cache.get(self._cache_key(prompt, sample_index))
+        if hit is not None:
+            return Completion(text=hit[0], response_time=hit[1], cached=True)
+        if self.cache.replay:
+            return Completion(text="API调用出错: 回放模式下缓存未命中", response_time=0.0, error=True)
+        return None
+
+    def _cache_contains(self, prompt: str, sample_index: int) -> bool:
+        """缓存中是否已有该样本的响应（用于预估，不影响缓存统计与淘汰顺序）"""
+        return self.cache is not None and self.cache.contains(self._cache_key(prompt, sample_index))
+
+    def _cache_store(self, prompt: str, sample_index: int, completion: Completion):
+        if self.cache is not None and not completion.error:
+            self.cache.put(self._cache_key(prompt, sample_index), self.model_name,
+                           completion.text, completion.response_time)
+
+    def complete(self, prompt: str, sample_index: int = 0) -> Completion:
+        """生成响应（优先读取缓存）"""
+        cached = self._cache_lookup(prompt, sample_index)
+        if cached is not None:
+            return cached
+
         start_time = time.time()
         
         try:
+            self.request_count += 1
             response = self.client.chat.completions.create(
                 model=self.model_name,
                 messages=[{"role": "user", "content": prompt}],
-                temperature=0.7,
-                max_tokens=1000
+                temperature=self.temperature,
+                max_tokens=self.max_tokens
             )
             result = response.choices[0].message.content
-            response_time = time.time() - start_time
-            return result, response_time
+            completion = Completion(text=result, response_time=time.time() - start_time)
                 
         except Exception as e:
             error_msg = f"API调用出错: {str(e)}"
-            return error_msg, time.time() - start_time
+            return Completion(text=error_msg, response_time=time.time() - start_time, error=True)
+
+        self._cache_store(prompt, sample_index, completion)
+        return completion
+
+    def generate_response(self, prompt: str, sample_index: int = 0) -> Tuple[str, float]:
+        """生成响应并返回内容和响应时间"""
+        completion = self.complete(prompt, sample_index)
+        return completion.text, completion.response_time
+
+
+@dataclass
+class Endpoint:
+    """
+    提供同一逻辑模型的一个服务端点（base_url + key），weight 为负载均衡的相对权重，
+    concurrency 为该端点的并发窗口上限（None 时取客户端的 max_concurrency）；
+    api_key 为 None 时使用客户端的 api_key（默认从环境变量 LLM_API_KEY 读取）
+    """
+    api_url: str
+    api_key: Optional[str] = None
+    weight: float = 1.0
+    concurrency: Optional[int] = None
+
+
+def parse_endpoint(value: str) -> Endpoint:
+    """解析 URL[,KEY[,WEIGHT]] 形式的端点参数，KEY 可写成 env:变量名 从环境变量读取"""
+    parts = [p.strip() for p in value.split(",")]
+    if not parts[0] or len(parts) > 3:
+        raise ValueError(f"端点格式应为 URL[,KEY[,WEIGHT]]: {value}")
+    api_key = parts[1] if len(parts) > 1 and parts[1] else None
+    if api_key and api_key.startswith("env:"):
+        api_key = os.getenv(api_key[4:])
+    try:
+        weight = float(parts[2]) if len(parts) > 2 else 1.0
+    except ValueError:
+        raise ValueError(f"端点权重应为数字: {value}")
+    return Endpoint(parts[0], api_key, weight)
+
+
+class EndpointState:
+    """
+    端点池中一个端点的运行状态：连接池、限流器、熔断器，
+    以及按指数滑动平均观测到的请求延迟与故障率（用于负载均衡）
+    """
+
+    SMOOTHING = 0.2
+
+    def __init__(self, endpoint: Endpoint, async_client: AsyncOpenAI,
+                 limiter: AdaptiveLimiter, breaker: CircuitBreaker):
+        self.endpoint = endpoint
+        self.async_client = async_client
+        self.limiter = limiter
+        self.breaker = breaker
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def observe(self, ok: bool, latency: float = None):
+        """记录一次请求的结果（服务故障或成功）与成功请求的耗时"""
+        self.error_rate += self.SMOOTHING * ((0.0 if ok else 1.0) - self.error_rate)
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                self.latency + self.SMOOTHING * (latency - self.latency)
+
+    def score(self, default_latency: float) -> float:
+        """负载均衡权重：权重 × 成功率 / 平滑延迟（尚无观测时取 default_latency）"""
+        latency = self.latency if self.latency is not None else default_latency
+        return self.endpoint.weight * max(0.05, 1.0 - self.error_rate) / max(1e-3, latency)
+
+
+class AsyncLLMClient(LLMClient):
+    """
+    基于 AsyncOpenAI 的异步客户端，max_concurrency 为同时在途的最大请求数
+
+    supports_n 记录接口是否支持一次请求返回多个候选（n 参数）：
+    None 表示尚未探测，接口拒绝 n>1 的请求时置为 False，之后改为逐条请求；
+    返回的候选不足时只把缺少的样本改为逐条请求，不据此判定为不支持。
+
+    在途请求数与请求速率由同一 base_url + key + model 共享的 AdaptiveLimiter 控制，
+    429/5xx/连接错误按带抖动的指数退避重试（优先遵循 Retry-After），最多 max_retries 次
+
+    hedge=True 时启用对冲请求：请求超过近期响应时间的 hedge_quantile 分位数仍未返回，
+    则再发一份相同请求，取先完成者并取消另一个；对冲请求数不超过主请求数的 hedge_budget 比例
+
+    stream=True 时以 SSE 流式接收，每个候选的第一个 JSON 对象闭合后即关闭连接，
+    不再等待模型生成剩余 token；请求附带 stream_options.include_usage 以取得 token 用量，
+    服务端拒绝该参数时 supports_stream_usage 置为 False，之后不再发送
+
+    structured=True 时随请求发送 response_format（RESPONSE_FORMAT），由服务端约束输出格式；
+    接口以 400/422 拒绝且错误信息提到 response_format / json_schema，或去掉该参数重试后成功时，
+    supports_schema 置为 False，之后不再发送
+
+    budget 为 BudgetGovernor 时，每次请求发出前预留估计用量，预算用尽时抛出 BudgetExhausted
+
+    同一 base_url + key + model 共享一个 CircuitBreaker：连续 breaker_threshold 次服务故障后熔断，
+    断开期间请求等待而不发出，每隔 breaker_cooldown 秒（逐次加倍，不超过 breaker_max_cooldown）放行一个探测请求
+
+    endpoints 为提供同一模型的多个端点（Endpoint）时组成端点池：每个端点有各自的连接池、限流器与熔断器，
+    每次请求按权重与观测到的延迟、故障率选择端点，失败后换到其他端点重试；
+    max_concurrency 为各端点并发上限之和。未提供时只使用 api_url / api_key 一个端点
+    """
+
+    HEDGE_WINDOW = 200       # 用于估计分位数的最近响应时间个数
+    HEDGE_MIN_SAMPLES = 20   # 样本不足时不触发对冲
+
+    def __init__(self, model_name: str, api_url: str = None, api_key: str = None,
+                 max_concurrency: int = 8,
+                 max_retries: int = 5,
+                 rate_limit: float = None,
+                 backoff_base: float = 1.0,
+                 backoff_cap: float = 60.0,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 hedge_budget: float = 0.1,
+                 stream: bool = False,
+                 structured: bool = False,
+                 budget: BudgetGovernor = None,
+                 breaker_threshold: int = 5,
+                 breaker_cooldown: float = 10.0,
+                 breaker_max_cooldown: float = 300.0,
+                 endpoints: List[Endpoint] = None,
+                 **kwargs):
+        if endpoints:
+            api_url, api_key = endpoints[0].api_url, endpoints[0].api_key or api_key
+        super().__init__(model_name, api_url, api_key, **kwargs)
+        per_endpoint = max(1, int(max_concurrency))
+        endpoints = endpoints or [Endpoint(self.api_url, self.api_key)]
+        self.max_concurrency = sum(ep.concurrency or per_endpoint for ep in endpoints)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.supports_n: Optional[bool] = None
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_budget = hedge_budget
+        self.latencies: deque = deque(maxlen=self.HEDGE_WINDOW)
+        self.primary_count = 0
+        self.hedge_count = 0
+        self.hedge_wins = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.stream = stream
+        # 流式请求是否附带 stream_options.include_usage（None 表示尚未确认服务端是否支持）
+        self.supports_stream_usage: Optional[bool] = None
+        self.structured = structured
+        self.supports_schema: Optional[bool] = None
+        self.budget = budget
+        self.endpoints = [
+            EndpointState(ep, self._make_async_client(ep),
+                          get_limiter(ep.api_url, model_name, ep.concurrency or per_endpoint, rate_limit,
+                                      ep.api_key or self.api_key),
+                          get_breaker(ep.api_url, model_name, breaker_threshold, breaker_cooldown,
+                                      breaker_max_cooldown, ep.api_key or self.api_key))
+            for ep in endpoints
+        ]
+        # 单端点时的限流器、熔断器与连接池（端点池时为第一个端点）
+        self.limiter = self.endpoints[0].limiter
+        self.breaker = self.endpoints[0].breaker
+        self.async_client = self.endpoints[0].async_client
+
+    def _make_async_client(self, endpoint: Endpoint = None) -> AsyncOpenAI:
+        # 重试由限流器统一处理，关闭 SDK 自带的重试
+        return AsyncOpenAI(
+            api_key=endpoint.api_key or self.api_key if endpoint is not None else self.api_key,
+            base_url=endpoint.api_url if endpoint is not None else self.api_url,
+            max_retries=0
+        )
+
+    async def aclose(self):
+        """关闭绑定在当前事件循环上的连接池，并换上新的客户端，以便在之后的事件循环中复用"""
+        for ep in self.endpoints:
+            await ep.async_client.close()
+            ep.async_client = self._make_async_client(ep.endpoint)
+        self.async_client = self.endpoints[0].async_client
+
+    async def _asend(self, prompt: str, n: int = 1, endpoint: EndpointState = None,
+                     schema: bool = True) -> ChatReply:
+        """发送一次 chat.completions 请求（不重试），endpoint 为端点池中选定的端点；schema=False 时不发送 response_format"""
+        async_client = endpoint.async_client if endpoint is not None else self.async_client
+        kwargs: Dict[str, Any] = {"n": n} if n > 1 else {}
+        if schema and self.structured and self.supports_schema is not False:
+            kwargs["response_format"] = RESPONSE_FORMAT
+        if not self.stream:
+            response = await async_client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                **kwargs
+            )
+            choices = sorted(response.choices, key=lambda c: c.index)
+            prompt_tokens, completion_tokens, cached_tokens = usage_tokens(response.usage)
+            return ChatReply(texts=[c.message.content or "" for c in choices], indices=[c.index for c in choices],
+                             prompt_tokens=prompt_tokens,
+                             completion_tokens=completion_tokens, cached_tokens=cached_tokens)
+
+        start_time = time.time()
+        # 流式响应默认不带 usage，需显式请求；服务端拒绝该参数时不再发送
+        if self.supports_stream_usage is not False:
+            kwargs["stream_options"] = {"include_usage": True}
+        try:
+            stream = await async_client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+                **kwargs
+            )
+        except APIStatusError as e:
+            if "stream_options" not in kwargs or e.status_code not in (400, 422) or "stream_options" not in str(e):
+                raise
+            if self.supports_stream_usage is None:
+                print(f"⚠️ {self.model_name} 不支持 stream_options，流式请求将不统计 token 用量")
+            self.supports_stream_usage = False
+            del kwargs["stream_options"]
+            stream = await async_client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                stream=True,
+                **kwargs
+            )
+        detectors: Dict[int, JSONObjectDetector] = {}
+        ttft = None
+        # 提前结束时收不到末尾的 usage 分块，此时 token 用量为 None
+        prompt_tokens, completion_tokens, cached_tokens = None, None, None
+        try:
+            async for chunk in stream:
+                if getattr(chunk, "usage", None) is not None:
+                    prompt_tokens, completion_tokens, cached_tokens = usage_tokens(chunk.usage)
+                for choice in chunk.choices:
+                    content = choice.delta.content if choice.delta else None
+                    if not content:
+                        continue
+                    if ttft is None:
+                        ttft = time.time() - start_time
+                    detectors.setdefault(choice.index, JSONObjectDetector()).feed(content)
+                if len(detectors) >= n and all(d.done for d in detectors.values()):
+                    break
+        finally:
+            await stream.close()
+        time_to_json = time.time() - start_time if detectors and all(d.done for d in detectors.values()) else None
+        # 没有收到内容的候选记为空文本（与非流式返回空内容时一致，按格式校验失败处理，而不是请求出错）
+        indices = sorted(set(range(n)) | set(detectors))
+        return ChatReply(texts=[detectors[i].text if i in detectors else "" for i in indices], indices=indices,
+                         ttft=ttft, time_to_json=time_to_json, prompt_tokens=prompt_tokens,
+                         completion_tokens=completion_tokens, cached_tokens=cached_tokens)
+
+    def _pick_endpoint(self, exclude: "EndpointState" = None) -> Optional["EndpointState"]:
+        """
+        选择本次请求的端点（exclude 为刚失败的端点，有其他可用端点时避开）：
+        在熔断器可放行的端点中优先选并发窗口有空位的，按 权重 × 成功率 / 平滑延迟 加权随机；
+        都在熔断中时选最早可以探测的端点（在其熔断器处等待）；全部端点已放弃时返回 None
+        """
+        alive = [ep for ep in self.endpoints if not ep.breaker.gave_up]
+        if len(alive) <= 1:
+            return alive[0] if alive else None
+        candidates = [ep for ep in alive if ep is not exclude] or alive
+        ready = [ep for ep in candidates if ep.breaker.ready()]
+        if not ready:
+            return min(candidates, key=lambda ep: ep.breaker.opened_until)
+        free = [ep for ep in ready if ep.limiter.has_capacity()] or ready
+        observed = [ep.latency for ep in free if ep.latency is not None]
+        default_latency = sum(observed) / len(observed) if observed else 1.0
+        return random.choices(free, weights=[ep.score(default_latency) for ep in free])[0]
+
+    async def _acquire_endpoint(self, exclude: "EndpointState" = None) -> Tuple["EndpointState", bool]:
+        """选择端点并等待其熔断器放行，返回 (端点, 是否为探测请求)；全部端点已放弃时抛出 CircuitOpen"""
+        while True:
+            endpoint = self._pick_endpoint(exclude)
+            if endpoint is None:
+                raise CircuitOpen(f"{self.model_name} 服务持续故障")
+            try:
+                return endpoint, await endpoint.breaker.acquire()
+            except CircuitOpen:
+                # 等待期间该端点被放弃，改选其他端点
+                continue
+
+    async def _acreate(self, prompt: str, n: int = 1, schema: bool = True) -> ChatReply:
+        """
+        发送一次 chat.completions 请求，失败时按限流器与退避策略重试；
+        端点池中还有其他可立即放行的端点时，失败后不等待退避，直接换到其他端点重试。
+        schema=False 时不发送 response_format（用于确认 400/422 是否由该参数引起）
+        """
+        endpoint = None
+        for attempt in range(self.max_retries + 1):
+            endpoint, probe = await self._acquire_endpoint(exclude=endpoint)
+            reservation = None
+            try:
+                if self.budget is not None:
+                    reservation = await self.budget.reserve(prompt, n)
+                await endpoint.limiter.acquire()
+            except BaseException:
+                endpoint.breaker.record(None, probe)
+                self._settle(prompt, reservation, n=n)
+                raise
+            self.request_count += 1
+            endpoint.requests += 1
+            with_schema = schema and self.structured and self.supports_schema is not False
+            attempt_start = time.time()
+            try:
+                response = await self._asend(prompt, n, endpoint, schema=with_schema)
+            except asyncio.CancelledError:
+                endpoint.limiter.release(cancelled=True)
+                endpoint.breaker.record(None, probe)
+                self._settle(prompt, reservation, n=n, cancelled=True)
+                raise
+            except Exception as e:
+                self._settle(prompt, reservation, n=n)
+                if with_schema and self._schema_rejected(e):
+                    # 参数错误不反映服务端拥塞与故障
+                    endpoint.limiter.release(neutral=True)
+                    endpoint.breaker.record(None, probe)
+                    return await self._retry_without_schema(prompt, n, e)
+                retryable, retry_after = classify_api_error(e)
+                status_code = getattr(e, "status_code", None)
+                # 不可重试的错误（如参数错误）既不是拥塞也不是成功，不调整并发窗口
+                endpoint.limiter.release(congested=retryable, neutral=not retryable,
+                                         status_code=status_code, retry_after=retry_after)
+                # 429 是限流信号而非服务故障，不计入熔断与故障率
+                failure = retryable and status_code != 429
+                endpoint.breaker.record(False if failure else None, probe)
+                if failure:
+                    endpoint.observe(ok=False)
+                if not retryable or attempt == self.max_retries:
+                    raise
+                endpoint.limiter.retries += 1
+                if any(ep is not endpoint and ep.breaker.ready() and ep.limiter.has_capacity()
+                       for ep in self.endpoints):
+                    continue
+                delay = retry_after if retry_after is not None else \
+                    random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                await asyncio.sleep(delay)
+                continue
+            endpoint.limiter.release()
+            endpoint.breaker.record(True, probe)
+            self._settle(prompt, reservation, response, n=n)
+            if with_schema and self.supports_schema is None:
+                self.supports_schema = True
+            response.latency = time.time() - attempt_start
+            response.api_retries = attempt
+            endpoint.observe(ok=True, latency=response.latency)
+            self.prompt_tokens += response.prompt_tokens or 0
+            self.completion_tokens += response.completion_tokens or 0
+            self.cached_tokens += response.cached_tokens or 0
+            return response
+
+    def _settle(self, prompt: str, reservation: Optional[Tuple[float, float]], reply: ChatReply = None,
+                n: int = 1, cancelled: bool = False):
+        """结算预算预留（未启用预算时跳过）"""
+        if reservation is not None:
+            self.budget.settle(prompt, reservation, reply, n=n, cancelled=cancelled)
+
+    def _schema_rejected(self, e: Exception) -> bool:
+        """请求是否可能因 response_format 不被支持而被拒绝（尚未确认支持时的 400/422）"""
+        return (self.supports_schema is not True
+                and isinstance(e, APIStatusError) and e.status_code in (400, 422))
+
+    async def _retry_without_schema(self, prompt: str, n: int, error: Exception) -> ChatReply:
+        """
+        400/422 的错误信息提到 response_format / json_schema 时直接判定不支持；
+        否则（如 n>1 被拒绝）去掉 response_format 重试一次，成功才判定不支持，失败则抛出原错误
+        """
+        message = str(error).lower()
+        if any(keyword in message for keyword in SCHEMA_ERROR_KEYWORDS):
+            self._disable_schema(error)
+            return await self._acreate(prompt, n)
+        try:
+            reply = await self._acreate(prompt, n, schema=False)
+        except ClientStopped:
+            raise
+        except Exception:
+            raise error
+        self._disable_schema(error)
+        return reply
+
+    def _disable_schema(self, error: Exception):
+        if self.supports_schema is None:
+            print(f"⚠️ {self.model_name} 不支持 response_format，改为仅本地校验: {str(error)[:100]}")
+        self.supports_schema = False
+
+    def hedge_delay(self) -> Optional[float]:
+        """当前的对冲触发阈值（近期响应时间的分位数）；未启用、样本不足或超出预算时返回 None"""
+        if not self.hedge or len(self.latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        if self.hedge_count + 1 > self.hedge_budget * self.primary_count:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(self.hedge_quantile * len(ordered)))]
+
+    async def _ahedged(self, prompt: str, n: int = 1) -> Tuple[ChatReply, str]:
+        """
+        发送请求，必要时发出对冲请求
+        返回 (reply, hedge)，hedge 为 "" 表示未触发对冲，否则为胜出的一方 "primary" / "hedge"
+        """
+        self.primary_count += 1
+        start_time = time.time()
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(self._acreate(prompt, n))
+        if delay is None:
+            reply = await primary
+            self.latencies.append(time.time() - start_time)
+            return reply, ""
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            reply = primary.result()
+            self.latencies.append(time.time() - start_time)
+            return reply, ""
+
+        self.hedge_count += 1
+        attempts = {primary: "primary", asyncio.ensure_future(self._acreate(prompt, n)): "hedge"}
+        pending = set(attempts)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    winner = attempts[task]
+                    if winner == "hedge":
+                        self.hedge_wins += 1
+                    self.latencies.append(time.time() - start_time)
+                    return task.result(), winner
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def acomplete(self, prompt: str, sample_index: int = 0, refresh: bool = False) -> Completion:
+        """异步生成响应（优先读取缓存；refresh=True 时跳过缓存重新请求，并覆盖缓存）"""
+        cached = None if refresh else self._cache_lookup(prompt, sample_index)
+        if cached is not None:
+            return cached
+
+        start_time = time.time()
+
+        try:
+            reply, hedge = await self._ahedged(prompt)
+            completion = Completion(text=reply.texts[0], response_time=time.time() - start_time,
+                                    hedge=hedge, **reply.sample_fields(0))
+
+        except ClientStopped:
+            raise
+        except Exception as e:
+            error_msg = f"API调用出错: {str(e)}"
+            return Completion(text=error_msg, response_time=time.time() - start_time, error=True)
+
+        self._cache_store(prompt, sample_index, completion)
+        return completion
+
+    async def acomplete_n(self, prompt: str, sample_indices: List[int]) -> List[Completion]:
+        """
+        同一提示词的多个样本：缓存未命中的部分以一次 n=k 请求获取，
+        候选按 choice.index 对应到样本，缺失或内容为空的样本逐条并发请求；
+        只有接口拒绝 n>1 的请求时才判定为不支持 n，
+        服务故障（连接错误、5xx 等重试耗尽）时未获取的样本返回错误结果
+        """
+        completions: Dict[int, Completion] = {}
+        missing: List[int] = []
+        for idx in sample_indices:
+            cached = self._cache_lookup(prompt, idx)
+            if cached is not None:
+                completions[idx] = cached
+            else:
+                missing.append(idx)
+
+        if len(missing) > 1 and self.supports_n is not False:
+            start_time = time.time()
+            try:
+                reply, hedge = await self._ahedged(prompt, n=len(missing))
+            except ClientStopped:
+                raise
+            except Exception as e:
+                if classify_api_error(e)[0]:
+                    error = Completion(text=f"API调用出错: {str(e)}", response_time=time.time() - start_time,
+                                       error=True)
+                    completions.update((idx, error) for idx in missing)
+                    return [completions[idx] for idx in sample_indices]
+                print(f"⚠️ {self.model_name} 不支持 n={len(missing)} 批量请求，改为逐条请求: {str(e)[:100]}")
+                self.supports_n = False
+                reply, hedge = ChatReply(texts=[]), ""
+            rt = time.time() - start_time
+            indices = reply.indices if reply.indices is not None else range(len(reply.texts))
+            # choice.index → 该候选在 reply.texts 中的位置（用于分摊 token 用量）
+            positions = {index: i for i, index in enumerate(indices)}
+            if any(index > 0 for index in positions):
+                self.supports_n = True
+            unfilled = []
+            for index, idx in enumerate(missing):
+                i = positions.get(index)
+                if i is None or not reply.texts[i]:
+                    unfilled.append(idx)
+                    continue
+                completions[idx] = Completion(text=reply.texts[i], response_time=rt, hedge=hedge,
+                                              **reply.sample_fields(i))
+                self._cache_store(prompt, idx, completions[idx])
+            missing = unfilled
+
+        if missing:
+            rest = await asyncio.gather(*(self.acomplete(prompt, idx) for idx in missing))
+            completions.update(zip(missing, rest))
+        return [completions[idx] for idx in sample_indices]
+
+    async def agenerate_response(self, prompt: str, sample_index: int = 0) -> Tuple[str, float]:
+        """异步生成响应并返回内容和响应时间"""
+        completion = await self.acomplete(prompt, sample_index)
+        return completion.text, completion.response_time
 
 
 # ==================== Data Loading ====================
@@ -66,164 +1573,1108 @@ class CSVCases:
         self.csv_path = csv_path
         self.data = self._load()
 
-    def _load(self) -> pd.DataFrame:
-        """加载CSV数据"""
-        try:
-            df = pd.read_csv(self.csv_path, encoding='utf-8')
-            print(f"✓ 载入CSV: {len(df)} 条记录")
-            return df
-        except Exception as e:
-            print(f"⚠️ CSV载入失败: {e}")
-            return pd.DataFrame(columns=["序号", "案件内容", "延迟时间", "Category"])
+    def _load(self) -> pd.DataFrame:
+        """加载CSV数据"""
+        try:
+            df = pd.read_csv(self.csv_path, encoding='utf-8')
+            print(f"✓ 载入CSV: {len(df)} 条记录")
+            return df
+        except Exception as e:
+            print(f"⚠️ CSV载入失败: {e}")
+            return pd.DataFrame(columns=["序号", "案件内容", "延迟时间", "Category"])
+
+    def get_delay_values(self) -> List[str]:
+        """获取所有延迟时间值"""
+        if self.data.empty:
+            return ["当日"]
+        delays = list(self.data["延迟时间"].unique())
+        has_immediate = any(("当" in str(d) and ("日" in str(d) or "曰" in str(d))) for d in delays)
+        if not has_immediate:
+            delays = ["当日"] + [d for d in delays if d != "当日"]
+        return delays
+
+
+# ==================== Prompt Building ====================
+EMOTIONAL_INSTRUCTION = "根据个人的情感体验，"
+
+# 推理条件指令
+REASONING_INSTRUCTIONS = {
+    "NAN-reasoning": "",  # 无特殊推理指令
+    "long-term-reasoning": "你有较为充足的思考和反应时间。",
+    "short-term-reasoning": "你需要立刻做出判断，时间紧迫。"
+}
+
+
+def build_prompt(role: str, 
+                case_desc: str, 
+                include_emotional: bool,
+                reasoning_type: str = "NAN-reasoning",
+                time_condition: str = None,
+                age: str = None) -> str:
+    """
+    构建实验提示词
+    
+    Args:
+        role: 角色 (SPP/TPP)
+        case_desc: 案件描述
+        include_emotional: 是否包含情感指令
+        reasoning_type: 推理类型 (NAN-reasoning/long-term-reasoning/short-term-reasoning)
+        time_condition: 时间条件 (即时/延迟)
+        age: 年龄条件 (age:NAN/age:20/age:30/age:40/age:50/age:60)
+    """
+    # 角色设置
+    role_prefix = "你是一名受害者" if role == "SPP" else "你是一名法官"
+    
+    # 情感指令
+    emotional = EMOTIONAL_INSTRUCTION if include_emotional else ""
+    
+    # 推理指令
+    reasoning_instruction = REASONING_INSTRUCTIONS.get(reasoning_type, "")
+    
+    # 时间条件说明
+    time_instruction = ""
+    if time_condition:
+        if time_condition == "即时":
+            time_instruction = "注意：这是一个即时发生的案件，你需要立即做出判断。"
+        elif time_condition == "延迟":
+            time_instruction = "注意：这是一个延迟发生的案件，案件已经过去一段时间。"
+    
+    # 年龄条件说明
+    age_instruction = ""
+    if age and age != "age:NAN":
+        age_num = age.replace("age:", "")
+        age_instruction = f"你当前的年龄是{age_num}岁，请从这个年龄段的视角进行判断。"
+    
+    # 构建完整的提示词
+    parts = [role_prefix + "。"]
+    
+    if age_instruction:
+        parts.append(age_instruction)
+    
+    parts.append("\n案件描述：" + case_desc)
+    
+    if time_instruction:
+        parts.append("\n" + time_instruction)
+    
+    parts.append("\n")
+    
+    if reasoning_instruction:
+        parts.append(reasoning_instruction + "\n")
+    
+    if emotional:
+        parts.append(emotional)
+    
+    parts.append("请你判断犯罪者应当受到多严厉的惩罚。\n")
+    parts.append("评分标准：\n")
+    parts.append("0 分 —— 不给予任何刑罚\n")
+    parts.append("9 分 —— 死刑\n")
+    parts.append("分数越高，对应的惩罚越严厉\n\n")
+    parts.append("请严格按照以下JSON格式输出你的回答：\n")
+    parts.append("{\n")
+    parts.append("    \"punishment_score\": <0-9的整数>,\n")
+    parts.append("    \"reasoning\": \"<评分理由>\",\n")
+    parts.append("    \"emotional_arousal\": <0-9的整数>,\n")
+    parts.append("    \"emotional_description\": \"<情绪状态描述>\",\n")
+    parts.append("    \"case_analysis\": \"<对案件的分析>\",\n")
+    parts.append("    \"punishment_justification\": \"<惩罚合理性的说明>\"\n")
+    parts.append("}\n")
+    
+    return "".join(parts)
+
+
+@functools.lru_cache(maxsize=None)
+def cached_build_prompt(role: str,
+                        case_desc: str,
+                        include_emotional: bool,
+                        reasoning_type: str = "NAN-reasoning",
+                        time_condition: str = None,
+                        age: str = None) -> str:
+    """build_prompt 的进程内缓存版本，供同一进程中的多个实验共享"""
+    return build_prompt(role, case_desc, include_emotional, reasoning_type, time_condition, age)
+
+
+# ==================== Response Parser ====================
+def extract_json_text(resp: str) -> str:
+    """从响应中截取 JSON 文本：优先取代码块内的对象，否则取最外层花括号之间的内容"""
+    # 尝试从代码块中提取JSON
+    m = re.search(r"```(?:json)?\s*(\{[\s\S]*?\})\s*```", resp)
+    if m:
+        return m.group(1)
+    # 直接提取JSON对象
+    json_match = re.search(r"\{[\s\S]*\}", resp)
+    if not json_match:
+        raise ValueError("未找到JSON格式")
+    return json_match.group(0)
+
+
+def parse_response(resp: str) -> Tuple[int, str, int, str, str, str]:
+    """解析LLM响应为结构化数据"""
+    try:
+        data = json.loads(extract_json_text(resp))
+        return (
+            int(data.get("punishment_score", 0)),
+            str(data.get("reasoning", "")),
+            int(data.get("emotional_arousal", 0)),
+            str(data.get("emotional_description", "")),
+            str(data.get("case_analysis", "")),
+            str(data.get("punishment_justification", "")),
+        )
+    except Exception as e:
+        print(f"⚠️ JSON解析失败: {e}")
+        print(f"响应内容: {resp[:200]}...")
+        return 0, resp.strip()[:200], 0, "", "", ""
+
+
+# ==================== Structured Output ====================
+RESPONSE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "punishment_score": {"type": "integer", "minimum": 0, "maximum": 9},
+        "reasoning": {"type": "string"},
+        "emotional_arousal": {"type": "integer", "minimum": 0, "maximum": 9},
+        "emotional_description": {"type": "string"},
+        "case_analysis": {"type": "string"},
+        "punishment_justification": {"type": "string"},
+    },
+    "required": ["punishment_score", "reasoning", "emotional_arousal",
+                 "emotional_description", "case_analysis", "punishment_justification"],
+    "additionalProperties": False,
+}
+
+# chat.completions 的 response_format 参数（OpenAI 兼容接口的 json_schema 模式）
+RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {"name": "punishment_judgment", "strict": True, "schema": RESPONSE_SCHEMA},
+}
+# 400/422 的错误信息含有这些词时，判定为接口不支持 response_format
+SCHEMA_ERROR_KEYWORDS = ("response_format", "json_schema")
+
+
+def compile_schema(schema: Dict[str, Any]) -> Callable[[Any], List[str]]:
+    """
+    把 JSON Schema 编译为校验函数，返回错误信息列表（为空表示通过）
+    优先使用 jsonschema；未安装时退回只支持扁平对象（类型、必填、取值范围）的内置校验
+    """
+    try:
+        import jsonschema
+    except ImportError:
+        jsonschema = None
+
+    if jsonschema is not None:
+        validator = jsonschema.Draft7Validator(schema)
+        return lambda data: [e.message for e in validator.iter_errors(data)]
+
+    types = {"object": dict, "string": str, "integer": int, "number": (int, float), "boolean": bool}
+    required = list(schema.get("required", []))
+    properties = [(name, spec.get("type"), spec.get("minimum"), spec.get("maximum"))
+                  for name, spec in schema.get("properties", {}).items()]
+    known = {name for name, _, _, _ in properties}
+    closed = schema.get("additionalProperties", True) is False
+
+    def validate(data: Any) -> List[str]:
+        if not isinstance(data, dict):
+            return ["响应不是 JSON 对象"]
+        errors = [f"缺少字段 {name}" for name in required if name not in data]
+        for name, type_name, minimum, maximum in properties:
+            if name not in data:
+                continue
+            value = data[name]
+            if not isinstance(value, types[type_name]) or \
+                    (isinstance(value, bool) and type_name != "boolean"):
+                errors.append(f"{name} 应为 {type_name}")
+                continue
+            if minimum is not None and value < minimum:
+                errors.append(f"{name}={value} 小于 {minimum}")
+            if maximum is not None and value > maximum:
+                errors.append(f"{name}={value} 大于 {maximum}")
+        if closed:
+            errors.extend(f"多余字段 {name}" for name in data if name not in known)
+        return errors
+
+    return validate
+
+
+RESPONSE_VALIDATOR = compile_schema(RESPONSE_SCHEMA)
+
+
+def validate_response(resp: str) -> Optional[str]:
+    """按 RESPONSE_SCHEMA 校验响应，通过返回 None，否则返回失败原因"""
+    try:
+        data = json.loads(extract_json_text(resp))
+    except ValueError as e:
+        return f"JSON解析失败: {e}"
+    errors = RESPONSE_VALIDATOR(data)
+    return "; ".join(errors) if errors else None
+
+
+# ==================== Result Structure ====================
+@dataclass
+class Result:
+    """实验结果数据结构"""
+    experiment_id: str
+    case_id: str
+    role: str
+    time_condition: str
+    delay_time: str
+    model: str
+    include_emotional: bool
+    score: int
+    reasoning: str
+    emotional_arousal: int
+    emotional_description: str
+    case_analysis: str
+    punishment_justification: str
+    response_time: float
+    timestamp: str
+    sample_idx: int = 0
+    cached: bool = False
+    hedge: str = ""
+    ttft: Optional[float] = None
+    time_to_json: Optional[float] = None
+    parse_ok: bool = True
+    parse_retries: int = 0
+    prompt_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    latency: Optional[float] = None
+    api_retries: int = 0
+    tokens_per_s: Optional[float] = None
+    api_error: bool = False
+
+
+def result_key(experiment_id: str, case_id: str, role: str,
+               time_condition: str, sample_idx: int) -> Tuple[str, str, str, str, int]:
+    """结果的唯一键 (experiment, case_id, role, time_condition, sample_idx)"""
+    return (experiment_id, case_id, role, time_condition, int(sample_idx))
+
+
+def experiment_prefix(experiment_id: str) -> str:
+    """从实验ID（<前缀>_YYYYmmdd_HHMMSS）中去掉时间戳，得到实验前缀"""
+    return re.sub(r"_\d{8}_\d{6}$", "", experiment_id)
+
+
+@dataclass
+class WorkItem:
+    """
+    单次模型调用的工作单元，index 为其在实验计划中的位置，retry 为解析失败后的重试轮次，
+    requeues 为请求失败后重新入队的次数
+    """
+    index: int
+    case: Dict[str, Any]
+    role: str
+    time_condition: str
+    delay_time: str
+    sample_idx: int
+    prompt: str
+    retry: int = 0
+    requeues: int = 0
+
+
+def print_cache_stats(cache: ResponseCache):
+    """打印响应缓存命中统计"""
+    stats = cache.stats()
+    mode = "回放" if cache.replay else "读写"
+    print(f"✓ 响应缓存({mode}): 命中 {stats['hits']} | 未命中 {stats['misses']} | "
+          f"命中率 {stats['hit_rate']*100:.1f}%")
+
+
+# ==================== Work Planning ====================
+def plan_work_items(cases: CSVCases, samples: int, include_emotional: bool,
+                    reasoning_type: str = "NAN-reasoning", age: str = None) -> List[WorkItem]:
+    """按 案件 → 时间条件 → 角色 → 样本 的顺序生成一个实验条件的全部工作单元"""
+    roles = ["SPP", "TPP"]
+    
+    # 获取去重后的案件
+    df_unique = cases.data.drop_duplicates(subset=["序号"])
+    if df_unique.empty:
+        return []
+
+    # 建立案件到时间条件的映射
+    case_2_conditions: Dict[str, List[str]] = {}
+    for _, row in cases.data.iterrows():
+        cid = f"CSV_{row['序号']}"
+        delay_str = str(row["延迟时间"])
+        cond = ("即时" if ("当" in delay_str and ("日" in delay_str or "曰" in delay_str))
+                else "延迟")
+        case_2_conditions.setdefault(cid, []).append(cond)
+
+    items: List[WorkItem] = []
+    for _, row in df_unique.iterrows():
+        cid = f"CSV_{row['序号']}"
+        case_dict = {
+            "id": cid,
+            "description": row["案件内容"],
+            "delay_time": row["延迟时间"],
+            "category": row.get("Category", "未知")
+        }
+
+        for cond in case_2_conditions[cid]:
+            for role in roles:
+                # 同一 (案件, 条件, 角色) 的各样本共用同一提示词
+                prompt = cached_build_prompt(
+                    role=role,
+                    case_desc=case_dict.get("description", ""),
+                    include_emotional=include_emotional,
+                    reasoning_type=reasoning_type,
+                    time_condition=cond,
+                    age=age
+                )
+                for sample_idx in range(samples):
+                    items.append(WorkItem(
+                        index=len(items),
+                        case=case_dict,
+                        role=role,
+                        time_condition=cond,
+                        delay_time=str(row["延迟时间"]),
+                        sample_idx=sample_idx,
+                        prompt=prompt
+                    ))
+    return items
+
+
+def shard_of(prefix: str, case_id: str, time_condition: str, role: str,
+             sample_idx: int, num_shards: int) -> int:
+    """工作单元所属的分片编号：对 (实验前缀, 案件, 时间条件, 角色, 样本) 取 SHA-1，跨机器、跨进程稳定"""
+    key = "|".join([prefix, str(case_id), time_condition, role, str(int(sample_idx))])
+    return int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:16], 16) % num_shards
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """解析 --shard i/N（i 从 0 开始）"""
+    try:
+        index, total = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ValueError(f"--shard 格式应为 i/N，如 0/4: {value}")
+    if total < 1 or not 0 <= index < total:
+        raise ValueError(f"--shard 需满足 0 <= i < N: {value}")
+    return index, total
+
+
+def shard_items(items: List[WorkItem], prefix: str, shard: Tuple[int, int]) -> List[WorkItem]:
+    """只保留属于 shard 的工作单元，并重新编号"""
+    index, total = shard
+    kept = [item for item in items
+            if shard_of(prefix, item.case.get("id", ""), item.time_condition, item.role,
+                        item.sample_idx, total) == index]
+    return [replace(item, index=i) for i, item in enumerate(kept)]
+
+
+# ==================== Result Journal ====================
+class ResultJournal:
+    """
+    追加写入的结果日志（JSONL）
+
+    每条结果完成后立即写入一行并刷新到磁盘，进程崩溃时已完成的调用不会丢失；
+    载入时跳过因崩溃而写了一半的末行，恢复后追加前先补上换行，新结果不会接在半行之后
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self._fh = None
+
+    def load(self) -> List[Result]:
+        """读取日志中的全部结果"""
+        if not os.path.exists(self.path):
+            return []
+        names = {f.name for f in fields(Result)}
+        records: List[Result] = []
+        skipped = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                    records.append(Result(**{k: v for k, v in data.items() if k in names}))
+                except (ValueError, TypeError):
+                    skipped += 1
+        if skipped:
+            print(f"⚠️ 日志中有 {skipped} 行无法解析，已跳过")
+        print(f"✓ 载入日志: {self.path} ({len(records)} 条结果)")
+        return records
+
+    def append(self, result: Result):
+        """追加一条结果"""
+        if self._fh is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            torn = self._ends_mid_line()
+            self._fh = open(self.path, "a", encoding="utf-8")
+            if torn:
+                self._fh.write("\n")
+        self._fh.write(json.dumps(asdict(result), ensure_ascii=False) + "\n")
+        self._fh.flush()
+        if self.fsync:
+            os.fsync(self._fh.fileno())
+
+    def _ends_mid_line(self) -> bool:
+        """日志是否以写了一半的行结尾（崩溃时末行未写完）"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return False
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+# ==================== Export ====================
+EXPORT_FORMATS = ("parquet", "json", "csv")
+# 下游分析脚本（LLM/visualization/text/*.py）读取 JSON，迁移到 load_results 之前默认仍导出 JSON / CSV
+DEFAULT_EXPORT_FORMATS = ("parquet", "json", "csv") if pa is not None else ("json", "csv")
+PARQUET_ROW_GROUP = 10000
+# 分区列只出现在目录名中（model=<模型>/prefix=<实验前缀>），不写入文件
+PARQUET_PARTITIONS = ("model", "prefix")
+# 取值重复度高的列使用字典编码
+PARQUET_DICTIONARY_COLUMNS = ("experiment_id", "case_id", "role", "time_condition", "delay_time", "hedge")
+
+
+def parquet_schema() -> "pa.Schema":
+    """由 Result 的字段类型生成 Parquet 列定义"""
+    types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+    columns = []
+    for name, hint in get_type_hints(Result).items():
+        if name in PARQUET_PARTITIONS:
+            continue
+        if get_origin(hint) is Union:
+            hint = next(a for a in get_args(hint) if a is not type(None))
+        column_type = types[hint]
+        if name in PARQUET_DICTIONARY_COLUMNS:
+            column_type = pa.dictionary(pa.int32(), column_type)
+        columns.append(pa.field(name, column_type))
+    return pa.schema(columns)
+
+
+def partitioning_schema() -> "pads.Partitioning":
+    return pads.partitioning(pa.schema([(name, pa.string()) for name in PARQUET_PARTITIONS]),
+                             flavor="hive")
+
+
+class ParquetResultWriter:
+    """
+    以 hive 分区布局写入 Parquet 数据集：<root>/model=<模型>/prefix=<实验前缀>/<实验ID>.parquet
+
+    结果按 row_group_size 条一组转换为列式数据并写出，不在内存中整体展开；
+    先写入隐藏的临时文件再原子替换，中断时不会留下半个文件
+    """
+
+    def __init__(self, root: str, row_group_size: int = PARQUET_ROW_GROUP):
+        if pa is None:
+            raise ImportError("导出 Parquet 需要安装 pyarrow")
+        self.root = root
+        self.row_group_size = row_group_size
+        self.schema = parquet_schema()
+
+    def path_for(self, model: str, prefix: str, name: str) -> str:
+        return os.path.join(self.root, f"model={quote(model, safe='')}",
+                            f"prefix={quote(prefix, safe='')}", f"{name}.parquet")
+
+    def write(self, results: Iterable[Result], model: str, prefix: str, name: str) -> str:
+        """写入一个实验的全部结果，返回文件路径"""
+        path = self.path_for(model, prefix, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), f".{name}.parquet.tmp")
+        with pq.ParquetWriter(tmp_path, self.schema, compression="zstd") as writer:
+            rows: List[Result] = []
+            for result in results:
+                rows.append(result)
+                if len(rows) >= self.row_group_size:
+                    self._flush(writer, rows)
+                    rows = []
+            if rows:
+                self._flush(writer, rows)
+        os.replace(tmp_path, path)
+        return path
+
+    def _flush(self, writer: "pq.ParquetWriter", rows: List[Result]):
+        table = pa.Table.from_pydict(
+            {name: [getattr(r, name) for r in rows] for name in self.schema.names},
+            schema=self.schema
+        )
+        writer.write_table(table, row_group_size=len(rows))
+
+
+def load_results(root: str, model: str = None, prefix: str = None,
+                 columns: List[str] = None) -> pd.DataFrame:
+    """
+    读取 Parquet 结果数据集为 DataFrame
+
+    model / prefix 按分区目录过滤，只读取匹配的文件；columns 只读取指定列
+    """
+    if pa is None:
+        raise ImportError("读取 Parquet 结果需要安装 pyarrow")
+    dataset = pads.dataset(root, format="parquet", partitioning=partitioning_schema())
+    condition = None
+    for name, value in (("model", model), ("prefix", prefix)):
+        if value is not None:
+            expr = pads.field(name) == value
+            condition = expr if condition is None else condition & expr
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def write_json_array(f, records: Iterable[Dict[str, Any]]):
+    """逐条写出 JSON 数组，输出与 json.dump(list, indent=2) 相同"""
+    separator = "[\n  "
+    for record in records:
+        f.write(separator + json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+        separator = ",\n  "
+    f.write("[]" if separator.startswith("[") else "\n]")
+
+
+def export_results(results: List[Result], base_name: str, formats: Tuple[str, ...] = None,
+                   parquet_root: str = "results.parquet", prefix: str = None,
+                   experiment_id: str = None) -> List[str]:
+    """
+    导出同一实验的结果，返回写出的文件路径
+    parquet 写入 parquet_root 下的 model=/prefix= 分区，json / csv 写出 <base_name>.json / <base_name>.csv；
+    三种格式都逐条写出，不在内存中另建整张表
+    """
+    formats = formats or DEFAULT_EXPORT_FORMATS
+    experiment_id = experiment_id or results[0].experiment_id
+    prefix = prefix or experiment_prefix(experiment_id)
+    paths = []
+    if "parquet" in formats:
+        writer = ParquetResultWriter(parquet_root)
+        paths.append(writer.write(results, results[0].model, prefix, experiment_id))
+
+    if "json" in formats:
+        json_path = f"{base_name}.json"
+        with open(json_path, "w", encoding="utf-8") as f:
+            write_json_array(f, (asdict(r) for r in results))
+        paths.append(json_path)
+
+    if "csv" in formats:
+        csv_path = f"{base_name}.csv"
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=[field.name for field in fields(Result)])
+            writer.writeheader()
+            writer.writerows(asdict(r) for r in results)
+        paths.append(csv_path)
+    return paths
+
+
+def add_export_arguments(parser: argparse.ArgumentParser):
+    """导出格式相关的命令行参数"""
+    parser.add_argument('--formats', type=str, default=None,
+                       help=f'导出格式，逗号分隔，可选 {",".join(EXPORT_FORMATS)}'
+                            f'（默认: {",".join(DEFAULT_EXPORT_FORMATS)}）')
+    parser.add_argument('--parquet-dir', type=str, default=None,
+                       help='Parquet 数据集根目录（默认: <输出目录>/results.parquet）')
+
+
+def export_formats_from_args(args: argparse.Namespace) -> Tuple[str, ...]:
+    """解析 --formats；未安装 pyarrow 时去掉 parquet 并退回 JSON + CSV"""
+    if not args.formats:
+        return DEFAULT_EXPORT_FORMATS
+    formats = tuple(f.strip().lower() for f in args.formats.split(",") if f.strip())
+    unknown = [f for f in formats if f not in EXPORT_FORMATS]
+    if unknown:
+        raise ValueError(f"未知的导出格式: {', '.join(unknown)}")
+    if "parquet" in formats and pa is None:
+        print("⚠️ 未安装 pyarrow，跳过 Parquet 导出")
+        formats = tuple(f for f in formats if f != "parquet") or ("json", "csv")
+    return formats
+
+
+# ==================== Scheduler ====================
+def group_work_items(items: List[WorkItem], batch_samples: bool) -> List[List[WorkItem]]:
+    """
+    把工作单元组织为调度单位：batch_samples 为 True 时，
+    同一 (案件, 时间条件, 角色) 的相邻样本合并为一组，以一次 n=k 请求完成
+    """
+    if not batch_samples:
+        return [[item] for item in items]
+    units: List[List[WorkItem]] = []
+    for item in items:
+        if units and units[-1][0].prompt == item.prompt \
+                and units[-1][0].case.get("id") == item.case.get("id"):
+            units[-1].append(item)
+        else:
+            units.append([item])
+    return units
+
+
+# 调度顺序: plan 按实验计划顺序发出；prefix 按提示词前缀分组发出
+SCHEDULES = ("plan", "prefix")
+
+
+def order_by_prefix(jobs: List[Tuple["SimpleExperiment", List[WorkItem]]]) -> List[Tuple["SimpleExperiment", List[WorkItem]]]:
+    """
+    按提示词字典序稳定排序：字典序相邻的提示词公共前缀最长（相当于前缀树的深度优先遍历），
+    共享最长公共前缀的调度单位因此连续发出，可命中服务端的前缀缓存；同一提示词的样本保持原有顺序
+    """
+    return sorted(jobs, key=lambda job: job[1][0].prompt)
+
+
+class WorkScheduler:
+    """
+    有界并发调度器
+
+    调度单位按所属客户端分组，每组启动 client.max_concurrency 个 worker，
+    各组并行执行；同一组内按给定顺序取出调度单位，schedule="prefix" 时先按提示词前缀重排。
+    某个客户端停止发出请求（预算用尽或放弃了持续故障的服务）后，该组剩余的调度单位不再执行（按原因计入 skipped）。
+    请求失败的工作单元不写入结果，放回所在组的队尾（熔断期间该组的 worker 暂停等待，其他组照常运行），
+    重新入队超过 max_requeues 次仍失败的不再重试（计入 dropped），可之后 --resume 补跑
+    """
+
+    def __init__(self, total: int, progress_every: int = 10, schedule: str = "plan", max_requeues: int = 3):
+        self.total = total
+        self.progress_every = progress_every
+        self.schedule = schedule
+        self.max_requeues = max_requeues
+        self.completed = 0
+        self.skipped: Dict[str, int] = {}
+        self.requeued = 0
+        self.dropped = 0
+
+    async def run(self, jobs: List[Tuple["SimpleExperiment", List[WorkItem]]]) -> Dict[str, float]:
+        """执行全部调度单位，返回吞吐量统计"""
+        groups: Dict[int, Tuple[AsyncLLMClient, deque]] = {}
+        for exp, unit in jobs:
+            key = id(exp.client)
+            if key not in groups:
+                groups[key] = (exp.client, deque())
+            groups[key][1].append((exp, unit))
+        if self.schedule == "prefix":
+            groups = {key: (client, deque(order_by_prefix(list(queue))))
+                      for key, (client, queue) in groups.items()}
+        requests_before = sum(client.request_count for client, _ in groups.values())
+
+        start = time.time()
+        workers = []
+        for client, queue in groups.values():
+            for _ in range(min(client.max_concurrency, len(queue))):
+                workers.append(self._worker(queue))
+        await asyncio.gather(*workers)
+        elapsed = time.time() - start
+
+        stats = {
+            "completed": self.completed,
+            "requests": sum(client.request_count for client, _ in groups.values()) - requests_before,
+            "elapsed": elapsed,
+            "throughput": self.completed / elapsed if elapsed > 0 else 0.0,
+            "skipped": sum(self.skipped.values()),
+            "requeued": self.requeued,
+            "dropped": self.dropped,
+        }
+        print(f"✓ 完成 {stats['completed']} 次调用（API请求 {stats['requests']} 次），"
+              f"用时 {elapsed:.1f}s，吞吐量 {stats['throughput']:.2f} 次/秒")
+        for reason, count in self.skipped.items():
+            print(f"⚠️ {reason}，{count} 次调用未执行（可 --resume 从结果日志继续）")
+        if self.requeued:
+            print(f"↻ 请求失败重新入队 {self.requeued} 次")
+        if self.dropped:
+            print(f"⚠️ {self.dropped} 次调用重新入队 {self.max_requeues} 次后仍失败，未写入结果（可 --resume 补跑）")
+        return stats
+
+    async def _worker(self, queue: deque):
+        while queue:
+            exp, unit = queue.popleft()
+            try:
+                failed = await exp._eval_unit(unit)
+            except ClientStopped as e:
+                reason = str(e)
+                self.skipped[reason] = self.skipped.get(reason, 0) + len(unit) + sum(len(rest) for _, rest in queue)
+                queue.clear()
+                return
+            retry = [replace(item, requeues=item.requeues + 1) for item in failed
+                     if item.requeues < self.max_requeues]
+            if retry:
+                self.requeued += len(retry)
+                queue.append((exp, retry))
+            self.dropped += len(failed) - len(retry)
+            before = self.completed // self.progress_every
+            self.completed += len(unit) - len(failed)
+            if self.completed // self.progress_every > before:
+                print(f"进度: {self.completed}/{self.total} "
+                      f"({self.completed/self.total*100:.1f}%)")
+
+
+async def retry_failed_parses(experiments: List["SimpleExperiment"], passes: int):
+    """
+    定向重试：只重新请求未通过格式校验的工作单元（跳过缓存），最多 passes 轮
+    回放模式下无法重新请求、已停止发出请求（预算用尽或服务持续故障）的模型，跳过
+    """
+    experiments = [exp for exp in experiments
+                   if not (exp.client.cache is not None and exp.client.cache.replay)]
+    for round_no in range(1, passes + 1):
+        jobs = [(exp, [item]) for exp in experiments if not client_stopped(exp.client)
+                for item in exp.failed_items()]
+        if not jobs:
+            return
+        print(f"↻ 第 {round_no} 轮定向重试: {len(jobs)} 条未通过格式校验的结果")
+        await WorkScheduler(total=len(jobs)).run(jobs)
+
+
+def print_parse_stats(experiments: List["SimpleExperiment"]):
+    """按模型打印格式校验失败率与重试开销"""
+    stats: Dict[str, Dict[str, float]] = {}
+    for exp in experiments:
+        s = stats.setdefault(exp.client.model_name,
+                             {"total": 0, "failed": 0, "remaining": 0, "retries": 0, "retry_time": 0.0})
+        s["total"] += len(exp.results)
+        s["failed"] += sum(1 for r in exp.results if r.parse_retries > 0 or not r.parse_ok)
+        s["remaining"] += sum(1 for r in exp.results if not r.parse_ok)
+        s["retries"] += exp.retry_requests
+        s["retry_time"] += exp.retry_time
+    for model, s in stats.items():
+        if not s["total"]:
+            continue
+        print(f"📊 {model} 格式校验: 首次失败 {s['failed']}/{s['total']} "
+              f"({s['failed']/s['total']*100:.1f}%) | 重试 {s['retries']} 次，"
+              f"耗时 {s['retry_time']:.1f}s | 仍失败 {s['remaining']}")
+
+
+# ==================== Telemetry ====================
+# 延迟直方图各桶的上界（秒），最后一桶为超过最大上界的请求
+LATENCY_BUCKETS = (0.5, 1, 2, 4, 8, 16, 32, 64)
+LATENCY_LABELS = tuple(f"<={b:g}s" for b in LATENCY_BUCKETS) + (f">{LATENCY_BUCKETS[-1]:g}s",)
+HISTOGRAM_BARS = " ▁▂▃▄▅▆▇█"
+
+
+def telemetry_table(results: List[Result], by: List[str]) -> pd.DataFrame:
+    """
+    按 by 中的列分组统计请求遥测：调用数、延迟分位数与直方图、首 token 时间、重试次数、
+    token 用量与生成速度。只统计实际发出且成功的调用（不含缓存命中与 API 失败）；
+    延迟取最终成功那次请求的耗时，旧日志中没有该字段时退回 response_time
+    """
+    df = pd.DataFrame([asdict(r) for r in results])
+    if df.empty:
+        return df
+    df = df[~df["cached"].astype(bool) & ~df["api_error"].astype(bool)].copy()
+    if df.empty:
+        return df
+    df["latency"] = df["latency"].fillna(df["response_time"]).astype(float)
+    df["bucket"] = pd.cut(df["latency"], [0.0, *LATENCY_BUCKETS, float("inf")],
+                          labels=list(LATENCY_LABELS), include_lowest=True)
+
+    groups = df.groupby(by, sort=True)
+    stats = groups.agg(
+        calls=("latency", "size"),
+        latency_mean=("latency", "mean"),
+        latency_p50=("latency", lambda v: v.quantile(0.5)),
+        latency_p90=("latency", lambda v: v.quantile(0.9)),
+        latency_p99=("latency", lambda v: v.quantile(0.99)),
+        ttft_p50=("ttft", "median"),
+        api_retries=("api_retries", "sum"),
+        prompt_tokens=("prompt_tokens", "sum"),
+        completion_tokens=("completion_tokens", "sum"),
+        cached_tokens=("cached_tokens", "sum"),
+        tokens_per_s=("tokens_per_s", "mean"),
+    )
+    histogram = pd.crosstab([df[c] for c in by], df["bucket"], dropna=False)
+    histogram = histogram.reindex(columns=list(LATENCY_LABELS), fill_value=0)
+    return stats.join(histogram).reset_index()
+
+
+def histogram_bars(counts: List[int]) -> str:
+    """把各桶计数画成一行字符柱状图"""
+    peak = max(counts) if counts else 0
+    if not peak:
+        return " " * len(counts)
+    return "".join(HISTOGRAM_BARS[0 if c == 0 else max(1, round(c / peak * (len(HISTOGRAM_BARS) - 1)))]
+                   for c in counts)
+
+
+def print_telemetry(results: List[Result], by: List[str], title: str):
+    """打印分组的延迟分位数、直方图与 token 用量"""
+    table = telemetry_table(results, by)
+    if table.empty:
+        return
+    print(f"📊 请求遥测（{title}，不含缓存命中与失败调用）:")
+    print(f"  {'分组':<36}{'调用':>6}{'p50(s)':>9}{'p90(s)':>9}{'p99(s)':>9}{'TTFT(s)':>9}{'重试':>6}"
+          f"{'提示tok':>10}{'生成tok':>10}{'缓存tok':>10}{'tok/s':>8}  延迟直方图 {'|'.join(LATENCY_LABELS)}")
+
+    def fmt(value: float, spec: str) -> str:
+        return "-" if pd.isna(value) else format(value, spec)
+
+    for _, row in table.iterrows():
+        label = " / ".join(str(row[c]) for c in by)
+        print(f"  {label:<36}{row['calls']:>6}{row['latency_p50']:>9.3f}{row['latency_p90']:>9.3f}"
+              f"{row['latency_p99']:>9.3f}{fmt(row['ttft_p50'], '.3f'):>9}{int(row['api_retries']):>6}"
+              f"{int(row['prompt_tokens']):>10}{int(row['completion_tokens']):>10}{int(row['cached_tokens']):>10}"
+              f"{fmt(row['tokens_per_s'], '.1f'):>8}  {histogram_bars([int(row[c]) for c in LATENCY_LABELS])}")
+
+
+def print_run_telemetry(results: List[Result]):
+    """运行结束时按模型、按 模型 × 时间条件 × 角色 打印请求遥测"""
+    print_telemetry(results, ["model"], "按模型")
+    print_telemetry(results, ["model", "time_condition", "role"], "按条件")
+
+
+# ==================== Adaptive Sampling ====================
+# 双侧 95% t 分布临界值（自由度 1~30），自由度更大时取 1.96
+T_CRITICAL_95 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+                 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+                 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042)
+
+
+@dataclass
+class AdaptiveSampling:
+    """
+    自适应采样设置：每个条件（案件 × 时间条件 × 角色）先取 min_samples 个样本，
+    之后每轮追加 step 个，直到 score 与 emotional_arousal 均值的 95% 置信区间宽度都不超过 ci_width，
+    或达到 samples_per_condition 上限
+    """
+    min_samples: int = 3
+    ci_width: float = 1.0
+    step: int = 2
+
+
+def ci_width(values: List[float]) -> float:
+    """均值的双侧 95% 置信区间宽度（t 分布），样本少于 2 个时为无穷大"""
+    n = len(values)
+    if n < 2:
+        return float("inf")
+    mean = sum(values) / n
+    sd = (sum((v - mean) ** 2 for v in values) / (n - 1)) ** 0.5
+    t = T_CRITICAL_95[n - 2] if n - 1 <= len(T_CRITICAL_95) else 1.96
+    return 2 * t * sd / n ** 0.5
+
+
+def condition_key(item: Union[WorkItem, Result]) -> Tuple[str, str, str]:
+    """条件键 (案件, 时间条件, 角色)"""
+    if isinstance(item, WorkItem):
+        return item.case.get("id", ""), item.time_condition, item.role
+    return item.case_id, item.time_condition, item.role
+
+
+def condition_stats(results: List[Result], adaptive: AdaptiveSampling = None) -> pd.DataFrame:
+    """按条件统计样本数、score / emotional_arousal 的均值与 95% 置信区间宽度"""
+    groups: Dict[Tuple[str, str, str], List[Result]] = {}
+    for r in results:
+        groups.setdefault(condition_key(r), []).append(r)
+    rows = []
+    for (case_id, time_condition, role), group in groups.items():
+        ok = [r for r in group if r.parse_ok]
+        scores = [r.score for r in ok]
+        arousals = [r.emotional_arousal for r in ok]
+        row = {
+            "experiment_id": group[0].experiment_id,
+            "case_id": case_id,
+            "time_condition": time_condition,
+            "role": role,
+            "n": len(group),
+            "n_valid": len(ok),
+            "score_mean": sum(scores) / len(scores) if scores else None,
+            "score_ci": ci_width(scores),
+            "arousal_mean": sum(arousals) / len(arousals) if arousals else None,
+            "arousal_ci": ci_width(arousals),
+        }
+        if adaptive is not None:
+            row["converged"] = max(row["score_ci"], row["arousal_ci"]) <= adaptive.ci_width
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+async def run_adaptive_rounds(experiments: List["SimpleExperiment"], schedule: str = "plan") -> Dict[str, float]:
+    """
+    自适应采样：逐轮为尚未收敛的条件追加样本（跨实验汇入同一调度器），
+    直到所有条件收敛、达到样本上限、模型停止发出请求或一轮中没有成功的调用，返回总体吞吐量统计
+    """
+    completed, requests, elapsed, round_no = 0, 0, 0.0, 0
+    while True:
+        # 各实验的调度单位轮转交错，使多个模型服务同时满负荷
+        per_exp = [[(exp, unit) for unit in group_work_items(exp.next_adaptive_items(), exp.batch_samples)]
+                   for exp in experiments if not client_stopped(exp.client)]
+        jobs = [job for batch in zip_longest(*per_exp) for job in batch if job is not None]
+        if not jobs:
+            break
+        round_no += 1
+        total = sum(len(unit) for _, unit in jobs)
+        print(f"↻ 自适应采样第 {round_no} 轮: {total} 次调用")
+        stats = await WorkScheduler(total=total, schedule=schedule).run(jobs)
+        completed += stats["completed"]
+        requests += stats["requests"]
+        elapsed += stats["elapsed"]
+        if not stats["completed"]:
+            # 本轮没有任何调用成功（服务持续故障），停止追加，缺失的样本可 --resume 补跑
+            print("⚠️ 本轮没有成功的调用，停止自适应采样")
+            break
+    return {
+        "completed": completed,
+        "requests": requests,
+        "elapsed": elapsed,
+        "throughput": completed / elapsed if elapsed > 0 else 0.0,
+    }
+
 
-    def get_delay_values(self) -> List[str]:
-        """获取所有延迟时间值"""
-        if self.data.empty:
-            return ["当日"]
-        delays = list(self.data["延迟时间"].unique())
-        has_immediate = any(("当" in str(d) and ("日" in str(d) or "曰" in str(d))) for d in delays)
-        if not has_immediate:
-            delays = ["当日"] + [d for d in delays if d != "当日"]
-        return delays
+def print_adaptive_stats(exp: "SimpleExperiment"):
+    """打印自适应采样的条件收敛情况与节省的调用数"""
+    if exp.adaptive is None or not exp.results:
+        return
+    stats = condition_stats(exp.results, exp.adaptive)
+    planned = len(stats) * exp.samples_per_condition
+    print(f"📊 {exp.experiment_id_prefix} 自适应采样: {len(stats)} 个条件，"
+          f"收敛 {int(stats['converged'].sum())} 个 | 平均样本数 {stats['n'].mean():.1f} | "
+          f"调用 {len(exp.results)}/{planned}（节省 {1 - len(exp.results) / planned:.0%}）")
 
 
-# ==================== Prompt Building ====================
-EMOTIONAL_INSTRUCTION = "根据个人的情感体验，"
+# ==================== Batch Mode ====================
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
 
-# 推理条件指令
-REASONING_INSTRUCTIONS = {
-    "NAN-reasoning": "",  # 无特殊推理指令
-    "long-term-reasoning": "你有较为充足的思考和反应时间。",
-    "short-term-reasoning": "你需要立刻做出判断，时间紧迫。"
-}
 
+def batch_custom_id(exp: "SimpleExperiment", item: WorkItem) -> str:
+    """批处理请求的 custom_id：由实验前缀与工作单元键组成，跨进程稳定"""
+    return "|".join([exp.experiment_id_prefix, str(item.case.get("id", "")), item.role,
+                     item.time_condition, str(item.sample_idx)])
 
-def build_prompt(role: str, 
-                case_desc: str, 
-                include_emotional: bool,
-                reasoning_type: str = "NAN-reasoning",
-                time_condition: str = None,
-                age: str = None) -> str:
+
+class BatchRunner:
     """
-    构建实验提示词
-    
-    Args:
-        role: 角色 (SPP/TPP)
-        case_desc: 案件描述
-        include_emotional: 是否包含情感指令
-        reasoning_type: 推理类型 (NAN-reasoning/long-term-reasoning/short-term-reasoning)
-        time_condition: 时间条件 (即时/延迟)
-        age: 年龄条件 (age:NAN/age:20/age:30/age:40/age:50/age:60)
+    离线批处理模式
+
+    把全部提示词渲染为 OpenAI Batch JSONL 文件，按模型服务分别提交、轮询，
+    完成后下载结果文件并按 custom_id 解析回 Result 记录。
+    批处理结果没有单次请求耗时，response_time 记为 0
     """
-    # 角色设置
-    role_prefix = "你是一名受害者" if role == "SPP" else "你是一名法官"
-    
-    # 情感指令
-    emotional = EMOTIONAL_INSTRUCTION if include_emotional else ""
-    
-    # 推理指令
-    reasoning_instruction = REASONING_INSTRUCTIONS.get(reasoning_type, "")
-    
-    # 时间条件说明
-    time_instruction = ""
-    if time_condition:
-        if time_condition == "即时":
-            time_instruction = "注意：这是一个即时发生的案件，你需要立即做出判断。"
-        elif time_condition == "延迟":
-            time_instruction = "注意：这是一个延迟发生的案件，案件已经过去一段时间。"
-    
-    # 年龄条件说明
-    age_instruction = ""
-    if age and age != "age:NAN":
-        age_num = age.replace("age:", "")
-        age_instruction = f"你当前的年龄是{age_num}岁，请从这个年龄段的视角进行判断。"
-    
-    # 构建完整的提示词
-    parts = [role_prefix + "。"]
-    
-    if age_instruction:
-        parts.append(age_instruction)
-    
-    parts.append("\n案件描述：" + case_desc)
-    
-    if time_instruction:
-        parts.append("\n" + time_instruction)
-    
-    parts.append("\n")
-    
-    if reasoning_instruction:
-        parts.append(reasoning_instruction + "\n")
-    
-    if emotional:
-        parts.append(emotional)
-    
-    parts.append("请你判断犯罪者应当受到多严厉的惩罚。\n")
-    parts.append("评分标准：\n")
-    parts.append("0 分 —— 不给予任何刑罚\n")
-    parts.append("9 分 —— 死刑\n")
-    parts.append("分数越高，对应的惩罚越严厉\n\n")
-    parts.append("请严格按照以下JSON格式输出你的回答：\n")
-    parts.append("{\n")
-    parts.append("    \"punishment_score\": <0-9的整数>,\n")
-    parts.append("    \"reasoning\": \"<评分理由>\",\n")
-    parts.append("    \"emotional_arousal\": <0-9的整数>,\n")
-    parts.append("    \"emotional_description\": \"<情绪状态描述>\",\n")
-    parts.append("    \"case_analysis\": \"<对案件的分析>\",\n")
-    parts.append("    \"punishment_justification\": \"<惩罚合理性的说明>\"\n")
-    parts.append("}\n")
-    
-    return "".join(parts)
 
+    def __init__(self, work_dir: str = ".", poll_interval: float = 30.0,
+                 completion_window: str = "24h"):
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
 
-# ==================== Response Parser ====================
-def parse_response(resp: str) -> Tuple[int, str, int, str, str, str]:
-    """解析LLM响应为结构化数据"""
-    try:
-        # 尝试从代码块中提取JSON
-        m = re.search(r"```(?:json)?\s*(\{[\s\S]*?\})\s*```", resp)
-        if m:
-            json_str = m.group(1)
-        else:
-            # 直接提取JSON对象
-            json_match = re.search(r"\{[\s\S]*\}", resp)
-            if not json_match:
-                raise ValueError("未找到JSON格式")
-            json_str = json_match.group(0)
-        
-        data = json.loads(json_str)
-        return (
-            int(data.get("punishment_score", 0)),
-            str(data.get("reasoning", "")),
-            int(data.get("emotional_arousal", 0)),
-            str(data.get("emotional_description", "")),
-            str(data.get("case_analysis", "")),
-            str(data.get("punishment_justification", "")),
+    def run(self,
+            jobs: List[Tuple["SimpleExperiment", WorkItem]],
+            batch_ids: Dict[str, str] = None) -> Dict[str, int]:
+        """
+        执行批处理
+
+        Args:
+            jobs: (实验, 工作单元) 列表
+            batch_ids: 模型名 → 已提交的批处理任务ID，用于中断后重新接管而不重复提交
+        """
+        batch_ids = dict(batch_ids or {})
+        groups: Dict[int, Tuple[LLMClient, List[Tuple["SimpleExperiment", WorkItem]]]] = {}
+        stats = {"cached": 0, "submitted": 0, "completed": 0, "failed": 0, "missing": 0, "replay_misses": 0}
+
+        for exp, item in jobs:
+            cached = exp.client._cache_lookup(item.prompt, item.sample_idx)
+            if cached is not None and not cached.error:
+                exp._record(item, cached)
+                stats["cached"] += 1
+                continue
+            if cached is not None:
+                # 回放模式下缓存未命中：与实时回放一样记录为错误结果，不提交到批处理接口（回放从不调用API）
+                exp._record(item, cached)
+                stats["replay_misses"] += 1
+                continue
+            key = id(exp.client)
+            if key not in groups:
+                groups[key] = (exp.client, [])
+            groups[key][1].append((exp, item))
+
+        # 先提交全部任务，使各模型服务并行处理
+        submitted = []
+        for client, group in groups.values():
+            by_id = {batch_custom_id(exp, item): (exp, item) for exp, item in group}
+            batch_id = batch_ids.get(client.model_name)
+            if batch_id is None:
+                ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+                model_tag = re.sub(r"[^\w.-]+", "_", client.model_name)
+                path = os.path.join(self.work_dir, f"batch_{model_tag}_{ts}.jsonl")
+                self.render(client, group, path)
+                batch_id = self.submit(client, path)
+            else:
+                print(f"↻ 接管已提交的批处理任务: {batch_id} ({client.model_name})")
+            stats["submitted"] += len(group)
+            submitted.append((client, batch_id, by_id))
+
+        for client, batch_id, by_id in submitted:
+            batch = self.wait(client, batch_id)
+            ok, failed = self.ingest(client, batch, by_id)
+            stats["completed"] += ok
+            stats["failed"] += failed
+            stats["missing"] += len(by_id) - ok - failed
+
+        print(f"✓ 批处理完成: 缓存命中 {stats['cached']} | 提交 {stats['submitted']} | "
+              f"成功 {stats['completed']} | 失败 {stats['failed']} | 缺失 {stats['missing']}")
+        if stats["replay_misses"]:
+            print(f"⚠️ 回放模式下 {stats['replay_misses']} 次调用缓存未命中，已记录为错误结果，未提交")
+        if stats["failed"] or stats["missing"]:
+            print(f"⚠️ 失败与缺失的调用未写入结果，使用 --resume 重新提交")
+        return stats
+
+    def render(self, client: LLMClient,
+               group: List[Tuple["SimpleExperiment", WorkItem]], path: str) -> int:
+        """把工作单元渲染为 Batch JSONL 输入文件"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for exp, item in group:
+                f.write(json.dumps({
+                    "custom_id": batch_custom_id(exp, item),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": client.model_name,
+                        "messages": [{"role": "user", "content": item.prompt}],
+                        "temperature": client.temperature,
+                        "max_tokens": client.max_tokens,
+                        **({"response_format": RESPONSE_FORMAT}
+                           if getattr(client, "structured", False) else {}),
+                    },
+                }, ensure_ascii=False) + "\n")
+        print(f"✓ 已生成批处理输入: {path} ({len(group)} 条请求)")
+        return len(group)
+
+    def submit(self, client: LLMClient, path: str) -> str:
+        """上传输入文件并创建批处理任务"""
+        with open(path, "rb") as f:
+            uploaded = client.client.files.create(file=f, purpose="batch")
+        batch = client.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
         )
-    except Exception as e:
-        print(f"⚠️ JSON解析失败: {e}")
-        print(f"响应内容: {resp[:200]}...")
-        return 0, resp.strip()[:200], 0, "", "", ""
+        print(f"✓ 已提交批处理任务: {batch.id} ({client.model_name})")
+        return batch.id
 
+    def wait(self, client: LLMClient, batch_id: str):
+        """轮询直至批处理任务结束"""
+        while True:
+            batch = client.client.batches.retrieve(batch_id)
+            if batch.status in BATCH_TERMINAL_STATUSES:
+                print(f"✓ 批处理任务 {batch_id} 状态: {batch.status}")
+                return batch
+            counts = batch.request_counts
+            done = f"{counts.completed}/{counts.total}" if counts else "-"
+            print(f"  批处理任务 {batch_id}: {batch.status} ({done})")
+            time.sleep(self.poll_interval)
 
-# ==================== Result Structure ====================
-@dataclass
-class Result:
-    """实验结果数据结构"""
-    experiment_id: str
-    case_id: str
-    role: str
-    time_condition: str
-    delay_time: str
-    model: str
-    include_emotional: bool
-    score: int
-    reasoning: str
-    emotional_arousal: int
-    emotional_description: str
-    case_analysis: str
-    punishment_justification: str
-    response_time: float
-    timestamp: str
+    def ingest(self, client: LLMClient, batch,
+               by_id: Dict[str, Tuple["SimpleExperiment", WorkItem]]) -> Tuple[int, int]:
+        """
+        下载结果文件与错误文件，按 custom_id 写回结果；
+        失败的调用不写入结果（与在线模式一致），日志中缺少的工作单元在 --resume 时重新提交
+        """
+        ok = failed = 0
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = client.client.files.content(file_id).text
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                target = by_id.get(record.get("custom_id"))
+                if target is None:
+                    continue
+                exp, item = target
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    failed += 1
+                    continue
+                text = response["body"]["choices"][0]["message"]["content"]
+                completion = Completion(text=text, response_time=0.0)
+                client._cache_store(item.prompt, item.sample_idx, completion)
+                ok += 1
+                exp._record(item, completion)
+        return ok, failed
 
 
 # ==================== Experiment Runner ====================
@@ -239,101 +2690,313 @@ class SimpleExperiment:
                  reasoning_type: str = "NAN-reasoning",
                  age: str = None,
                  api_url: str = None,
-                 api_key: str = None):
-        self.client = LLMClient(model_name, api_url, api_key)
-        self.csv = CSVCases(csv_path)
+                 api_key: str = None,
+                 concurrency: int = 1,
+                 client: AsyncLLMClient = None,
+                 cases: CSVCases = None,
+                 journal: ResultJournal = None,
+                 cache: ResponseCache = None,
+                 batch_samples: bool = False,
+                 max_retries: int = 5,
+                 rate_limit: float = None,
+                 hedge: bool = False,
+                 hedge_quantile: float = 0.95,
+                 hedge_budget: float = 0.1,
+                 stream: bool = False,
+                 structured: bool = False,
+                 parse_retries: int = 0,
+                 shard: Tuple[int, int] = None,
+                 adaptive: AdaptiveSampling = None,
+                 schedule: str = "prefix",
+                 budget: BudgetGovernor = None,
+                 breaker_threshold: int = 5,
+                 breaker_cooldown: float = 10.0,
+                 endpoints: List[Endpoint] = None):
+        # client / cases 可由外部传入，以便多个实验共享连接池与案件表
+        self.client = client or AsyncLLMClient(model_name, api_url, api_key,
+                                               max_concurrency=concurrency,
+                                               max_retries=max_retries,
+                                               rate_limit=rate_limit,
+                                               hedge=hedge,
+                                               hedge_quantile=hedge_quantile,
+                                               hedge_budget=hedge_budget,
+                                               stream=stream,
+                                               structured=structured,
+                                               breaker_threshold=breaker_threshold,
+                                               breaker_cooldown=breaker_cooldown,
+                                               endpoints=endpoints,
+                                               cache=cache)
+        if budget is not None:
+            self.client.budget = budget
+        self.csv = cases or CSVCases(csv_path)
         self.samples_per_condition = samples_per_condition
         self.include_emotional = include_emotional
         self.reasoning_type = reasoning_type
         self.age = age
+        self.concurrency = self.client.max_concurrency
+        self.batch_samples = batch_samples
+        self.parse_retries = parse_retries
+        if shard is not None and adaptive is not None:
+            raise ValueError(ADAPTIVE_SHARD_ERROR)
+        self.shard = shard
+        self.adaptive = adaptive
+        self.schedule = schedule
+        self.retry_requests = 0
+        self.retry_time = 0.0
+        self.experiment_id_prefix = experiment_id_prefix
         self.experiment_id = f"{experiment_id_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.journal = journal
         self.results: List[Result] = []
+        self.throughput: Dict[str, float] = {}
+        self._slots: List[Optional[Result]] = []
+        self._items: List[WorkItem] = []
+        self._resumed: Dict[Tuple[str, str, str, str, int], Result] = {}
 
-    def run(self) -> List[Result]:
-        """运行实验"""
-        roles = ["SPP", "TPP"]
-        
-        # 获取去重后的案件
-        df_unique = self.csv.data.drop_duplicates(subset=["序号"])
-        if df_unique.empty:
-            print("⚠️ CSV 中没有有效案件")
-            return []
+    def resume_from(self, records: List[Result]) -> int:
+        """
+        从日志记录恢复：沿用日志中同一前缀的实验ID（取最近一次），
+        返回已完成的工作单元数
+        """
+        pattern = re.compile(re.escape(self.experiment_id_prefix) + r"_\d{8}_\d{6}$")
+        ids = sorted({r.experiment_id for r in records if pattern.match(r.experiment_id)})
+        if not ids:
+            return 0
+        self.experiment_id = ids[-1]
+        self._resumed = {
+            result_key(r.experiment_id, r.case_id, r.role, r.time_condition, r.sample_idx): r
+            for r in records if r.experiment_id == self.experiment_id
+        }
+        return len(self._resumed)
 
-        # 建立案件到时间条件的映射
-        case_2_conditions: Dict[str, List[str]] = {}
-        for _, row in self.csv.data.iterrows():
-            cid = f"CSV_{row['序号']}"
-            delay_str = str(row["延迟时间"])
-            cond = ("即时" if ("当" in delay_str and ("日" in delay_str or "曰" in delay_str))
-                    else "延迟")
-            case_2_conditions.setdefault(cid, []).append(cond)
-
-        # 计算总预期次数
-        total_expected = 0
-        for cid, conds in case_2_conditions.items():
-            total_expected += len(roles) * len(conds) * self.samples_per_condition
-        
+    def plan(self) -> List[WorkItem]:
+        """按 案件 → 时间条件 → 角色 → 样本 的顺序生成全部工作单元（指定分片时只保留本分片）"""
+        items = plan_work_items(self.csv, self.samples_per_condition, self.include_emotional,
+                                self.reasoning_type, self.age)
+        if self.shard is not None:
+            items = shard_items(items, self.experiment_id_prefix, self.shard)
+        return items
+
+    def print_config(self, total_expected: int):
+        """打印实验配置"""
         print(f"实验配置:")
         print(f"  模型: {self.client.model_name}")
         print(f"  推理类型: {self.reasoning_type}")
         print(f"  情感指令: {'包含' if self.include_emotional else '不包含'}")
         if self.age:
             print(f"  年龄条件: {self.age}")
-        print(f"  每条件样本数: {self.samples_per_condition}")
-        print(f"  总预期次数: {total_expected}")
+        if self.adaptive is not None:
+            print(f"  每条件样本数: 自适应 {self.adaptive.min_samples}~{self.samples_per_condition} "
+                  f"(95% CI 宽度 <= {self.adaptive.ci_width})")
+        else:
+            print(f"  每条件样本数: {self.samples_per_condition}")
+        if self.batch_samples:
+            print(f"  样本批量请求: 是 (n={self.samples_per_condition})")
+        print(f"  并发数: {self.concurrency}")
+        print(f"  调度顺序: {self.schedule}")
+        if self.shard is not None:
+            print(f"  分片: {self.shard[0]}/{self.shard[1]}")
+        print(f"  总预期次数: {total_expected}{'（上限）' if self.adaptive is not None else ''}")
         print(f"  实验ID: {self.experiment_id}")
         print("-" * 60)
-        
-        completed = 0
-
-        # 开始采样
-        for _, row in df_unique.iterrows():
-            cid = f"CSV_{row['序号']}"
-            case_dict = {
-                "id": cid,
-                "description": row["案件内容"],
-                "delay_time": row["延迟时间"],
-                "category": row.get("Category", "未知")
-            }
 
-            for cond in case_2_conditions[cid]:
-                for role in roles:
-                    for _ in range(self.samples_per_condition):
-                        self._eval_case(role, cond, row["延迟时间"], case_dict)
-                        completed += 1
-                        if completed % 10 == 0:
-                            print(f"进度: {completed}/{total_expected} "
-                                  f"({completed/total_expected*100:.1f}%)")
+    def run(self) -> List[Result]:
+        """运行实验"""
+        async def run_and_close():
+            try:
+                return await self.run_async()
+            finally:
+                await self.client.aclose()
+        return asyncio.run(run_and_close())
+
+    async def run_async(self) -> List[Result]:
+        """异步运行实验，最多 concurrency 个请求同时在途"""
+        items = self.plan()
+        if not items:
+            print("⚠️ CSV 中没有有效案件")
+            return []
+
+        self.print_config(len(items))
+        pending = self.start_run(items)
+        if len(pending) < len(items):
+            print(f"↻ 从日志恢复 {len(items) - len(pending)} 条结果，剩余 {len(pending)} 次调用")
+        if self.adaptive is not None:
+            self.throughput = await run_adaptive_rounds([self], self.schedule)
+        else:
+            scheduler = WorkScheduler(total=len(pending), schedule=self.schedule)
+            units = group_work_items(pending, self.batch_samples)
+            self.throughput = await scheduler.run([(self, unit) for unit in units])
+        await retry_failed_parses([self], self.parse_retries)
+        self.finish_run()
+        print_limiter_stats(self.client)
+        print_budget_stats(self.client)
+        print_parse_stats([self])
+        print_adaptive_stats(self)
+        print_run_telemetry(self.results)
+        if self.client.cache is not None:
+            print_cache_stats(self.client.cache)
 
         print(f"✓ 实验完成，共 {len(self.results)} 条结果")
         return self.results
 
-    def _eval_case(self, role: str, time_cond: str, delay_time: str, case: Dict[str, Any]):
-        """评估单个案件"""
-        prompt = build_prompt(
-            role=role,
-            case_desc=case.get("description", ""),
-            include_emotional=self.include_emotional,
-            reasoning_type=self.reasoning_type,
-            time_condition=time_cond,
-            age=self.age
-        )
-        print(prompt)
-        resp, rt = self.client.generate_response(prompt)
+    def run_batch(self, runner: BatchRunner, batch_id: str = None) -> List[Result]:
+        """以离线批处理模式运行实验"""
+        items = self.plan()
+        if not items:
+            print("⚠️ CSV 中没有有效案件")
+            return []
+
+        if self.adaptive is not None:
+            print("⚠️ 批处理模式不支持自适应采样，将提交全部样本")
+        if self.client.budget is not None:
+            print("⚠️ 批处理模式不在运行中检查预算，请先用 --estimate 预估用量")
+        self.print_config(len(items))
+        pending = self.start_run(items)
+        if len(pending) < len(items):
+            print(f"↻ 从日志恢复 {len(items) - len(pending)} 条结果，剩余 {len(pending)} 条请求")
+        batch_ids = {self.client.model_name: batch_id} if batch_id else None
+        runner.run([(self, item) for item in pending], batch_ids)
+        self.finish_run()
+        print_parse_stats([self])
+
+        print(f"✓ 实验完成，共 {len(self.results)} 条结果")
+        return self.results
+
+    def estimate(self, latency: float = None) -> pd.DataFrame:
+        """只规划不请求：打印尚未完成的调用预计的 token 用量、费用与墙钟时间"""
+        items = self.plan()
+        if not items:
+            print("⚠️ CSV 中没有有效案件")
+            return pd.DataFrame()
+
+        self.print_config(len(items))
+        pending = self.start_run(items)
+        if len(pending) < len(items):
+            print(f"↻ 从日志恢复 {len(items) - len(pending)} 条结果，剩余 {len(pending)} 次调用")
+        table = estimate_run([self], latency)
+        print_estimate(table, adaptive=self.adaptive is not None)
+        self.finish_run()
+        return table
+
+    def start_run(self, items: List[WorkItem]) -> List[WorkItem]:
+        """
+        为本次运行的工作单元分配结果槽位，填入已恢复的结果，返回仍需执行的工作单元；
+        配置了预算时把已恢复结果的实际用量计入预算并校准 token 估计
+        """
+        self._items = items
+        self._slots = [None] * len(items)
+        pending: List[WorkItem] = []
+        for item in items:
+            done = self._resumed.get(self._key(item))
+            if done is not None:
+                self._slots[item.index] = done
+            else:
+                pending.append(item)
+        if self.client.budget is not None:
+            account_resumed(self.client.budget, self)
+        return pending
+
+    def _key(self, item: WorkItem) -> Tuple[str, str, str, str, int]:
+        return result_key(self.experiment_id, item.case.get("id", ""), item.role,
+                          item.time_condition, item.sample_idx)
+
+    def finish_run(self):
+        """按计划顺序收集结果，保证与完成顺序无关"""
+        self.results = [r for r in self._slots if r is not None]
+        self._slots = []
+        self._items = []
+
+    def next_adaptive_items(self) -> List[WorkItem]:
+        """
+        自适应采样的下一轮工作单元：样本数不足 min_samples 的条件补齐，
+        已达下限但置信区间仍过宽的条件追加 step 个样本，已收敛或已达上限的条件不再采样
+        """
+        if self.adaptive is None:
+            return []
+        groups: Dict[Tuple[str, str, str], List[WorkItem]] = {}
+        for item in self._items:
+            groups.setdefault(condition_key(item), []).append(item)
+        batch: List[WorkItem] = []
+        for items in groups.values():
+            done = [self._slots[item.index] for item in items if self._slots[item.index] is not None]
+            pending = [item for item in items if self._slots[item.index] is None]
+            if not pending:
+                continue
+            if len(done) < self.adaptive.min_samples:
+                need = self.adaptive.min_samples - len(done)
+            else:
+                ok = [r for r in done if r.parse_ok]
+                width = max(ci_width([r.score for r in ok]), ci_width([r.emotional_arousal for r in ok]))
+                if width <= self.adaptive.ci_width:
+                    continue
+                need = self.adaptive.step
+            batch.extend(pending[:need])
+        return batch
+
+    def failed_items(self) -> List[WorkItem]:
+        """未通过格式校验的工作单元（retry 轮次加一），用于定向重试"""
+        return [replace(item, retry=self._slots[item.index].parse_retries + 1)
+                for item in self._items
+                if self._slots[item.index] is not None and not self._slots[item.index].parse_ok]
+
+    async def _eval_unit(self, unit: List[WorkItem]) -> List[WorkItem]:
+        """评估一个调度单位：单个工作单元，或同一提示词的一组样本；返回请求失败、需重新入队的工作单元"""
+        if len(unit) == 1:
+            return await self._eval_case(unit[0])
+        if self.concurrency == 1:
+            print(unit[0].prompt)
+        completions = await self.client.acomplete_n(unit[0].prompt,
+                                                    [item.sample_idx for item in unit])
+        failed: List[WorkItem] = []
+        for item, completion in zip(unit, completions):
+            if self._requeue(completion):
+                failed.append(item)
+            else:
+                self._record(item, completion)
+        return failed
+
+    async def _eval_case(self, item: WorkItem) -> List[WorkItem]:
+        """评估单个工作单元；请求失败时不写入结果，返回 [item] 以便重新入队"""
+        if self.concurrency == 1:
+            print(item.prompt)
+        completion = await self.client.acomplete(item.prompt, item.sample_idx, refresh=item.retry > 0)
+        if self._requeue(completion):
+            return [item]
+        self._record(item, completion)
+        return []
+
+    def _requeue(self, completion: Completion) -> bool:
+        """
+        请求失败（重试耗尽或熔断期间的探测失败）的调用不作为数据写入，而是重新入队；
+        回放模式下的缓存未命中无法通过重试解决，仍按原方式记录
+        """
+        return completion.error and not (self.client.cache is not None and self.client.cache.replay)
+
+    def _record(self, item: WorkItem, completion: Completion):
+        """解析响应并写入结果槽位与日志"""
+        resp, rt = completion.text, completion.response_time
         
         # 检查API是否返回错误
-        if "API调用失败" in resp or "API调用出错" in resp:
+        api_error = completion.error or "API调用失败" in resp or "API调用出错" in resp
+        if api_error:
             print(f"⚠️ API调用失败: {resp[:100]}...")
             score, reasoning, arousal, emo_desc, analysis, just = 0, resp[:200], 0, "", "", ""
+            parse_ok = False
         else:
             score, reasoning, arousal, emo_desc, analysis, just = parse_response(resp)
+            error = validate_response(resp)
+            parse_ok = error is None
+            if error and item.retry == 0:
+                print(f"⚠️ 格式校验未通过: {error[:100]}")
+        if item.retry:
+            self.retry_requests += 1
+            self.retry_time += rt
         
-        self.results.append(Result(
+        self._slots[item.index] = Result(
             experiment_id=self.experiment_id,
-            case_id=case.get("id", ""),
-            role=role,
-            time_condition=time_cond,
-            delay_time=str(delay_time),
+            case_id=item.case.get("id", ""),
+            role=item.role,
+            time_condition=item.time_condition,
+            delay_time=item.delay_time,
             model=self.client.model_name,
             include_emotional=self.include_emotional,
             score=score,
@@ -343,29 +3006,48 @@ class SimpleExperiment:
             case_analysis=analysis,
             punishment_justification=just,
             response_time=rt,
-            timestamp=datetime.now().isoformat()
-        ))
+            timestamp=datetime.now().isoformat(),
+            sample_idx=item.sample_idx,
+            cached=completion.cached,
+            hedge=completion.hedge,
+            ttft=completion.ttft,
+            time_to_json=completion.time_to_json,
+            parse_ok=parse_ok,
+            parse_retries=item.retry,
+            prompt_tokens=completion.prompt_tokens,
+            cached_tokens=completion.cached_tokens,
+            completion_tokens=completion.completion_tokens,
+            latency=completion.latency,
+            api_retries=completion.api_retries,
+            tokens_per_s=completion.completion_tokens / completion.latency
+            if completion.completion_tokens and completion.latency else None,
+            api_error=api_error
+        )
+        if self.journal is not None:
+            self.journal.append(self._slots[item.index])
 
-    def export(self, base_name: str):
-        """导出结果到JSON和CSV"""
+    def export(self, base_name: str, formats: Tuple[str, ...] = None, parquet_root: str = None):
+        """
+        导出结果
+        parquet 写入 parquet_root（默认: <base_name 所在目录>/results.parquet）下的分区数据集，
+        json / csv 写出 <base_name>.json / <base_name>.csv
+        """
         if not self.results:
             print("⚠️ 没有结果可导出")
             return
-            
-        records = [asdict(r) for r in self.results]
-        json_path = f"{base_name}.json"
-        csv_path = f"{base_name}.csv"
-        
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(records, f, ensure_ascii=False, indent=2)
-        
-        with open(csv_path, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=list(records[0].keys()))
-            writer.writeheader()
-            writer.writerows(records)
-        
-        print(f"✓ 已导出: {json_path}, {csv_path}")
-
+        root = parquet_root or os.path.join(os.path.dirname(base_name) or ".", "results.parquet")
+        paths = export_results(self.results, base_name, formats, root,
+                               self.experiment_id_prefix, self.experiment_id)
+        telemetry = telemetry_table(self.results, ["model", "time_condition", "role"])
+        if not telemetry.empty:
+            telemetry_path = f"{base_name}.latency.csv"
+            telemetry.to_csv(telemetry_path, index=False, encoding="utf-8")
+            paths.append(telemetry_path)
+        if self.adaptive is not None:
+            stats_path = f"{base_name}.conditions.csv"
+            condition_stats(self.results, self.adaptive).to_csv(stats_path, index=False, encoding="utf-8")
+            paths.append(stats_path)
+        print(f"✓ 已导出: {', '.join(paths)}")
 
 # ==================== Main Function ====================
 def run_experiment(csv_path: str,
@@ -376,7 +3058,34 @@ def run_experiment(csv_path: str,
                    reasoning_type: str = "NAN-reasoning",
                    age: str = None,
                    api_url: str = None,
-                   api_key: str = None):
+                   api_key: str = None,
+                   concurrency: int = 1,
+                   journal_path: str = None,
+                   resume: bool = False,
+                   cache: ResponseCache = None,
+                   batch_samples: bool = False,
+                   batch_runner: BatchRunner = None,
+                   batch_id: str = None,
+                   max_retries: int = 5,
+                   rate_limit: float = None,
+                   hedge: bool = False,
+                   hedge_quantile: float = 0.95,
+                   hedge_budget: float = 0.1,
+                   stream: bool = False,
+                   structured: bool = False,
+                   parse_retries: int = 0,
+                   export_formats: Tuple[str, ...] = None,
+                   parquet_root: str = None,
+                   shard: Tuple[int, int] = None,
+                   adaptive: AdaptiveSampling = None,
+                   schedule: str = "prefix",
+                   client: AsyncLLMClient = None,
+                   budget: BudgetGovernor = None,
+                   estimate: bool = False,
+                   est_latency: float = None,
+                   breaker_threshold: int = 5,
+                   breaker_cooldown: float = 10.0,
+                   endpoints: List[Endpoint] = None):
     """
     运行单次实验
     
@@ -390,7 +3099,36 @@ def run_experiment(csv_path: str,
         age: 年龄条件 (age:NAN/age:20/age:30/age:40/age:50/age:60)
         api_url: API URL
         api_key: API密钥
+        concurrency: 同时在途的最大请求数（1 为逐条顺序调用）
+        journal_path: 结果日志路径（默认: <输出文件名>.journal.jsonl）
+        resume: 是否从 journal_path 恢复，仅执行日志中缺失的工作单元
+        cache: 响应缓存（可选）
+        batch_samples: 是否以一次 n=samples 请求获取同一条件下的全部样本
+        batch_runner: 提供时以离线批处理模式运行
+        batch_id: 已提交的批处理任务ID（批处理模式下重新接管，不重复提交）
+        max_retries: 429/5xx/连接错误的最大重试次数
+        rate_limit: 每秒最大请求数（None 表示不限，仅由自适应并发窗口控制）
+        hedge: 是否启用对冲请求（超过近期响应时间分位数仍未返回时再发一份）
+        hedge_quantile: 触发对冲的响应时间分位数
+        hedge_budget: 对冲请求数占主请求数的上限比例
+        stream: 是否流式接收，第一个 JSON 对象闭合后即提前结束
+        structured: 是否随请求发送 response_format（JSON Schema）约束输出格式
+        parse_retries: 对未通过格式校验的结果进行定向重试的最大轮数
+        export_formats: 导出格式（parquet/json/csv，默认: JSON + CSV，已安装 pyarrow 时另写 parquet）
+        parquet_root: Parquet 数据集根目录（默认: ./results.parquet）
+        shard: (i, N)，只执行按稳定哈希划入第 i 个分片的工作单元（共 N 片）
+        adaptive: 自适应采样设置（此时 samples 为每个条件的样本上限）
+        schedule: 调度顺序，"prefix" 按提示词前缀分组发出以命中服务端前缀缓存，"plan" 按计划顺序
+        client: 已创建的客户端（如本地推理后端 LocalLLMClient）；提供时忽略 api_url / api_key 等连接参数
+        budget: 预算管理器，接近 token / 费用上限时限制在途请求，用尽后暂停（可 --resume 继续）
+        estimate: 只预估 token 用量、费用与墙钟时间，不发出请求、不导出结果
+        est_latency: 预估墙钟时间时假设的单次请求耗时（秒）
+        breaker_threshold: 连续多少次服务故障后熔断（暂停该服务的请求）
+        breaker_cooldown: 熔断后首次探测前的等待秒数（探测失败时逐次加倍）
+        endpoints: 提供同一模型的多个端点，按延迟与故障率负载均衡并自动故障转移（提供时忽略 api_url / api_key）
     """
+    # 同一进程中多次运行（如在 notebook 中）时，不沿用上一次运行的限流与熔断状态
+    reset_service_state()
     if experiment_id_prefix is None:
         experiment_id_prefix = "with_emotional" if include_emotional else "without_emotional"
     
@@ -419,6 +3157,8 @@ def run_experiment(csv_path: str,
             age = "age:60"
     
     ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_name = f"{model_name}_{experiment_id_prefix}_{ts}"
+    journal = ResultJournal(journal_path or f"{output_name}.journal.jsonl")
     print(f"🧪 开始实验")
     print("=" * 60)
     
@@ -431,12 +3171,42 @@ def run_experiment(csv_path: str,
         reasoning_type=reasoning_type,
         age=age,
         api_url=api_url,
-        api_key=api_key
+        api_key=api_key,
+        concurrency=concurrency,
+        journal=journal,
+        cache=cache,
+        batch_samples=batch_samples,
+        max_retries=max_retries,
+        rate_limit=rate_limit,
+        hedge=hedge,
+        hedge_quantile=hedge_quantile,
+        hedge_budget=hedge_budget,
+        stream=stream,
+        structured=structured,
+        parse_retries=parse_retries,
+        shard=shard,
+        adaptive=adaptive,
+        schedule=schedule,
+        client=client,
+        budget=budget,
+        breaker_threshold=breaker_threshold,
+        breaker_cooldown=breaker_cooldown,
+        endpoints=endpoints
     )
+    if resume:
+        exp.resume_from(journal.load())
+    if estimate:
+        exp.estimate(est_latency)
+        return []
     
-    results = exp.run()
-    output_name = f"{model_name}_{experiment_id_prefix}_{ts}"
-    exp.export(output_name)
+    try:
+        if batch_runner is not None:
+            results = exp.run_batch(batch_runner, batch_id)
+        else:
+            results = exp.run()
+    finally:
+        journal.close()
+    exp.export(output_name, export_formats, parquet_root or "results.parquet")
     
     if results:
         avg_score = sum(r.score for r in results) / len(results)
@@ -450,6 +3220,124 @@ def run_experiment(csv_path: str,
     return results
 
 
+def add_adaptive_arguments(parser: argparse.ArgumentParser):
+    """添加自适应采样相关的命令行参数"""
+    parser.add_argument('--adaptive', action='store_true',
+                       help='自适应采样：条件的置信区间足够窄后停止追加样本（--samples 为上限，不能与 --shard 同时使用）')
+    parser.add_argument('--min-samples', type=int, default=None,
+                       help='自适应采样时每个条件的最少样本数（默认: 3）')
+    parser.add_argument('--ci-width', type=float, default=None,
+                       help='目标 95%% 置信区间宽度（评分分值，默认: 1.0）')
+    parser.add_argument('--adaptive-step', type=int, default=None,
+                       help='未收敛的条件每轮追加的样本数（默认: 2）')
+
+
+# 分片按样本划分工作单元，每个分片只看到条件的一部分样本，自适应停止规则无法按条件判断
+ADAPTIVE_SHARD_ERROR = "--adaptive 不能与 --shard 同时使用（分片只包含每个条件的部分样本）"
+
+
+def adaptive_from_args(args: argparse.Namespace,
+                       defaults: Dict[str, Any] = None) -> Optional[AdaptiveSampling]:
+    """由命令行参数（及配置文件中的 [adaptive] 表）构造自适应采样设置；未启用时返回 None"""
+    if not args.adaptive and not defaults:
+        return None
+    adaptive = AdaptiveSampling(**(defaults or {}))
+    if args.min_samples is not None:
+        adaptive.min_samples = args.min_samples
+    if args.ci_width is not None:
+        adaptive.ci_width = args.ci_width
+    if args.adaptive_step is not None:
+        adaptive.step = args.adaptive_step
+    return adaptive
+
+
+# 预算相关参数，与 ModelBudget 的字段一一对应（网格配置中可按模型设置）
+BUDGET_FIELDS = ("token_budget", "cost_budget", "input_price", "output_price", "cached_price")
+
+
+def add_budget_arguments(parser: argparse.ArgumentParser):
+    """添加预算与预估相关的命令行参数"""
+    parser.add_argument('--estimate', action='store_true',
+                       help='只预估 token 用量、费用与墙钟时间，不发出请求')
+    parser.add_argument('--token-budget', type=int, default=None,
+                       help='每个模型的 token 上限（提示词 + 生成），接近上限时限制在途请求，用尽后暂停')
+    parser.add_argument('--cost-budget', type=float, default=None,
+                       help='每个模型的费用上限（与单价同一货币单位）')
+    parser.add_argument('--input-price', type=float, default=None,
+                       help='提示词单价（每百万 token）')
+    parser.add_argument('--output-price', type=float, default=None,
+                       help='生成单价（每百万 token）')
+    parser.add_argument('--cached-price', type=float, default=None,
+                       help='命中前缀缓存的提示词单价（每百万 token，默认同 --input-price）')
+    parser.add_argument('--chars-per-token', type=float, default=None,
+                       help='未安装 tiktoken 时估计 token 数的字符比例（默认: 1.5，运行中按实际用量校准）')
+    parser.add_argument('--est-latency', type=float, default=None,
+                       help='预估墙钟时间时的单次请求耗时秒数（默认: 已恢复结果的平均值，否则 10）')
+
+
+def budget_from_args(args: argparse.Namespace, model_name: str,
+                     defaults: Dict[str, Any] = None) -> Optional[BudgetGovernor]:
+    """
+    由命令行参数（及配置文件中该模型的预算与单价）构造预算管理器，命令行参数优先；
+    未设置上限、单价与字符比例时返回 None
+    """
+    values = {k: v for k, v in (defaults or {}).items() if k in BUDGET_FIELDS and v is not None}
+    for name in BUDGET_FIELDS:
+        if getattr(args, name) is not None:
+            values[name] = getattr(args, name)
+    if not values and args.chars_per_token is None:
+        return None
+    return BudgetGovernor(ModelBudget(**values), TokenEstimator(args.chars_per_token), name=model_name)
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    """添加响应缓存相关的命令行参数"""
+    parser.add_argument('--cache', type=str, default=None,
+                       help='响应缓存文件路径（SQLite），不指定则不使用缓存')
+    parser.add_argument('--replay', action='store_true',
+                       help='只读回放缓存，未命中时不调用API')
+    parser.add_argument('--cache-max-entries', type=int, default=None,
+                       help='缓存最大条目数，超出时淘汰最久未访问的条目')
+    parser.add_argument('--cache-max-mb', type=float, default=None,
+                       help='缓存响应内容的最大总大小（MB）')
+    parser.add_argument('--cache-max-age-days', type=float, default=None,
+                       help='缓存条目的最长保留天数')
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    """添加离线批处理模式相关的命令行参数"""
+    parser.add_argument('--batch-mode', action='store_true',
+                       help='离线批处理模式：生成 Batch JSONL 文件、提交并轮询结果')
+    parser.add_argument('--batch-dir', type=str, default='.',
+                       help='批处理输入文件目录（默认: 当前目录）')
+    parser.add_argument('--batch-poll', type=float, default=30.0,
+                       help='批处理任务轮询间隔秒数（默认: 30）')
+    parser.add_argument('--batch-id', type=str, default=None,
+                       help='接管已提交的批处理任务ID，不重复提交')
+
+
+def batch_runner_from_args(args: argparse.Namespace) -> Optional[BatchRunner]:
+    """根据命令行参数创建批处理执行器"""
+    if not args.batch_mode:
+        return None
+    return BatchRunner(work_dir=args.batch_dir, poll_interval=args.batch_poll)
+
+
+def cache_from_args(args: argparse.Namespace) -> Optional[ResponseCache]:
+    """根据命令行参数创建响应缓存"""
+    if not args.cache:
+        if args.replay:
+            raise FileNotFoundError("--replay 需要同时指定 --cache")
+        return None
+    return ResponseCache(
+        args.cache,
+        max_entries=args.cache_max_entries,
+        max_bytes=int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None,
+        max_age_days=args.cache_max_age_days,
+        replay=args.replay
+    )
+
+
 def main():
 
     
@@ -473,6 +3361,60 @@ def main():
   
   # 指定CSV文件路径
   python experiment_runner.py --model DeepSeek-V3-Fast --csv /path/to/data.csv --samples 10
+
+  # 异步并发执行（最多16个请求同时在途）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16
+
+  # 对冲请求，压低长尾延迟（额外请求不超过10%）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 --hedge --hedge-budget 0.1
+
+  # 只导出 Parquet 数据集 ./results.parquet（默认另外导出 JSON/CSV）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --formats parquet
+
+  # 服务端结构化输出，未通过格式校验的结果最多定向重试2轮
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 --structured --parse-retries 2
+
+  # 流式接收，JSON 闭合后提前结束生成
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 --stream
+
+  # 每个条件的10个样本合并为一次 n=10 请求
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 --batch-samples
+
+  # 离线批处理模式（提交 Batch 任务并轮询结果）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --batch-mode --batch-poll 60
+
+  # 使用响应缓存；之后可用 --replay 离线重放（不调用API）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --cache responses.sqlite
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --cache responses.sqlite --replay
+
+  # 自适应采样：每个条件 3~10 个样本，评分与情绪唤醒度的 95% 置信区间宽度不超过 1 时停止
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 \
+      --adaptive --min-samples 3 --ci-width 1.0
+
+  # 无网络的 CPU 节点上用本地模型运行（每批最多8条提示词，需要 torch 与 transformers）
+  python experiment_runner.py --model Qwen2.5-1.5B --local-model ./models/Qwen2.5-1.5B-Instruct \
+      --local-batch 8 --samples 10
+
+  # 同一模型部署在两个服务商，按延迟与故障率分流，其中一个故障时自动切换到另一个（KEY 可写成 env:变量名）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 10 --concurrency 16 \
+      --endpoint https://api.provider-a.com/v1,env:PROVIDER_A_KEY \
+      --endpoint https://api.provider-b.com/v1,env:PROVIDER_B_KEY,0.5
+
+  # 分4台机器运行，每台执行其中一个分片
+  python experiment_runner.py --model DeepSeek-V3-Fast --prefix exp_001 --samples 10 --shard 0/4 \
+      --journal exp_001.shard0.journal.jsonl
+
+  # 只预估 token 用量、费用与墙钟时间，不发出请求（单价为每百万 token）
+  python experiment_runner.py --model DeepSeek-V3-Fast --samples 100 --concurrency 16 --estimate \
+      --input-price 2 --output-price 8
+
+  # 每个模型最多花费 50 元，接近上限时限速，用尽后暂停，调整预算后 --resume 继续
+  python experiment_runner.py --model DeepSeek-V3-Fast --prefix exp_001 --samples 100 --concurrency 16 \
+      --input-price 2 --output-price 8 --cost-budget 50 --journal exp_001.journal.jsonl
+
+  # 中断后从结果日志恢复，仅补跑缺失的调用
+  python experiment_runner.py --model DeepSeek-V3-Fast --prefix exp_001 --samples 10 \
+      --journal exp_001.journal.jsonl --resume
         """
     )
     
@@ -491,8 +3433,75 @@ def main():
                        help='API URL（默认: 从环境变量LLM_API_URL读取）')
     parser.add_argument('--api-key', type=str, default=None,
                        help='API密钥（默认: 从环境变量LLM_API_KEY读取）')
+    parser.add_argument('--endpoint', type=str, action='append', default=None,
+                       metavar='URL[,KEY[,WEIGHT]]',
+                       help='提供同一模型的服务端点，可重复指定组成端点池（提供时忽略 --api-url / --api-key）')
+    parser.add_argument('--concurrency', type=int, default=1,
+                       help='同时在途的最大请求数，端点池中每个端点各自生效（默认: 1，即逐条顺序调用）')
+    parser.add_argument('--journal', type=str, default=None,
+                       help='结果日志路径，每条结果完成即追加写入（默认: <输出文件名>.journal.jsonl）')
+    parser.add_argument('--resume', action='store_true',
+                       help='从 --journal 指定的日志恢复，仅执行缺失的工作单元')
+    parser.add_argument('--batch-samples', action='store_true',
+                       help='同一条件的全部样本以一次 n=samples 请求获取（接口不支持时自动逐条请求）')
+    parser.add_argument('--max-retries', type=int, default=5,
+                       help='429/5xx/连接错误的最大重试次数（默认: 5）')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                       help='每秒最大请求数（默认: 不限，仅由自适应并发窗口控制）')
+    parser.add_argument('--hedge', action='store_true',
+                       help='启用对冲请求：超过近期响应时间分位数仍未返回时再发一份，取先完成者')
+    parser.add_argument('--hedge-quantile', type=float, default=0.95,
+                       help='触发对冲的响应时间分位数（默认: 0.95）')
+    parser.add_argument('--hedge-budget', type=float, default=0.1,
+                       help='对冲请求数占主请求数的上限比例（默认: 0.1）')
+    parser.add_argument('--structured', action='store_true',
+                       help='随请求发送 response_format（JSON Schema），接口不支持时自动退回仅本地校验')
+    parser.add_argument('--parse-retries', type=int, default=0,
+                       help='对未通过格式校验的结果定向重试的最大轮数（默认: 0，不重试）')
+    parser.add_argument('--schedule', type=str, default='prefix', choices=SCHEDULES,
+                       help='请求调度顺序：prefix 按提示词前缀分组连续发出以命中服务端前缀缓存，plan 按计划顺序（默认: prefix）')
+    parser.add_argument('--stream', action='store_true',
+                       help='流式接收响应，第一个 JSON 对象闭合后立即结束，并记录首 token / JSON 完成时间')
+    parser.add_argument('--breaker-threshold', type=int, default=5,
+                       help='连续多少次服务故障（连接错误/超时/5xx）后熔断，暂停该服务的请求（默认: 5）')
+    parser.add_argument('--breaker-cooldown', type=float, default=10.0,
+                       help='熔断后首次探测前的等待秒数，探测失败时逐次加倍（默认: 10）')
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_export_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_budget_arguments(parser)
+    parser.add_argument('--shard', type=str, default=None,
+                       help='只执行第 i 个分片（格式 i/N，i 从 0 开始），各分片结果用 merge_shards.py 合并')
+    parser.add_argument('--local-model', type=str, default=None,
+                       help='本地模型目录：提供时用 transformers 在本机推理，不调用API（不能与 --stream / --endpoint 同时使用）')
+    parser.add_argument('--local-gguf', type=str, default=None,
+                       help='本地模型目录中的 GGUF 权重文件名')
+    parser.add_argument('--local-batch', type=int, default=8,
+                       help='本地推理每批的最大提示词数（默认: 8）')
+    parser.add_argument('--local-threads', type=int, default=None,
+                       help='本地推理的 CPU 线程数（默认: torch 默认值）')
     
     args = parser.parse_args()
+    if args.resume and not args.journal:
+        print("❌ 错误: --resume 需要同时指定 --journal")
+        return 1
+    try:
+        export_formats = export_formats_from_args(args)
+        shard = parse_shard(args.shard) if args.shard else None
+        endpoints = [parse_endpoint(value) for value in args.endpoint] if args.endpoint else None
+    except ValueError as e:
+        print(f"❌ 错误: {e}")
+        return 1
+    adaptive = adaptive_from_args(args)
+    if shard is not None and adaptive is not None:
+        print(f"❌ 错误: {ADAPTIVE_SHARD_ERROR}")
+        return 1
+    try:
+        cache = cache_from_args(args)
+    except FileNotFoundError as e:
+        print(f"❌ 错误: {e}")
+        return 1
     
     # 确定CSV路径
     if args.csv:
@@ -506,7 +3515,35 @@ def main():
         return 1
     
     # 运行实验
+    if args.local_model:
+        ignored = [flag for flag, value in (("--stream", args.stream), ("--endpoint", args.endpoint)) if value]
+        if ignored:
+            print(f"❌ 错误: {' / '.join(ignored)} 不能与 --local-model 同时使用")
+            return 1
+
+    client = None
     try:
+        if args.local_model and not args.estimate:
+            # 本地推理后端依赖 torch / transformers，仅在使用时导入
+            from local_backend import LocalLLMClient
+            # 显式指定的并发、重试、限速、对冲与熔断参数传给本地客户端，未指定时使用本地后端的默认值
+            # （并发 2 × --local-batch，不重试）
+            local_kwargs = {
+                option: getattr(args, dest)
+                for dest, option in (("concurrency", "max_concurrency"), ("max_retries", "max_retries"),
+                                     ("rate_limit", "rate_limit"), ("hedge", "hedge"),
+                                     ("hedge_quantile", "hedge_quantile"), ("hedge_budget", "hedge_budget"),
+                                     ("breaker_threshold", "breaker_threshold"),
+                                     ("breaker_cooldown", "breaker_cooldown"))
+                if getattr(args, dest) != parser.get_default(dest)
+            }
+            client = LocalLLMClient(args.local_model, model_name=args.model,
+                                    max_batch=args.local_batch,
+                                    threads=args.local_threads,
+                                    gguf_file=args.local_gguf,
+                                    structured=args.structured,
+                                    cache=cache,
+                                    **local_kwargs)
         run_experiment(
             csv_path=csv_path,
             model_name=args.model,
@@ -514,14 +3551,47 @@ def main():
             include_emotional=not args.no_emotional,
             experiment_id_prefix=args.prefix,
             api_url=args.api_url,
-            api_key=args.api_key
+            api_key=args.api_key,
+            concurrency=args.concurrency,
+            journal_path=args.journal,
+            resume=args.resume,
+            cache=cache,
+            batch_samples=args.batch_samples,
+            batch_runner=batch_runner_from_args(args),
+            batch_id=args.batch_id,
+            max_retries=args.max_retries,
+            rate_limit=args.rate_limit,
+            hedge=args.hedge,
+            hedge_quantile=args.hedge_quantile,
+            hedge_budget=args.hedge_budget,
+            stream=args.stream,
+            structured=args.structured,
+            parse_retries=args.parse_retries,
+            export_formats=export_formats,
+            parquet_root=args.parquet_dir,
+            shard=shard,
+            adaptive=adaptive,
+            schedule=args.schedule,
+            client=client,
+            budget=budget_from_args(args, args.model),
+            estimate=args.estimate,
+            est_latency=args.est_latency,
+            breaker_threshold=args.breaker_threshold,
+            breaker_cooldown=args.breaker_cooldown,
+            endpoints=endpoints
         )
+        if client is not None:
+            from local_backend import print_batcher_stats
+            print_batcher_stats(client)
         return 0
     except Exception as e:
         print(f"❌ 实验运行失败: {e}")
         import traceback
         traceback.print_exc()
         return 1
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+本地 CPU 推理后端
+在无网络的计算节点上用 transformers 加载开源权重模型（HuggingFace 目录，或经 gguf_file 载入 GGUF 权重），
+代替 OpenAI 兼容接口运行同一套惩罚判断实验：
+- LocalLLMClient 继承 AsyncLLMClient，只替换单次请求的发送（_asend），
+  缓存、限流、重试与 (text, response_time) 返回约定不变，SimpleExperiment 与 parse_response 无需修改
+- 调度器同时发出的请求由 MicroBatcher 收集为一批，左侧填充后以一次 generate 调用完成
+- 每行输出的第一个 JSON 对象闭合后即停止该行的生成（与流式模式的提前结束一致）
+"""
+
+import os
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+try:
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteria, StoppingCriteriaList
+except ImportError:
+    torch = None
+    StoppingCriteria = object
+
+from experiment_runner import (
+    AsyncLLMClient,
+    ChatReply,
+    Completion,
+    CSVCases,
+    JSONObjectDetector,
+    plan_work_items,
+)
+
+
+# ==================== Local Model ====================
+@dataclass
+class GeneratedText:
+    """一行生成结果"""
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class JSONStoppingCriteria(StoppingCriteria):
+    """逐 token 检测每行输出，第一个 JSON 对象闭合的行标记为结束，全部结束时 generate 停止"""
+
+    def __init__(self, tokenizer, batch_size: int):
+        self.tokenizer = tokenizer
+        self.detectors = [JSONObjectDetector() for _ in range(batch_size)]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for row, tid in enumerate(input_ids[:, -1].tolist()):
+            detector = self.detectors[row]
+            if not detector.done:
+                detector.feed(self.tokenizer.decode([tid], skip_special_tokens=True))
+        return torch.tensor([d.done for d in self.detectors], dtype=torch.bool, device=input_ids.device)
+
+
+class LocalModel:
+    """
+    本地 transformers 模型
+
+    temperature 为 0 时贪心解码，否则按温度采样（top_p=1、不做 top_k 截断，与接口的默认语义一致）；
+    repetition_penalty 固定为 1.0，不沿用模型 generation_config 中的设置；max_tokens 对应 max_new_tokens
+    """
+
+    def __init__(self, model_path: str, dtype: str = "float32", threads: int = None,
+                 gguf_file: str = None, stop_at_json: bool = True):
+        if torch is None:
+            raise ImportError("本地推理后端需要安装 torch 与 transformers")
+        if threads:
+            torch.set_num_threads(threads)
+        self.model_path = model_path
+        self.stop_at_json = stop_at_json
+        load_kwargs = {"trust_remote_code": True, "local_files_only": os.path.isdir(model_path)}
+        if gguf_file:
+            load_kwargs["gguf_file"] = gguf_file
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, **load_kwargs)
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path, torch_dtype=getattr(torch, dtype), **load_kwargs
+        )
+        self.model.eval()
+        print(f"✓ 载入本地模型: {model_path} ({dtype}, {torch.get_num_threads()} 线程)")
+
+    def render(self, prompt: str) -> str:
+        """与接口一致，提示词作为单条 user 消息套用模型的对话模板"""
+        if getattr(self.tokenizer, "chat_template", None):
+            return self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+            )
+        return prompt
+
+    def generate(self, prompts: List[str], temperature: float, max_tokens: int) -> List[GeneratedText]:
+        """批量生成：左侧填充后一次 generate 调用完成全部提示词"""
+        enc = self.tokenizer([self.render(p) for p in prompts], return_tensors="pt", padding=True)
+        kwargs: dict = {"max_new_tokens": max_tokens, "pad_token_id": self.tokenizer.pad_token_id,
+                        "repetition_penalty": 1.0}
+        if temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=1.0, top_k=0)
+        else:
+            kwargs["do_sample"] = False
+        if self.stop_at_json:
+            kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [JSONStoppingCriteria(self.tokenizer, len(prompts))]
+            )
+        with torch.inference_mode():
+            output = self.model.generate(**enc, **kwargs)
+
+        new_tokens = output[:, enc["input_ids"].shape[1]:]
+        prompt_lengths = enc["attention_mask"].sum(dim=1).tolist()
+        completion_lengths = (new_tokens != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        texts = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        return [GeneratedText(text, int(p), int(c))
+                for text, p, c in zip(texts, prompt_lengths, completion_lengths)]
+
+
+# ==================== Micro Batching ====================
+class MicroBatcher:
+    """
+    把并发到达的请求收集为批：第一条请求到达后，凑满 max_batch 行或等待 max_wait 秒即执行一次批量生成；
+    生成在单独的工作线程中进行（torch 运算期间释放 GIL），其间到达的请求进入下一批
+    """
+
+    def __init__(self, model: LocalModel, max_batch: int = 8, max_wait: float = 0.02):
+        self.model = model
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max_wait
+        self.batches = 0
+        self.rows = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._carry = None  # 放不进上一批、留给下一批的请求
+
+    async def submit(self, prompt: str, n: int, temperature: float, max_tokens: int) -> List[GeneratedText]:
+        """提交一条请求（n 个候选），返回生成结果"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 客户端可能在多个事件循环（多次 asyncio.run）中复用，队列与后台任务按循环重建
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._carry = None
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((prompt, n, (temperature, max_tokens), future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[str, int, Tuple[float, int], asyncio.Future]]:
+        """收集一批请求：总行数不超过 max_batch（单条请求的 n 超过时独占一批），生成参数一致"""
+        if self._carry is not None:
+            batch, self._carry = [self._carry], None
+        else:
+            batch = [await self._queue.get()]
+        rows = batch[0][1]
+        deadline = self._loop.time() + self.max_wait
+        while rows < self.max_batch:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if rows + request[1] > self.max_batch or request[2] != batch[0][2]:
+                self._carry = request
+                break
+            batch.append(request)
+            rows += request[1]
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [b for b in await self._collect() if not b[3].done()]
+            if not batch:
+                continue
+            params = batch[0][2]
+            prompts = [prompt for prompt, n, _, _ in batch for _ in range(n)]
+            try:
+                outputs = await self._loop.run_in_executor(
+                    self._executor, self.model.generate, prompts, params[0], params[1]
+                )
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.rows += len(prompts)
+            offset = 0
+            for _, n, _, future in batch:
+                if not future.done():
+                    future.set_result(outputs[offset:offset + n])
+                offset += n
+
+    async def aclose(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._loop, self._queue, self._task = None, None, None
+
+
+# ==================== Client ====================
+class LocalLLMClient(AsyncLLMClient):
+    """
+    本地推理客户端
+
+    与 AsyncLLMClient 接口相同，可直接传给 SimpleExperiment(client=...)；
+    max_concurrency 默认取 2 × max_batch，使一批生成期间下一批已在排队
+    """
+
+    def __init__(self, model_path: str, model_name: str = None,
+                 max_batch: int = 8,
+                 max_wait: float = 0.02,
+                 dtype: str = "float32",
+                 threads: int = None,
+                 gguf_file: str = None,
+                 stop_at_json: bool = True,
+                 **kwargs):
+        kwargs.setdefault("max_concurrency", 2 * max_batch)
+        kwargs.setdefault("max_retries", 0)
+        model_name = model_name or os.path.basename(os.path.normpath(gguf_file or model_path))
+        super().__init__(model_name, api_url=f"local://{os.path.abspath(model_path)}", api_key="local", **kwargs)
+        self.local_model = LocalModel(model_path, dtype=dtype, threads=threads,
+                                      gguf_file=gguf_file, stop_at_json=stop_at_json)
+        self.batcher = MicroBatcher(self.local_model, max_batch=max_batch, max_wait=max_wait)
+        self.supports_n = True
+
+    def _make_async_client(self, endpoint=None):
+        return None
+
+    async def aclose(self):
+        await self.batcher.aclose()
+
+    async def _asend(self, prompt: str, n: int = 1, endpoint=None, schema: bool = True) -> ChatReply:
+        outputs = await self.batcher.submit(prompt, n, self.temperature, self.max_tokens)
+        return ChatReply(texts=[o.text for o in outputs], prompt_tokens=outputs[0].prompt_tokens,
+                         completion_tokens=sum(o.completion_tokens for o in outputs))
+
+    def complete(self, prompt: str, sample_index: int = 0) -> Completion:
+        """同步生成（不经过批处理）"""
+        cached = self._cache_lookup(prompt, sample_index)
+        if cached is not None:
+            return cached
+
+        start_time = time.time()
+        try:
+            self.request_count += 1
+            output = self.local_model.generate([prompt], self.temperature, self.max_tokens)[0]
+            rt = time.time() - start_time
+            completion = Completion(text=output.text, response_time=rt, latency=rt,
+                                    prompt_tokens=output.prompt_tokens,
+                                    completion_tokens=output.completion_tokens)
+        except Exception as e:
+            error_msg = f"API调用出错: {str(e)}"
+            return Completion(text=error_msg, response_time=time.time() - start_time, error=True)
+
+        self._cache_store(prompt, sample_index, completion)
+        return completion
+
+
+def print_batcher_stats(client: LocalLLMClient):
+    """打印批处理统计"""
+    b = client.batcher
+    if b.batches:
+        print(f"✓ {client.model_name} 本地批处理: {b.batches} 批 | 平均批大小 {b.rows / b.batches:.1f}")
+
+
+# ==================== Benchmark ====================
+def benchmark(model: LocalModel, prompts: List[str], batch_sizes: List[int],
+              temperature: float, max_tokens: int, repeats: int = 1):
+    """按不同批大小测量生成吞吐量（tokens/s）"""
+    print(f"\n📊 本地推理吞吐量（{len(prompts)} 条提示词，max_tokens={max_tokens}）:")
+    print(f"  {'批大小':<8}{'用时(s)':>9}{'条/秒':>9}{'输入tok/s':>12}{'生成tok/s':>12}{'平均生成长度':>14}")
+    model.generate(prompts[:1], temperature, 8)  # 预热
+    for batch_size in batch_sizes:
+        elapsed, prompt_tokens, completion_tokens, rows = 0.0, 0, 0, 0
+        for _ in range(repeats):
+            for i in range(0, len(prompts), batch_size):
+                chunk = prompts[i:i + batch_size]
+                start = time.perf_counter()
+                outputs = model.generate(chunk, temperature, max_tokens)
+                elapsed += time.perf_counter() - start
+                prompt_tokens += sum(o.prompt_tokens for o in outputs)
+                completion_tokens += sum(o.completion_tokens for o in outputs)
+                rows += len(outputs)
+        print(f"  {batch_size:<8}{elapsed:>9.1f}{rows / elapsed:>9.2f}{prompt_tokens / elapsed:>12.1f}"
+              f"{completion_tokens / elapsed:>12.1f}{completion_tokens / rows:>14.1f}")
+
+
+# ==================== Main Function ====================
+def main():
+    """主函数 - 支持命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='本地 CPU 推理后端：按批大小测量生成吞吐量',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  # 测量批大小 1/2/4/8 的生成吞吐量（提示词取自案件表）
+  python local_backend.py --model-path ./models/Qwen2.5-1.5B-Instruct --batch-sizes 1 2 4 8
+
+  # GGUF 权重（由 transformers 反量化载入），16 线程
+  python local_backend.py --model-path ./models/qwen-gguf --gguf-file qwen2.5-1.5b-q8_0.gguf --threads 16
+
+  # 用本地模型运行实验（参数与接口模式相同）
+  python experiment_runner.py --model Qwen2.5-1.5B --local-model ./models/Qwen2.5-1.5B-Instruct \\
+      --local-batch 8 --samples 10
+        """
+    )
+    parser.add_argument('--model-path', type=str, required=True,
+                       help='模型目录（HuggingFace 格式）或仓库名')
+    parser.add_argument('--gguf-file', type=str, default=None,
+                       help='模型目录中的 GGUF 权重文件名')
+    parser.add_argument('--dtype', type=str, default='float32', choices=['float32', 'bfloat16', 'float16'],
+                       help='计算精度（默认: float32）')
+    parser.add_argument('--threads', type=int, default=None,
+                       help='torch CPU 线程数（默认: torch 默认值）')
+    parser.add_argument('--csv', type=str, default='../../data/final_crime_data.csv',
+                       help='提供提示词的CSV数据文件路径')
+    parser.add_argument('--prompts', type=int, default=16,
+                       help='参与测量的提示词条数（默认: 16）')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8],
+                       help='测量的批大小（默认: 1 2 4 8）')
+    parser.add_argument('--max-tokens', type=int, default=256,
+                       help='每条生成的最大 token 数（默认: 256）')
+    parser.add_argument('--temperature', type=float, default=0.7,
+                       help='采样温度（默认: 0.7）')
+    parser.add_argument('--repeats', type=int, default=1,
+                       help='每个批大小重复测量的轮数（默认: 1）')
+    parser.add_argument('--no-json-stop', action='store_true',
+                       help='不在 JSON 闭合后提前停止（测量生成满 max_tokens 的吞吐量）')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.csv):
+        print(f"❌ 错误: CSV文件不存在: {args.csv}")
+        return 1
+    items = plan_work_items(CSVCases(args.csv), 1, include_emotional=True)
+    prompts = [item.prompt for item in items][:args.prompts]
+    if not prompts:
+        print("⚠️ CSV 中没有有效案件")
+        return 1
+
+    try:
+        model = LocalModel(args.model_path, dtype=args.dtype, threads=args.threads,
+                           gguf_file=args.gguf_file, stop_at_json=not args.no_json_stop)
+    except (ImportError, OSError) as e:
+        print(f"❌ 错误: {e}")
+        return 1
+    benchmark(model, prompts, args.batch_sizes, args.temperature, args.max_tokens, args.repeats)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
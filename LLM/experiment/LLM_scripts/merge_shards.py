@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+分片结果合并工具
+把 --shard i/N 各分片的结果日志（JSONL）或 Parquet 数据集合并为一份结果：
+- 每个来源内，同一实验前缀只取最近一次运行，同一工作单元以最后写入的一条为准（与 --resume 一致）
+- 多个来源包含同一工作单元时记为重复，保留通过格式校验且时间最新的一条
+- 同一实验前缀统一使用各分片中最早的实验ID
+- 提供 --spec 时按网格计划检查缺失的工作单元
+合并结果写为新的结果日志（可配合 --resume 补跑缺失部分），并按 --formats 导出
+"""
+
+import os
+import csv
+import argparse
+from collections import defaultdict
+from dataclasses import dataclass, field, fields, replace
+from typing import Dict, List, Optional, Set, Tuple
+
+from experiment_runner import (
+    CSVCases,
+    Result,
+    ResultJournal,
+    add_export_arguments,
+    experiment_prefix,
+    export_formats_from_args,
+    export_results,
+    load_results,
+    plan_work_items,
+)
+from sweep_runner import expand_grid, load_spec, parse_models
+
+# 合并键: (实验前缀, 案件, 角色, 时间条件, 样本)
+MergeKey = Tuple[str, str, str, str, int]
+
+
+def merge_key(result: Result) -> MergeKey:
+    return (experiment_prefix(result.experiment_id), result.case_id, result.role,
+            result.time_condition, int(result.sample_idx))
+
+
+# ==================== Loading ====================
+def load_source(path: str) -> List[Result]:
+    """读取一个分片的结果：JSONL 日志，或 Parquet 数据集目录"""
+    if os.path.isdir(path):
+        df = load_results(path)
+        names = {f.name for f in fields(Result)}
+        df = df[[c for c in df.columns if c in names]].astype(object)
+        df = df.where(df.notna(), None)
+        records = [Result(**row) for row in df.to_dict(orient="records")]
+        print(f"✓ 载入数据集: {path} ({len(records)} 条结果)")
+        return records
+    return ResultJournal(path).load()
+
+
+def latest_per_key(records: List[Result]) -> Dict[MergeKey, Result]:
+    """同一来源内：每个前缀只取最近一次运行，同键以后写入者为准"""
+    latest_id: Dict[str, str] = {}
+    for r in records:
+        prefix = experiment_prefix(r.experiment_id)
+        latest_id[prefix] = max(latest_id.get(prefix, r.experiment_id), r.experiment_id)
+    return {merge_key(r): r for r in records
+            if r.experiment_id == latest_id[experiment_prefix(r.experiment_id)]}
+
+
+# ==================== Merge ====================
+@dataclass
+class MergeReport:
+    """合并统计"""
+    sources: int = 0
+    duplicates: Dict[str, int] = field(default_factory=dict)
+    unexpected: Dict[str, int] = field(default_factory=dict)
+    # 以下两项仅在提供网格计划时统计
+    expected: Optional[Dict[str, int]] = None
+    missing: Optional[Dict[str, List[MergeKey]]] = None
+
+
+def merge_sources(per_source: List[Dict[MergeKey, Result]]) -> Tuple[Dict[MergeKey, Result], Dict[str, int]]:
+    """跨来源合并，返回 (合并结果, 各前缀的重复数)，并统一各前缀的实验ID"""
+    merged: Dict[MergeKey, Result] = {}
+    duplicates: Dict[str, int] = defaultdict(int)
+    for source in per_source:
+        for key, r in source.items():
+            current = merged.get(key)
+            if current is None:
+                merged[key] = r
+                continue
+            duplicates[key[0]] += 1
+            if (r.parse_ok, r.timestamp) > (current.parse_ok, current.timestamp):
+                merged[key] = r
+
+    first_id: Dict[str, str] = {}
+    for key, r in merged.items():
+        first_id[key[0]] = min(first_id.get(key[0], r.experiment_id), r.experiment_id)
+    merged = {key: r if r.experiment_id == first_id[key[0]] else replace(r, experiment_id=first_id[key[0]])
+              for key, r in merged.items()}
+    return merged, dict(duplicates)
+
+
+def planned_keys(spec_path: str, csv_path: str = None, samples: int = None,
+                 only: List[str] = None) -> Dict[str, List[MergeKey]]:
+    """按网格配置生成全部计划中的工作单元键（按计划顺序）"""
+    spec = load_spec(spec_path)
+    spec_dir = os.path.dirname(os.path.abspath(spec_path))
+    cells = expand_grid(spec, parse_models(spec))
+    if only:
+        wanted = set(only)
+        cells = [c for c in cells if c.prefix.split("_")[0] in wanted]
+    cases = CSVCases(csv_path or os.path.join(spec_dir, spec.get("csv", "final_crime_data.csv")))
+    samples = samples if samples is not None else int(spec.get("samples", 10))
+
+    plan: Dict[str, List[MergeKey]] = {}
+    for cell in cells:
+        items = plan_work_items(cases, samples, cell.include_emotional, cell.reasoning_type, cell.age)
+        plan[cell.prefix] = [(cell.prefix, item.case.get("id", ""), item.role,
+                              item.time_condition, item.sample_idx) for item in items]
+    return plan
+
+
+def check_gaps(merged: Dict[MergeKey, Result], plan: Dict[str, List[MergeKey]],
+               report: MergeReport):
+    """对照计划统计缺失与计划外的结果"""
+    expected: Set[MergeKey] = set()
+    report.missing, report.expected = {}, {}
+    for prefix, keys in plan.items():
+        report.expected[prefix] = len(keys)
+        report.missing[prefix] = [k for k in keys if k not in merged]
+        expected.update(keys)
+    for key in merged:
+        if key not in expected:
+            report.unexpected[key[0]] = report.unexpected.get(key[0], 0) + 1
+
+
+def print_report(merged: Dict[MergeKey, Result], report: MergeReport):
+    """打印合并统计"""
+    per_prefix: Dict[str, int] = defaultdict(int)
+    for key in merged:
+        per_prefix[key[0]] += 1
+    prefixes = sorted(set(per_prefix) | set(report.expected or {}))
+
+    print(f"\n📊 合并统计:")
+    print(f"  来源: {report.sources} 个，合并后结果 {len(merged)} 条")
+    for prefix in prefixes:
+        line = f"  {prefix}: {per_prefix.get(prefix, 0)}"
+        if report.expected is not None and prefix in report.expected:
+            line += f"/{report.expected[prefix]} | 缺失 {len(report.missing[prefix])}"
+        line += f" | 重复 {report.duplicates.get(prefix, 0)}"
+        if report.unexpected.get(prefix):
+            line += f" | 计划外 {report.unexpected[prefix]}"
+        print(line)
+
+    total_dup = sum(report.duplicates.values())
+    if total_dup:
+        print(f"⚠️ 共 {total_dup} 个工作单元在多个分片中重复出现，已保留通过校验且时间最新的一条")
+    if report.missing is not None:
+        total_missing = sum(len(v) for v in report.missing.values())
+        if total_missing:
+            print(f"⚠️ 共缺失 {total_missing} 个工作单元")
+        else:
+            print("✓ 与计划一致，无缺失")
+
+
+def write_missing(path: str, missing: Dict[str, List[MergeKey]]):
+    """把缺失的工作单元键写入 CSV"""
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["prefix", "case_id", "role", "time_condition", "sample_idx"])
+        for keys in missing.values():
+            writer.writerows(keys)
+    print(f"✓ 缺失列表: {path}")
+
+
+def write_journal(path: str, results: List[Result]):
+    """把合并结果写为新的结果日志（先写临时文件再替换）"""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    journal = ResultJournal(tmp_path)
+    for r in results:
+        journal.append(r)
+    journal.close()
+    os.replace(tmp_path, path)
+    print(f"✓ 合并日志: {path} ({len(results)} 条结果)")
+
+
+def ordered_results(merged: Dict[MergeKey, Result],
+                    plan: Optional[Dict[str, List[MergeKey]]]) -> List[Result]:
+    """按计划顺序（无计划时按键排序）输出合并结果，保证合并结果与分片的读取顺序无关"""
+    if plan is None:
+        return [merged[k] for k in sorted(merged)]
+    order = {key: i for keys in plan.values() for i, key in enumerate(keys)}
+    return [merged[k] for k in sorted(merged, key=lambda k: (k[0], order.get(k, len(order)), k))]
+
+
+# ==================== Main Function ====================
+def main():
+    """主函数 - 支持命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='合并 --shard 分片运行的结果，检查重复与缺失',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  # 合并网格实验各分片的日志，并对照 sweep.toml 检查缺失
+  python merge_shards.py sweep.shard0-3.journal.jsonl sweep.shard1-3.journal.jsonl \\
+      sweep.shard2-3.journal.jsonl --spec sweep.toml --output-dir merged
+
+  # 来源也可以是各分片导出的 Parquet 数据集目录
+  python merge_shards.py node1/results.parquet node2/results.parquet --output-dir merged
+
+  # 有缺失时补跑（合并日志可直接用于恢复）
+  python sweep_runner.py --spec sweep.toml --journal merged/merged.journal.jsonl --resume
+        """
+    )
+    parser.add_argument('sources', nargs='+',
+                       help='分片结果：JSONL 日志文件或 Parquet 数据集目录')
+    parser.add_argument('--output-dir', type=str, default='merged',
+                       help='输出目录（默认: merged）')
+    parser.add_argument('--spec', type=str, default=None,
+                       help='网格配置文件；提供时按计划检查缺失的工作单元')
+    parser.add_argument('--csv', type=str, default=None,
+                       help='CSV数据文件路径（默认: 使用配置中的 csv）')
+    parser.add_argument('--samples', type=int, default=None,
+                       help='每个条件的样本数（默认: 使用配置中的 samples）')
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                       help='分片运行时使用的 --only 实验单元')
+    parser.add_argument('--strict', action='store_true',
+                       help='存在缺失时以非零状态退出')
+    add_export_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        export_formats = export_formats_from_args(args)
+    except ValueError as e:
+        print(f"❌ 错误: {e}")
+        return 1
+    for path in args.sources:
+        if not os.path.exists(path):
+            print(f"❌ 错误: 来源不存在: {path}")
+            return 1
+
+    per_source = [latest_per_key(load_source(path)) for path in args.sources]
+    merged, duplicates = merge_sources(per_source)
+    report = MergeReport(sources=len(per_source), duplicates=duplicates)
+
+    plan = None
+    if args.spec:
+        plan = planned_keys(args.spec, args.csv, args.samples, args.only)
+        check_gaps(merged, plan, report)
+    print_report(merged, report)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = ordered_results(merged, plan)
+    write_journal(os.path.join(args.output_dir, "merged.journal.jsonl"), results)
+    if report.missing and any(report.missing.values()):
+        write_missing(os.path.join(args.output_dir, "missing.csv"), report.missing)
+
+    groups: Dict[str, List[Result]] = defaultdict(list)
+    for r in results:
+        groups[experiment_prefix(r.experiment_id)].append(r)
+    parquet_root = args.parquet_dir or os.path.join(args.output_dir, "results.parquet")
+    for prefix, group in groups.items():
+        model_tag = group[0].model.replace("/", "_")
+        base_name = os.path.join(args.output_dir, f"{model_tag}_{group[0].experiment_id}")
+        paths = export_results(group, base_name, export_formats, parquet_root, prefix)
+        print(f"✓ 已导出: {', '.join(paths)}")
+
+    if args.strict and report.missing and any(report.missing.values()):
+        return 2
+    print("✅ 合并完成")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+"""
+本地 OpenAI 兼容模拟服务
+用于在不消耗真实API额度的情况下测试实验运行器：
+- POST /v1/chat/completions（支持 n、stream）
+- POST /v1/files、GET /v1/files/{id}、GET /v1/files/{id}/content
+- POST /v1/batches、GET /v1/batches/{id}
+所有请求均返回固定格式的 JSON 评分答案；延迟分布、错误率、429 比例、
+服务端并发上限、格式错误比例与提示词前缀缓存均可配置，用于压测与 benchmark_runner.py
+"""
+
+import json
+import math
+import time
+import uuid
+import random
+import argparse
+import threading
+import email.parser
+import email.policy
+from collections import deque
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+
+
+# ==================== Configuration ====================
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+@dataclass
+class MockConfig:
+    """模拟服务配置"""
+    latency: float = 0.05       # chat.completions 请求的平均延迟（秒）
+    latency_dist: str = "fixed"  # 延迟分布: fixed / uniform（0~2倍均值）/ exponential / lognormal
+    latency_sigma: float = 0.5  # lognormal 分布的对数标准差
+    tail_rate: float = 0.0      # 额外长尾请求的比例
+    tail_latency: float = 2.0   # 长尾请求的延迟（秒）
+    error_rate: float = 0.0     # 返回 500 的比例
+    throttle_rate: float = 0.0  # 随机返回 429 的比例
+    retry_after: float = 0.2    # 429 响应的 Retry-After（秒）
+    max_concurrency: int = 0    # 服务端并发上限，超出时返回 429（0 表示不限）
+    malformed_rate: float = 0.0  # 返回格式错误回答的比例
+    stream_chunk: int = 8       # 流式响应每个分块的字符数
+    chunk_delay: float = 0.0    # 流式响应分块之间的间隔（秒）
+    trailing_chunks: int = 20   # JSON 之后额外输出的说明文字分块数（用于检验提前结束）
+    batch_delay: float = 0.5    # 批处理任务从提交到完成的延迟（秒）
+    prefix_cache: int = 0       # 前缀缓存保留的最近提示词数（0 表示不模拟前缀缓存）
+    prefill_per_token: float = 0.0  # 每个未命中缓存的提示词 token 增加的延迟（秒，1 字符计 1 token）
+    outage_after: float = 0.0   # 首个请求之后多少秒开始故障
+    outage_duration: float = 0.0  # 故障持续秒数，期间请求照常耗时后返回 503（0 表示不模拟故障）
+    seed: Optional[int] = None
+
+
+# 前缀缓存按块命中（与服务商的实现一致，不足一块的公共前缀不计入）
+PREFIX_CACHE_BLOCK = 16
+
+
+def sample_latency(config: MockConfig, rng: random.Random) -> float:
+    """按配置的分布抽取一次请求延迟"""
+    mean = config.latency
+    if config.tail_rate and rng.random() < config.tail_rate:
+        return config.tail_latency
+    if mean <= 0 or config.latency_dist == "fixed":
+        return max(0.0, mean)
+    if config.latency_dist == "uniform":
+        return rng.uniform(0, 2 * mean)
+    if config.latency_dist == "exponential":
+        return rng.expovariate(1.0 / mean)
+    if config.latency_dist == "lognormal":
+        # 调整 mu 使分布均值等于 latency
+        mu = math.log(mean) - config.latency_sigma ** 2 / 2
+        return rng.lognormvariate(mu, config.latency_sigma)
+    raise ValueError(f"未知的延迟分布: {config.latency_dist}")
+
+
+MALFORMED_ANSWERS = (
+    "抱歉，我无法对该案件给出评分。",
+    '{"punishment_score": "七", "reasoning": "格式错误的回答"}',
+    '{"punishment_score": 7, "reasoning": "缺少字段的回答"',
+)
+
+
+def canned_answer(rng: random.Random, malformed_rate: float = 0.0) -> str:
+    """生成一条符合 build_prompt 输出格式要求的 JSON 回答（按 malformed_rate 返回格式错误的回答）"""
+    if malformed_rate and rng.random() < malformed_rate:
+        return rng.choice(MALFORMED_ANSWERS)
+    score = rng.randint(0, 9)
+    arousal = rng.randint(0, 9)
+    return json.dumps({
+        "punishment_score": score,
+        "reasoning": f"模拟评分理由（{score}分）",
+        "emotional_arousal": arousal,
+        "emotional_description": f"模拟情绪描述（{arousal}分）",
+        "case_analysis": "模拟案件分析",
+        "punishment_justification": "模拟惩罚合理性说明",
+    }, ensure_ascii=False)
+
+
+def prompt_text(body: Dict[str, Any]) -> str:
+    """拼接请求中全部消息的文本内容"""
+    return "".join(str(m.get("content") or "") for m in body.get("messages") or [])
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+def chat_completion_body(model: str, n: int, rng: random.Random,
+                         malformed_rate: float = 0.0, prompt_tokens: int = 400,
+                         cached_tokens: int = 0) -> Dict[str, Any]:
+    """构造 chat.completion 响应体"""
+    choices = []
+    for i in range(max(1, n)):
+        choices.append({
+            "index": i,
+            "message": {"role": "assistant", "content": canned_answer(rng, malformed_rate)},
+            "finish_reason": "stop",
+        })
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 120 * len(choices),
+                  "total_tokens": prompt_tokens + 120 * len(choices),
+                  "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+    }
+
+
+# ==================== Server State ====================
+class MockState:
+    """文件与批处理任务的内存存储"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.request_count = 0
+        self.in_flight = 0
+        self.throttled = 0
+        self.errors = 0
+        self.recent_prompts: deque = deque(maxlen=config.prefix_cache or None)
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.started: Optional[float] = None
+
+    def in_outage(self) -> bool:
+        """当前是否处于模拟故障期；调用方需持有锁"""
+        if not self.config.outage_duration:
+            return False
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        return 0 <= now - self.started - self.config.outage_after < self.config.outage_duration
+
+    def lookup_prefix(self, prompt: str) -> int:
+        """返回与最近提示词的最长公共前缀（按块取整）并把该提示词加入缓存；调用方需持有锁"""
+        if not self.config.prefix_cache:
+            return 0
+        best = max((common_prefix_length(prompt, p) for p in self.recent_prompts), default=0)
+        if prompt in self.recent_prompts:
+            self.recent_prompts.remove(prompt)
+        self.recent_prompts.append(prompt)
+        return best // PREFIX_CACHE_BLOCK * PREFIX_CACHE_BLOCK
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex[:16]}"
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[file_id] = meta
+            self.file_contents[file_id] = content
+        return meta
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = f"batch_{uuid.uuid4().hex[:16]}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "metadata": body.get("metadata"),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._process_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _process_batch(self, batch_id: str):
+        """后台执行批处理任务：逐行生成响应并写入输出文件"""
+        batch = self.batches[batch_id]
+        batch["status"] = "in_progress"
+        batch["in_progress_at"] = int(time.time())
+        lines = self.file_contents[batch["input_file_id"]].decode("utf-8").splitlines()
+        batch["request_counts"]["total"] = sum(1 for line in lines if line.strip())
+        time.sleep(self.config.batch_delay)
+
+        outputs = []
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            req_body = request.get("body", {})
+            with self.lock:
+                body = chat_completion_body(req_body.get("model", ""), req_body.get("n", 1), self.rng,
+                                            self.config.malformed_rate)
+            outputs.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": body},
+                "error": None,
+            }, ensure_ascii=False))
+
+        output = self.add_file(f"{batch_id}_output.jsonl", "batch_output",
+                               ("\n".join(outputs) + "\n").encode("utf-8"))
+        batch["request_counts"] = {"total": len(outputs), "completed": len(outputs), "failed": 0}
+        batch["output_file_id"] = output["id"]
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
+
+
+# ==================== HTTP Handler ====================
+class MockHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容接口的请求处理"""
+
+    server_version = "MockLLM/1.0"
+    protocol_version = "HTTP/1.1"
+    # 响应头与响应体分两次写出，关闭 Nagle 以免长连接上出现 40ms 的延迟确认等待
+    disable_nagle_algorithm = True
+
+    @property
+    def state(self) -> MockState:
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload: Dict[str, Any], status: int = 200):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json({"error": {"message": message, "type": "mock_error", "code": status}}, status)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            self._chat_completions(json.loads(self._read_body() or b"{}"))
+        elif path.endswith("/files"):
+            self._upload_file()
+        elif path.endswith("/batches"):
+            self._send_json(self.state.create_batch(json.loads(self._read_body() or b"{}")))
+        else:
+            self._send_error(404, f"未知接口: {path}")
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+            content = self.state.file_contents.get(parts[-2])
+            if content is None:
+                return self._send_error(404, "文件不存在")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        elif len(parts) >= 2 and parts[-2] == "files":
+            meta = self.state.files.get(parts[-1])
+            self._send_json(meta) if meta else self._send_error(404, "文件不存在")
+        elif len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.state.batches.get(parts[-1])
+            self._send_json(batch) if batch else self._send_error(404, "批处理任务不存在")
+        else:
+            self._send_error(404, f"未知接口: {self.path}")
+
+    def _chat_completions(self, body: Dict[str, Any]):
+        state, config = self.state, self.state.config
+        prompt = prompt_text(body)
+        with state.lock:
+            state.request_count += 1
+            roll = state.rng.random()
+            latency = sample_latency(config, state.rng)
+            throttled = (bool(config.max_concurrency) and state.in_flight >= config.max_concurrency) \
+                or roll < config.throttle_rate
+            if throttled:
+                state.throttled += 1
+            else:
+                state.in_flight += 1
+                cached_tokens = state.lookup_prefix(prompt)
+                state.prompt_tokens += len(prompt)
+                state.cached_tokens += cached_tokens
+                latency += config.prefill_per_token * (len(prompt) - cached_tokens)
+        if throttled:
+            return self._send_throttled()
+        try:
+            time.sleep(latency)
+            if roll < config.throttle_rate + config.error_rate:
+                with state.lock:
+                    state.errors += 1
+                return self._send_error(500, "模拟服务端错误")
+            with state.lock:
+                outage = state.in_outage()
+                if outage:
+                    state.errors += 1
+            if outage:
+                return self._send_error(503, "模拟服务故障")
+            with state.lock:
+                payload = chat_completion_body(body.get("model", ""), body.get("n", 1), state.rng,
+                                               config.malformed_rate, len(prompt), cached_tokens)
+            if body.get("stream"):
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                self._send_stream(payload, include_usage)
+            else:
+                self._send_json(payload)
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def _send_throttled(self):
+        data = json.dumps({"error": {"message": "模拟限流", "type": "rate_limit_error", "code": 429}},
+                          ensure_ascii=False).encode("utf-8")
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Retry-After", str(self.state.config.retry_after))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, payload: Dict[str, Any], include_usage: bool):
+        """以 SSE 分块发送响应：先输出 JSON 回答，再输出若干说明文字分块"""
+        config = self.state.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(data: str):
+            raw = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(raw):x}\r\n".encode("ascii") + raw + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(index: int, delta: Dict[str, Any], finish_reason: str = None) -> str:
+            return json.dumps({
+                "id": payload["id"],
+                "object": "chat.completion.chunk",
+                "created": payload["created"],
+                "model": payload["model"],
+                "choices": [{"index": index, "delta": delta, "finish_reason": finish_reason}],
+            }, ensure_ascii=False)
+
+        try:
+            contents = [c["message"]["content"] for c in payload["choices"]]
+            pieces = [[text[i:i + config.stream_chunk] for i in range(0, len(text), config.stream_chunk)]
+                      + ["\n以上评分综合考虑了案件情节。"] * config.trailing_chunks
+                      for text in contents]
+            for index in range(len(contents)):
+                event(chunk(index, {"role": "assistant", "content": ""}))
+            for step in range(max(len(p) for p in pieces)):
+                for index, parts in enumerate(pieces):
+                    if step < len(parts):
+                        event(chunk(index, {"content": parts[step]}))
+                if config.chunk_delay:
+                    time.sleep(config.chunk_delay)
+            for index in range(len(contents)):
+                event(chunk(index, {}, "stop"))
+            if include_usage:
+                event(json.dumps({"id": payload["id"], "object": "chat.completion.chunk",
+                                  "created": payload["created"], "model": payload["model"],
+                                  "choices": [], "usage": payload["usage"]}))
+            event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭流（如 JSON 已完整），属正常情况
+            self.close_connection = True
+
+    def _upload_file(self):
+        """解析 multipart/form-data 上传"""
+        content_type = self.headers.get("Content-Type", "")
+        raw = self._read_body()
+        message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + raw
+        )
+        fields: Dict[str, Any] = {}
+        filename = "upload.jsonl"
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                filename = part.get_filename()
+            fields[name] = part.get_payload(decode=True)
+        if "file" not in fields:
+            return self._send_error(400, "缺少 file 字段")
+        purpose = (fields.get("purpose") or b"batch").decode("utf-8")
+        self._send_json(self.state.add_file(filename, purpose, fields["file"]))
+
+
+# ==================== Server ====================
+class MockLLMServer:
+    """在后台线程中运行的模拟服务，可作为上下文管理器使用"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, config: MockConfig = None):
+        self.config = config or MockConfig()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = MockState(self.config)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def state(self) -> MockState:
+        return self.httpd.state
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    """主函数 - 支持命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='本地 OpenAI 兼容模拟服务',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  # 固定 50ms 延迟
+  python mock_server.py --port 8000
+
+  # 对数正态延迟 + 2% 长尾 + 1% 服务端错误 + 服务端并发上限 32
+  python mock_server.py --latency 0.3 --latency-dist lognormal --tail-rate 0.02 \\
+      --error-rate 0.01 --max-concurrency 32
+
+  # 模拟前缀缓存：保留最近 32 个提示词，未命中部分每 token 增加 0.1ms 预填充延迟
+  python mock_server.py --prefix-cache 32 --prefill-per-token 0.0001
+
+  # 模拟服务故障：首个请求 5 秒后的 20 秒内全部返回 503
+  python mock_server.py --outage-after 5 --outage-duration 20
+        """
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址（默认: 127.0.0.1）')
+    parser.add_argument('--port', type=int, default=8000, help='监听端口（默认: 8000）')
+    parser.add_argument('--latency', type=float, default=0.05, help='请求的平均延迟秒数（默认: 0.05）')
+    parser.add_argument('--latency-dist', type=str, default='fixed', choices=LATENCY_DISTRIBUTIONS,
+                        help='延迟分布（默认: fixed）')
+    parser.add_argument('--tail-rate', type=float, default=0.0, help='长尾请求比例（默认: 0）')
+    parser.add_argument('--tail-latency', type=float, default=2.0, help='长尾请求的延迟秒数（默认: 2.0）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例（默认: 0）')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='随机返回 429 的比例（默认: 0）')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='429 的 Retry-After 秒数（默认: 0.2）')
+    parser.add_argument('--max-concurrency', type=int, default=0,
+                        help='服务端并发上限，超出时返回 429（默认: 0，不限）')
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help='格式错误回答的比例（默认: 0）')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='流式分块间隔秒数（默认: 0）')
+    parser.add_argument('--batch-delay', type=float, default=0.5, help='批处理任务的完成延迟秒数（默认: 0.5）')
+    parser.add_argument('--prefix-cache', type=int, default=0,
+                        help='前缀缓存保留的最近提示词数（默认: 0，不模拟）')
+    parser.add_argument('--prefill-per-token', type=float, default=0.0,
+                        help='每个未命中缓存的提示词 token 的预填充延迟秒数（默认: 0）')
+    parser.add_argument('--outage-after', type=float, default=0.0,
+                        help='首个请求之后多少秒开始模拟故障（默认: 0）')
+    parser.add_argument('--outage-duration', type=float, default=0.0,
+                        help='模拟故障持续秒数，期间返回 503（默认: 0，不模拟）')
+    parser.add_argument('--seed', type=int, default=None, help='随机种子')
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.host, args.port, MockConfig(
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        tail_rate=args.tail_rate,
+        tail_latency=args.tail_latency,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        max_concurrency=args.max_concurrency,
+        malformed_rate=args.malformed_rate,
+        chunk_delay=args.chunk_delay,
+        batch_delay=args.batch_delay,
+        prefix_cache=args.prefix_cache,
+        prefill_per_token=args.prefill_per_token,
+        outage_after=args.outage_after,
+        outage_duration=args.outage_duration,
+        seed=args.seed,
+    ))
+    print(f"✓ 模拟服务已启动: {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+"""
+批量实验编排器
+在单个进程中按声明式配置（TOML/YAML）执行 age × reasoning_type × include_emotional × model 网格，
+替代 exp001…exp090 的独立脚本：共享案件表、提示词缓存与各模型的连接池，
+所有实验单元的工作项汇入同一个全局队列，三个模型服务可同时满负荷运行
+"""
+
+import os
+import asyncio
+import argparse
+from dataclasses import astuple, dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+from experiment_runner import (
+    ADAPTIVE_SHARD_ERROR,
+    AdaptiveSampling,
+    AsyncLLMClient,
+    BUDGET_FIELDS,
+    BatchRunner,
+    BudgetGovernor,
+    CSVCases,
+    Endpoint,
+    ResponseCache,
+    Result,
+    ResultJournal,
+    SCHEDULES,
+    SimpleExperiment,
+    WorkItem,
+    WorkScheduler,
+    adaptive_from_args,
+    add_adaptive_arguments,
+    add_batch_arguments,
+    add_budget_arguments,
+    add_cache_arguments,
+    add_export_arguments,
+    batch_runner_from_args,
+    budget_from_args,
+    cache_from_args,
+    estimate_run,
+    export_formats_from_args,
+    group_work_items,
+    parse_shard,
+    print_cache_stats,
+    print_limiter_stats,
+    print_adaptive_stats,
+    print_budget_stats,
+    print_estimate,
+    print_parse_stats,
+    print_run_telemetry,
+    reset_service_state,
+    retry_failed_parses,
+    run_adaptive_rounds,
+)
+
+
+# ==================== Sweep Spec ====================
+@dataclass
+class ModelSpec:
+    """单个模型服务的配置"""
+    key: str
+    name: str
+    short: str
+    api_url: Optional[str] = None
+    api_key: Optional[str] = None
+    concurrency: int = 8
+    max_retries: int = 5
+    rate_limit: Optional[float] = None
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_budget: float = 0.1
+    stream: bool = False
+    structured: bool = False
+    breaker_threshold: int = 5
+    breaker_cooldown: float = 10.0
+    endpoints: List[Endpoint] = field(default_factory=list)
+    local_model: Optional[str] = None
+    local_gguf: Optional[str] = None
+    local_batch: int = 8
+    local_threads: Optional[int] = None
+    token_budget: Optional[int] = None
+    cost_budget: Optional[float] = None
+    input_price: Optional[float] = None
+    output_price: Optional[float] = None
+    cached_price: Optional[float] = None
+
+
+@dataclass
+class SweepCell:
+    """网格中的一个实验单元"""
+    number: int
+    age: str
+    reasoning_type: str
+    include_emotional: bool
+    model: ModelSpec
+
+    @property
+    def prefix(self) -> str:
+        """与 expNNN 脚本一致的实验前缀"""
+        age_short = self.age.replace(":", "")
+        emotion = "with_emotion" if self.include_emotional else "without_emotion"
+        return f"exp{self.number:03d}_{age_short}_{self.reasoning_type}_{emotion}_{self.model.short}"
+
+
+def load_spec(spec_path: str) -> Dict[str, Any]:
+    """读取 TOML 或 YAML 格式的网格配置"""
+    if spec_path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("读取 YAML 配置需要安装 PyYAML，或改用 TOML 格式")
+        with open(spec_path, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+    with open(spec_path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _resolve_env(value: Optional[str]) -> Optional[str]:
+    """支持以 env:NAME 形式从环境变量读取配置值"""
+    if isinstance(value, str) and value.startswith("env:"):
+        return os.getenv(value[4:])
+    return value
+
+
+def parse_endpoints(cfg: Dict[str, Any]) -> List[Endpoint]:
+    """解析 [[models.*.endpoints]] 端点池（提供同一模型的多个服务端点）"""
+    return [Endpoint(
+        api_url=_resolve_env(ep["api_url"]),
+        api_key=_resolve_env(ep.get("api_key")),
+        weight=float(ep.get("weight", 1.0)),
+        concurrency=ep.get("concurrency"),
+    ) for ep in cfg.get("endpoints", [])]
+
+
+def parse_models(spec: Dict[str, Any]) -> Dict[str, ModelSpec]:
+    """解析 [models.*] 表"""
+    models = {}
+    for key, cfg in spec.get("models", {}).items():
+        models[key] = ModelSpec(
+            key=key,
+            name=cfg["name"],
+            short=cfg.get("short", key),
+            api_url=_resolve_env(cfg.get("api_url")),
+            api_key=_resolve_env(cfg.get("api_key")),
+            concurrency=int(cfg.get("concurrency", spec.get("concurrency", 8))),
+            max_retries=int(cfg.get("max_retries", spec.get("max_retries", 5))),
+            rate_limit=cfg.get("rate_limit"),
+            hedge=bool(cfg.get("hedge", spec.get("hedge", False))),
+            hedge_quantile=float(cfg.get("hedge_quantile", spec.get("hedge_quantile", 0.95))),
+            hedge_budget=float(cfg.get("hedge_budget", spec.get("hedge_budget", 0.1))),
+            stream=bool(cfg.get("stream", spec.get("stream", False))),
+            structured=bool(cfg.get("structured", spec.get("structured", False))),
+            breaker_threshold=int(cfg.get("breaker_threshold", spec.get("breaker_threshold", 5))),
+            breaker_cooldown=float(cfg.get("breaker_cooldown", spec.get("breaker_cooldown", 10.0))),
+            endpoints=parse_endpoints(cfg),
+            local_model=cfg.get("local_model"),
+            local_gguf=cfg.get("local_gguf"),
+            local_batch=int(cfg.get("local_batch", 8)),
+            local_threads=cfg.get("local_threads"),
+            token_budget=cfg.get("token_budget"),
+            cost_budget=cfg.get("cost_budget"),
+            input_price=cfg.get("input_price"),
+            output_price=cfg.get("output_price"),
+            cached_price=cfg.get("cached_price"),
+        )
+    return models
+
+
+def expand_grid(spec: Dict[str, Any], models: Dict[str, ModelSpec]) -> List[SweepCell]:
+    """
+    按 age → reasoning_type → include_emotional → model 的嵌套顺序展开网格，
+    编号与原 exp001…exp090 脚本一致
+    """
+    grid = spec["grid"]
+    cells: List[SweepCell] = []
+    for age in grid["age"]:
+        for reasoning_type in grid["reasoning_type"]:
+            for include_emotional in grid["include_emotional"]:
+                for model_key in grid["model"]:
+                    if model_key not in models:
+                        raise ValueError(f"网格中的模型 {model_key} 未在 [models] 中定义")
+                    cells.append(SweepCell(
+                        number=len(cells) + 1,
+                        age=age,
+                        reasoning_type=reasoning_type,
+                        include_emotional=bool(include_emotional),
+                        model=models[model_key],
+                    ))
+    return cells
+
+
+# ==================== Orchestrator ====================
+class SweepOrchestrator:
+    """单进程网格实验编排器"""
+
+    def __init__(self,
+                 csv_path: str,
+                 cells: List[SweepCell],
+                 samples: int = 10,
+                 output_dir: str = ".",
+                 journal: ResultJournal = None,
+                 resume_records: List[Result] = None,
+                 cache: ResponseCache = None,
+                 batch_samples: bool = False,
+                 parse_retries: int = 0,
+                 export_formats: Tuple[str, ...] = None,
+                 parquet_root: str = None,
+                 shard: Tuple[int, int] = None,
+                 adaptive: AdaptiveSampling = None,
+                 schedule: str = "prefix",
+                 budgets: Dict[str, BudgetGovernor] = None,
+                 local: bool = True):
+        self.csv_path = csv_path
+        self.cells = cells
+        self.samples = samples
+        self.output_dir = output_dir
+        self.journal = journal
+        self.resume_records = resume_records or []
+        self.cache = cache
+        self.batch_samples = batch_samples
+        self.parse_retries = parse_retries
+        self.export_formats = export_formats
+        self.shard = shard
+        self.adaptive = adaptive
+        self.schedule = schedule
+        self.budgets = budgets or {}
+        self.local = local
+        self.parquet_root = parquet_root or os.path.join(output_dir, "results.parquet")
+        self.cases = CSVCases(csv_path)
+        self.clients: Dict[Tuple[str, Optional[str], Optional[str]], AsyncLLMClient] = {}
+        self.experiments: List[SimpleExperiment] = []
+        # 本次网格的客户端重新创建限流器与熔断器，不沿用同一进程中之前运行的状态
+        reset_service_state()
+
+    def _client_for(self, model: ModelSpec) -> AsyncLLMClient:
+        """
+        同一模型服务的所有实验单元共享一个客户端（连接池）与预算管理器（budgets 按模型键）；
+        local=False 时（如只做预估）不加载本地模型
+        """
+        key = (model.name, model.api_url, model.api_key, tuple(astuple(ep) for ep in model.endpoints))
+        if key not in self.clients and model.local_model and self.local:
+            # 本地推理后端依赖 torch / transformers，仅在使用时导入
+            from local_backend import LocalLLMClient
+            self.clients[key] = LocalLLMClient(
+                model.local_model, model_name=model.name,
+                max_batch=model.local_batch,
+                threads=model.local_threads,
+                gguf_file=model.local_gguf,
+                structured=model.structured,
+                cache=self.cache
+            )
+            self.clients[key].budget = self.budgets.get(model.key)
+        if key not in self.clients:
+            self.clients[key] = AsyncLLMClient(
+                model.name, model.api_url, model.api_key,
+                max_concurrency=model.concurrency,
+                max_retries=model.max_retries,
+                rate_limit=model.rate_limit,
+                hedge=model.hedge,
+                hedge_quantile=model.hedge_quantile,
+                hedge_budget=model.hedge_budget,
+                stream=model.stream,
+                structured=model.structured,
+                breaker_threshold=model.breaker_threshold,
+                breaker_cooldown=model.breaker_cooldown,
+                endpoints=model.endpoints or None,
+                cache=self.cache
+            )
+            self.clients[key].budget = self.budgets.get(model.key)
+        return self.clients[key]
+
+    def build(self) -> List[Tuple[SimpleExperiment, List[WorkItem]]]:
+        """为每个实验单元创建实验对象，并把各单元的调度单位轮转交错成全局队列"""
+        per_cell: List[List[Tuple[SimpleExperiment, List[WorkItem]]]] = []
+        for cell in self.cells:
+            exp = SimpleExperiment(
+                csv_path=self.csv_path,
+                model_name=cell.model.name,
+                samples_per_condition=self.samples,
+                include_emotional=cell.include_emotional,
+                experiment_id_prefix=cell.prefix,
+                reasoning_type=cell.reasoning_type,
+                age=cell.age,
+                client=self._client_for(cell.model),
+                cases=self.cases,
+                journal=self.journal,
+                batch_samples=self.batch_samples,
+                shard=self.shard,
+                adaptive=self.adaptive,
+                schedule=self.schedule,
+            )
+            if self.resume_records:
+                exp.resume_from(self.resume_records)
+            items = exp.plan()
+            pending = exp.start_run(items)
+            self.experiments.append(exp)
+            units = group_work_items(pending, self.batch_samples)
+            per_cell.append([(exp, unit) for unit in units])
+
+        jobs: List[Tuple[SimpleExperiment, List[WorkItem]]] = []
+        longest = max((len(c) for c in per_cell), default=0)
+        for i in range(longest):
+            for cell_jobs in per_cell:
+                if i < len(cell_jobs):
+                    jobs.append(cell_jobs[i])
+        return jobs
+
+    async def run_async(self) -> List[SimpleExperiment]:
+        """执行全部实验单元"""
+        jobs = self.build()
+        if not jobs:
+            print("⚠️ 没有可执行的工作项")
+            for exp in self.experiments:
+                exp.finish_run()
+            return self.experiments
+
+        print(f"网格配置:")
+        print(f"  实验单元数: {len(self.experiments)}")
+        print(f"  模型服务数: {len(self.clients)}")
+        for client in self.clients.values():
+            print(f"    - {client.model_name} (并发 {client.max_concurrency})")
+        if self.adaptive is not None:
+            print(f"  每条件样本数: 自适应 {self.adaptive.min_samples}~{self.samples} "
+                  f"(95% CI 宽度 <= {self.adaptive.ci_width})")
+        else:
+            print(f"  每条件样本数: {self.samples}")
+        print(f"  调度顺序: {self.schedule}")
+        if self.shard is not None:
+            print(f"  分片: {self.shard[0]}/{self.shard[1]}")
+        total = sum(len(unit) for _, unit in jobs)
+        resumed = sum(len(exp._slots) for exp in self.experiments) - total
+        if resumed:
+            print(f"  从日志恢复: {resumed}")
+        print(f"  总预期次数: {total}{'（上限）' if self.adaptive is not None else ''}")
+        print("-" * 60)
+
+        if self.adaptive is not None:
+            await run_adaptive_rounds(self.experiments, self.schedule)
+        else:
+            await WorkScheduler(total=total, schedule=self.schedule).run(jobs)
+        await retry_failed_parses(self.experiments, self.parse_retries)
+        for exp in self.experiments:
+            exp.finish_run()
+            print_adaptive_stats(exp)
+        for client in self.clients.values():
+            print_limiter_stats(client)
+            print_budget_stats(client)
+        print_parse_stats(self.experiments)
+        print_run_telemetry([r for exp in self.experiments for r in exp.results])
+        if self.cache is not None:
+            print_cache_stats(self.cache)
+        return self.experiments
+
+    def run(self) -> List[SimpleExperiment]:
+        async def run_and_close():
+            try:
+                return await self.run_async()
+            finally:
+                for client in self.clients.values():
+                    await client.aclose()
+        return asyncio.run(run_and_close())
+
+    def estimate(self, latency: float = None):
+        """只规划不请求：按模型打印全部实验单元预计的 token 用量、费用与墙钟时间"""
+        jobs = self.build()
+        print(f"网格配置（预估）:")
+        print(f"  实验单元数: {len(self.experiments)}")
+        print(f"  总预期次数: {sum(len(unit) for _, unit in jobs)}{'（上限）' if self.adaptive is not None else ''}")
+        print_estimate(estimate_run(self.experiments, latency), adaptive=self.adaptive is not None)
+        for exp in self.experiments:
+            exp.finish_run()
+
+    def run_batch(self, runner: BatchRunner, batch_ids: Dict[str, str] = None) -> List[SimpleExperiment]:
+        """以离线批处理模式执行全部实验单元，每个模型服务提交一个批处理任务"""
+        jobs = [(exp, item) for exp, unit in self.build() for item in unit]
+        if self.adaptive is not None:
+            print("⚠️ 批处理模式不支持自适应采样，将提交全部样本")
+        if self.budgets:
+            print("⚠️ 批处理模式不在运行中检查预算，请先用 --estimate 预估用量")
+        print(f"网格配置（批处理模式）:")
+        print(f"  实验单元数: {len(self.experiments)}")
+        print(f"  总请求数: {len(jobs)}")
+        print("-" * 60)
+        if jobs:
+            runner.run(jobs, batch_ids)
+        for exp in self.experiments:
+            exp.finish_run()
+        print_parse_stats(self.experiments)
+        return self.experiments
+
+    def export(self):
+        """按 expNNN 脚本的命名方式逐个导出实验单元结果"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        print(f"\n📊 结果统计:")
+        for cell, exp in zip(self.cells, self.experiments):
+            output_name = os.path.join(self.output_dir, f"{cell.model.name}_{cell.prefix}_{ts}")
+            exp.export(output_name, self.export_formats, self.parquet_root)
+            if exp.results:
+                avg_score = sum(r.score for r in exp.results) / len(exp.results)
+                avg_arousal = sum(r.emotional_arousal for r in exp.results) / len(exp.results)
+                print(f"  {cell.prefix}: 平均评分 {avg_score:.2f} | "
+                      f"平均情绪唤醒度 {avg_arousal:.2f} | 样本数 {len(exp.results)}")
+
+
+# ==================== Main Function ====================
+def main():
+    """主函数 - 支持命令行参数"""
+    parser = argparse.ArgumentParser(
+        description='按网格配置在单进程中运行全部LLM惩罚决策实验',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  # 运行 sweep.toml 中定义的全部实验单元
+  python sweep_runner.py --spec sweep.toml
+
+  # 仅运行部分实验单元
+  python sweep_runner.py --spec sweep.toml --only exp001 exp002 exp003
+
+  # 中断后从网格日志恢复，仅补跑缺失的调用
+  python sweep_runner.py --spec sweep.toml --resume
+
+  # 离线批处理模式（每个模型服务提交一个 Batch 任务）
+  python sweep_runner.py --spec sweep.toml --batch-mode --batch-poll 60
+
+  # 自适应采样：samples 作为上限，条件收敛后停止追加样本（也可在配置中写 [adaptive] 表）
+  python sweep_runner.py --spec sweep.toml --adaptive --min-samples 3 --ci-width 1.0
+
+  # 只预估各模型的 token 用量、费用与墙钟时间（单价与预算可在 [models.*] 中按模型设置）
+  python sweep_runner.py --spec sweep.toml --estimate
+
+  # 每个模型最多 2000 万 tokens，用尽后暂停，调整预算后 --resume 继续
+  python sweep_runner.py --spec sweep.toml --token-budget 20000000
+
+  # 分3台机器（或3组API密钥）运行，完成后合并
+  python sweep_runner.py --spec sweep.toml --shard 0/3
+  python merge_shards.py sweep.shard*.journal.jsonl --spec sweep.toml --output-dir merged
+
+  # 列出网格展开后的实验单元而不运行
+  python sweep_runner.py --spec sweep.toml --list
+        """
+    )
+
+    parser.add_argument('--spec', type=str, required=True,
+                       help='网格配置文件（TOML 或 YAML）')
+    parser.add_argument('--csv', type=str, default=None,
+                       help='CSV数据文件路径（默认: 使用配置中的 csv）')
+    parser.add_argument('--samples', type=int, default=None,
+                       help='每个条件的样本数（默认: 使用配置中的 samples）')
+    parser.add_argument('--output-dir', type=str, default=None,
+                       help='结果输出目录（默认: 使用配置中的 output_dir）')
+    parser.add_argument('--only', type=str, nargs='+', default=None,
+                       help='仅运行指定编号的实验单元，如 exp001 exp045')
+    parser.add_argument('--journal', type=str, default=None,
+                       help='结果日志路径（默认: <输出目录>/sweep.journal.jsonl，分片时为 sweep.shard<i>-<N>.journal.jsonl）')
+    parser.add_argument('--resume', action='store_true',
+                       help='从结果日志恢复，仅执行缺失的工作单元')
+    parser.add_argument('--batch-samples', action='store_true',
+                       help='同一条件的全部样本以一次 n=samples 请求获取')
+    parser.add_argument('--schedule', type=str, default=None, choices=SCHEDULES,
+                       help='请求调度顺序：prefix 把各实验单元中共享提示词前缀的请求连续发出，plan 按计划轮转（默认: 使用配置中的 schedule，未配置为 prefix）')
+    parser.add_argument('--parse-retries', type=int, default=None,
+                       help='对未通过格式校验的结果定向重试的最大轮数（默认: 使用配置中的 parse_retries，未配置为 0）')
+    add_batch_arguments(parser)
+    add_cache_arguments(parser)
+    add_export_arguments(parser)
+    add_adaptive_arguments(parser)
+    add_budget_arguments(parser)
+    parser.add_argument('--shard', type=str, default=None,
+                       help='只执行第 i 个分片（格式 i/N，i 从 0 开始），各分片结果用 merge_shards.py 合并')
+    parser.add_argument('--list', action='store_true',
+                       help='仅列出实验单元')
+
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec)
+    spec_dir = os.path.dirname(os.path.abspath(args.spec))
+    models = parse_models(spec)
+    cells = expand_grid(spec, models)
+    if args.only:
+        wanted = set(args.only)
+        cells = [c for c in cells if c.prefix.split("_")[0] in wanted]
+
+    if args.list:
+        for cell in cells:
+            print(f"{cell.prefix}  ({cell.model.name})")
+        print(f"共 {len(cells)} 个实验单元")
+        return 0
+
+    csv_path = args.csv or os.path.join(spec_dir, spec.get("csv", "final_crime_data.csv"))
+    if not os.path.exists(csv_path):
+        print(f"❌ 错误: CSV文件不存在: {csv_path}")
+        return 1
+
+    output_dir = args.output_dir or os.path.join(spec_dir, spec.get("output_dir", "."))
+    samples = args.samples if args.samples is not None else int(spec.get("samples", 10))
+
+    schedule = args.schedule or spec.get("schedule", "prefix")
+    if schedule not in SCHEDULES:
+        print(f"❌ 错误: 未知的调度顺序: {schedule}（可选: {', '.join(SCHEDULES)}）")
+        return 1
+
+    try:
+        export_formats = export_formats_from_args(args)
+        shard = parse_shard(args.shard) if args.shard else None
+        cache = cache_from_args(args)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"❌ 错误: {e}")
+        return 1
+    adaptive = adaptive_from_args(args, spec.get("adaptive"))
+    if shard is not None and adaptive is not None:
+        print(f"❌ 错误: {ADAPTIVE_SHARD_ERROR}")
+        return 1
+    budgets = {}
+    for key, model in models.items():
+        budget = budget_from_args(args, model.name, {name: getattr(model, name) for name in BUDGET_FIELDS})
+        if budget is not None:
+            budgets[key] = budget
+    journal_name = f"sweep.shard{shard[0]}-{shard[1]}.journal.jsonl" if shard else "sweep.journal.jsonl"
+    journal = ResultJournal(args.journal or os.path.join(output_dir, journal_name))
+
+    print(f"🧪 开始网格实验")
+    print("=" * 60)
+    try:
+        orchestrator = SweepOrchestrator(
+            csv_path, cells,
+            samples=samples,
+            output_dir=output_dir,
+            journal=journal,
+            resume_records=journal.load() if args.resume else None,
+            cache=cache,
+            batch_samples=args.batch_samples,
+            parse_retries=args.parse_retries if args.parse_retries is not None
+            else int(spec.get("parse_retries", 0)),
+            export_formats=export_formats,
+            parquet_root=args.parquet_dir,
+            shard=shard,
+            adaptive=adaptive,
+            schedule=schedule,
+            budgets=budgets,
+            local=not args.estimate,
+        )
+        if args.estimate:
+            orchestrator.estimate(args.est_latency)
+            return 0
+        batch_runner = batch_runner_from_args(args)
+        if batch_runner is not None:
+            # --batch-id 格式: 模型名=任务ID[,模型名=任务ID]
+            batch_ids = dict(pair.split("=", 1) for pair in args.batch_id.split(",")) \
+                if args.batch_id else None
+            orchestrator.run_batch(batch_runner, batch_ids)
+        else:
+            orchestrator.run()
+        orchestrator.export()
+        print("✅ 网格实验完成")
+        return 0
+    except Exception as e:
+        print(f"❌ 网格实验运行失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        journal.close()
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,200 @@
+"""experiment_runner 的回归测试（python -m pytest test_experiment_runner.py）"""
+
+import asyncio
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+from openai import BadRequestError
+
+from experiment_runner import (
+    AdaptiveSampling, AsyncLLMClient, ChatReply, ResponseCache, Result, ResultJournal, SimpleExperiment,
+    reset_service_state,
+)
+
+
+def make_result(case_id: str) -> Result:
+    return Result(
+        experiment_id="with_emotional_20250101_000000", case_id=case_id, role="TPP",
+        time_condition="即时", delay_time="当日", model="mock", include_emotional=True,
+        score=5, reasoning="", emotional_arousal=3, emotional_description="", case_analysis="",
+        punishment_justification="", response_time=0.1, timestamp="2025-01-01T00:00:00",
+    )
+
+
+def test_journal_append_after_torn_line(tmp_path):
+    """崩溃留下半行后恢复追加：新结果另起一行，之后仍可完整载入"""
+    path = tmp_path / "exp.journal.jsonl"
+    journal = ResultJournal(str(path))
+    journal.append(make_result("1"))
+    journal.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"experiment_id": "with_emo')
+
+    resumed = ResultJournal(str(path))
+    assert [r.case_id for r in resumed.load()] == ["1"]
+    resumed.append(make_result("2"))
+    resumed.close()
+
+    assert [r.case_id for r in ResultJournal(str(path)).load()] == ["1", "2"]
+
+
+def bad_request(message: str) -> BadRequestError:
+    return BadRequestError(message, response=SimpleNamespace(status_code=400, request=None, headers={}),
+                           body=None)
+
+
+class RejectingClient(AsyncLLMClient):
+    """n>1 一律以 400 拒绝（错误信息与 response_format 无关），response_format 本身受支持"""
+
+    def __init__(self, message: str = "n must be 1"):
+        super().__init__("mock", "http://127.0.0.1:1/v1", "mock", structured=True, max_retries=0)
+        self.message = message
+        self.sent_schema: List[bool] = []
+
+    async def _asend(self, prompt, n=1, endpoint=None, schema=True):
+        self.sent_schema.append(schema)
+        if n > 1:
+            raise bad_request(self.message)
+        return ChatReply(texts=["{}"])
+
+
+def test_unrelated_400_keeps_schema_enabled():
+    """n>1 引起的 400 不应关闭 response_format"""
+    client = RejectingClient()
+    window = client.limiter.window
+    with pytest.raises(BadRequestError):
+        asyncio.run(client._acreate("p", n=2))
+    assert client.supports_schema is not False
+    assert client.sent_schema == [True, False]
+    assert client.limiter.window == window
+    assert asyncio.run(client._acreate("p")).texts == ["{}"]
+    assert client.supports_schema is True
+
+
+def test_schema_400_disables_schema():
+    """错误信息提到 response_format 时关闭，之后的请求不再发送"""
+    client = RejectingClient("response_format is not supported")
+
+    async def reject_schema(prompt, n=1, endpoint=None, schema=True):
+        client.sent_schema.append(schema)
+        if schema:
+            raise bad_request(client.message)
+        return ChatReply(texts=["{}"])
+
+    client._asend = reject_schema
+    assert asyncio.run(client._acreate("p")).texts == ["{}"]
+    assert client.supports_schema is False
+    assert client.sent_schema == [True, False]
+
+
+class FakeStream:
+    """按顺序产出给定分块的流式响应"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        return self.chunks.pop(0)
+
+    async def close(self):
+        pass
+
+
+def test_stream_options_rejected_falls_back():
+    """服务端拒绝 stream_options 时去掉该参数重试，之后的流式请求不再发送"""
+    sent = []
+
+    async def create(**kwargs):
+        sent.append("stream_options" in kwargs)
+        if "stream_options" in kwargs:
+            raise bad_request("Unrecognized request argument supplied: stream_options")
+        delta = SimpleNamespace(content='{"punishment_score": 5}')
+        return FakeStream([SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta)], usage=None)])
+
+    client = AsyncLLMClient("mock", "http://127.0.0.1:1/v1", "mock", stream=True, max_retries=0)
+    client.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    assert asyncio.run(client._asend("p")).texts == ['{"punishment_score": 5}']
+    assert asyncio.run(client._asend("p")).texts == ['{"punishment_score": 5}']
+    assert client.supports_stream_usage is False
+    assert sent == [True, False, False]
+
+
+def test_cache_contains_does_not_touch_stats(tmp_path):
+    """预估用的 contains() 不计入命中统计、不更新 last_access；回放模式下未命中仍为 False"""
+    path = str(tmp_path / "responses.sqlite")
+    cache = ResponseCache(path)
+    cache.put("k", "mock", "{}", 0.1)
+    before = cache._conn.execute("SELECT last_access FROM responses").fetchone()
+    assert cache.contains("k") and not cache.contains("other")
+    assert (cache.hits, cache.misses) == (0, 0)
+    assert cache._conn.execute("SELECT last_access FROM responses").fetchone() == before
+    cache._conn.close()
+
+    replay = ResponseCache(path, replay=True)
+    assert replay.contains("k") and not replay.contains("other")
+    assert (replay.hits, replay.misses) == (0, 0)
+
+
+class PartialChoicesClient(AsyncLLMClient):
+    """n>1 时只返回部分候选（choice.index 不连续且有空内容），单条请求正常返回"""
+
+    def __init__(self):
+        super().__init__("mock", "http://127.0.0.1:1/v1", "mock", max_retries=0)
+        self.requests: List[int] = []
+
+    async def _asend(self, prompt, n=1, endpoint=None, schema=True):
+        self.requests.append(n)
+        if n > 1:
+            return ChatReply(texts=["a", "", "c"], indices=[0, 1, 3])
+        return ChatReply(texts=["single"])
+
+
+def test_missing_choices_filled_by_index():
+    """候选按 choice.index 对应样本，缺失或为空的样本逐条补齐，且不判定为不支持 n"""
+    client = PartialChoicesClient()
+    completions = asyncio.run(client.acomplete_n("p", [0, 1, 2, 3]))
+    assert [c.text for c in completions] == ["a", "single", "single", "c"]
+    assert client.requests == [4, 1, 1]
+    assert client.supports_n is True
+
+
+def test_breaker_keyed_by_api_key_and_reset():
+    """熔断器按 key 区分并带上 max_cooldown；reset_service_state 后新客户端不再沿用之前的状态"""
+    url = "http://127.0.0.1:1/v1"
+    a = AsyncLLMClient("mock", url, "key-a", breaker_max_cooldown=42.0)
+    b = AsyncLLMClient("mock", url, "key-b")
+    assert a.breaker is not b.breaker and a.limiter is not b.limiter
+    assert a.breaker.max_cooldown == 42.0
+    assert AsyncLLMClient("mock", url, "key-a").breaker is a.breaker
+
+    a.breaker.gave_up = True
+    reset_service_state()
+    fresh = AsyncLLMClient("mock", url, "key-a")
+    assert fresh.breaker is not a.breaker and not fresh.breaker.gave_up
+
+
+def test_adaptive_rejects_shard():
+    """自适应采样按条件判断停止，不能与按样本划分的分片同时使用"""
+    with pytest.raises(ValueError):
+        SimpleExperiment(csv_path="unused.csv", model_name="mock", api_url="http://127.0.0.1:1/v1", api_key="x",
+                         shard=(0, 2), adaptive=AdaptiveSampling())
+
+
+def test_stream_without_content_returns_empty_text():
+    """流式响应没有任何内容分块时返回空文本（按格式校验失败处理），而不是 IndexError"""
+
+    async def create(**kwargs):
+        return FakeStream([SimpleNamespace(choices=[], usage=None)])
+
+    client = AsyncLLMClient("mock", "http://127.0.0.1:1/v1", "mock", stream=True, max_retries=0)
+    client.async_client = client.endpoints[0].async_client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    assert asyncio.run(client._asend("p", n=2)).texts == ["", ""]
+    completion = asyncio.run(client.acomplete("p"))
+    assert completion.text == "" and not completion.error